@@ -0,0 +1,142 @@
+import io
+import logging
+import queue
+from PIL import Image
+
+from ImageTiling import Tile, ParseTileName, GetTileViews, EncodeTileImage
+from ModelScoring import ScoringJob
+from Instrumentation import recorder
+
+logger = logging.getLogger("AugmentedScoring")
+
+# Views scored for each uncertain tile (see GetTileViews), and how often the tile generator checks for tiles that
+# failed to score while waiting for the last first views
+VIEW_COUNT = 4
+FIRST_VIEW_POLL_SEC = 0.1
+
+class AdaptiveAugmentedScoring:
+    """
+    Adaptive test-time augmentation. Rather than scoring the 90/180/270 degree rotations of every tile (see
+    '--augment'), tiles are scored as they are first, and only tiles with a detection in an uncertain band
+    around BoundingBoxScoreThreshold (within AugmentUncertaintyBand score points of it) are scored again
+    rotated. The rotations are made in memory from the already encoded tile, and the views of each such tile are
+    merged with weighted box fusion (see CoordinateOperations.FuseAugmentedViews). The detections of all other
+    tiles are used as they are, so augmentation only costs requests where it can change the outcome.
+    """
+
+    def __init__(self, settings, scoringMethod, tiler, coordinateOps):
+        self.scoringMethod = scoringMethod
+        self.tiler = tiler
+        self.coordinateOps = coordinateOps
+        self.scoreThreshold = settings.boundingBoxScoreThreshold
+        self.lowerThreshold = max(0.0, settings.boundingBoxScoreThreshold - settings.augmentUncertaintyBand)
+        self.upperThreshold = settings.boundingBoxScoreThreshold + settings.augmentUncertaintyBand
+
+    def __rotateTile(self, tile):
+        _, _, _, _, x, y = ParseTileName(tile.name)
+        with Image.open(io.BytesIO(tile.data)) as image:
+            for angle, view in GetTileViews(image, True):
+                if angle == 0:
+                    continue
+                with recorder.Span("encode", tile=tile.name, angle=angle):
+                    data = EncodeTileImage(view)
+                yield Tile(self.tiler.GetTileName(tile.index, tile.row, tile.col, angle, x, y), tile.index, tile.row, tile.col, angle, data)
+
+    def __generateViews(self, tiles, firstViews, progress):
+        # Runs on a background thread (see ScoringBackend.PullTile). The unrotated tiles are passed on as they come,
+        # along with the rotated views of each tile reported uncertain through firstViews so far (each tile's first
+        # view is reported as the tile, or as None when it needs no augmentation), so the second pass overlaps
+        # with the first
+        for tile in tiles:
+            yield tile
+            progress["sent"] += 1
+            yield from self.__rotateReported(firstViews, progress, False)
+
+    def __generateRemainingViews(self, firstViews, progress, firstJob):
+        # Waits for the first views still being scored once all tiles are queued, yielding the rotated views of
+        # the uncertain ones. This is a job of its own, since backends may hold back the last tiles of a job
+        # until it has no more (e.g. a partial batch). Tiles that fail to score are never reported, only listed
+        # in the first job's failed tiles.
+        while progress["reported"] + sum(1 for name in list(firstJob.failedTiles) if ParseTileName(name)[3] == 0) < progress["sent"]:
+            yield from self.__rotateReported(firstViews, progress, True)
+
+    def __rotateReported(self, firstViews, progress, block):
+        while True:
+            try:
+                tile = firstViews.get(block, FIRST_VIEW_POLL_SEC)
+            except queue.Empty:
+                return
+            progress["reported"] += 1
+            block = False
+            if tile is not None:
+                yield from self.__rotateTile(tile)
+
+    def __toScores(self, tile, detections):
+        return [
+            { "name": tile.name, "score": score, "tag": tag, "boxes": [tuple(box)] }
+            for box, score, tag in zip(detections.boxes.tolist(), detections.scores.tolist(), detections.tags)
+        ]
+
+    def __fuse(self, tile, views):
+        # Fused boxes are named after the unrotated tile
+        with recorder.Span("fuse", tile=tile.name, boxes=len(views)):
+            fused = self.coordinateOps.FuseAugmentedViews(
+                self.tiler.tileHeight,
+                self.tiler.tileWidth,
+                views,
+                scoreThreshold=self.scoreThreshold
+            )
+        return self.coordinateOps.ScoresToDetections(fused)
+
+    def ScoreTiles(self, sourceImage, tiles, onTileScored):
+        """
+        Scores the (unrotated) tiles of a source image, calling onTileScored(tile, detections) with the final
+        detections of each tile, as for ScoringBackend.ScoreTiles: right away for tiles without uncertain
+        detections, and once the rotated views are fused for the others. The rotated views go through the same
+        work queue as the other tiles, so at most MaxTilesInFlight tiles are held in memory; tiles waiting for
+        their rotated views to be scored are only kept by position (they are passed to onTileScored without data).
+        """
+        firstViews = queue.Queue()
+        uncertain = {}
+        scored = 0
+        augmented = 0
+
+        # Boxes down to the bottom of the uncertain band are kept, to tell which tiles are worth augmenting
+        def onViewScored(tile, detections):
+            nonlocal scored, augmented
+            if tile.angle == 0:
+                scored += 1
+                if (detections.scores <= self.upperThreshold).any():
+                    augmented += 1
+                    uncertain[tile.name] = (tile._replace(data=b""), self.__toScores(tile, detections), VIEW_COUNT - 1)
+                    firstViews.put(tile)
+                else:
+                    # Reported before the consumer runs, so the tile generator isn't left waiting should it raise
+                    firstViews.put(None)
+                    onTileScored(tile, detections.Select(detections.scores > self.scoreThreshold))
+                return
+
+            # The views of a tile are fused as soon as they are all in
+            _, _, _, _, x, y = ParseTileName(tile.name)
+            name = self.tiler.GetTileName(tile.index, tile.row, tile.col, 0, x, y)
+            original, views, remaining = uncertain[name]
+            views.extend(self.__toScores(tile, detections))
+            if remaining > 1:
+                uncertain[name] = (original, views, remaining - 1)
+                return
+            del uncertain[name]
+            onTileScored(original, self.__fuse(original, views))
+
+        progress = { "sent": 0, "reported": 0 }
+        firstJob = ScoringJob(sourceImage, self.__generateViews(tiles, firstViews, progress), scoreThreshold=self.lowerThreshold, onTileScored=onViewScored)
+        lastJob = ScoringJob(sourceImage, self.__generateRemainingViews(firstViews, progress, firstJob), scoreThreshold=self.lowerThreshold, onTileScored=onViewScored)
+        self.scoringMethod.ScoreJobs([firstJob, lastJob])
+        if firstJob.error is not None:
+            raise Exception(firstJob.error)
+
+        # Tiles with rotated views that failed to score are fused from the views that didn't
+        for original, views, _ in uncertain.values():
+            onTileScored(original, self.__fuse(original, views))
+
+        logger.info(f"Scored rotated views of {augmented} of {scored} tiles with uncertain detections (scores from {self.lowerThreshold} to {self.upperThreshold})")
+        recorder.Increment("tiles_augmented", augmented)
@@ -1,44 +1,520 @@
+import itertools
 import logging
+import numpy as np
+
+from ImageTiling import ParseTileName
 
 logger = logging.getLogger("BoundingBoxes")
 
+class DetectionArray:
+    """
+    Column-oriented storage for a batch of detections. Boxes are held in an (N, 4) float array of
+    (x1, y1, x2, y2), alongside an (N, 3) int array of the (row, col, angle) of the tile each box came from,
+    an (N,) array of scores, an (N, 2) float array with the pixel origin of each tile (NaN for grid tiles,
+    whose origin follows from the row and column) and an (N,) object array with the tag name of each box.
+    """
+
+    def __init__(self, boxes, tiles, scores, origins=None, tags=None):
+        self.boxes = boxes
+        self.tiles = tiles
+        self.scores = scores
+        self.origins = origins if origins is not None else np.full((boxes.shape[0], 2), np.nan)
+        self.tags = tags if tags is not None else np.full(boxes.shape[0], "", dtype=object)
+
+    def __len__(self):
+        return self.boxes.shape[0]
+
+    def Select(self, indices):
+        """
+        Returns a new DetectionArray holding only the given rows (indices or boolean mask).
+        """
+        return DetectionArray(self.boxes[indices], self.tiles[indices], self.scores[indices], self.origins[indices], self.tags[indices])
+
+    def ToBoxList(self):
+        """
+        Returns the boxes as a list of (x1, y1, x2, y2) tuples.
+        """
+        return [tuple(box) for box in self.boxes.tolist()]
+
+class SpatialGridIndex:
+    """
+    Uniform grid over source image space, for finding the boxes near a region without scanning every box. Each
+    box is listed in every cell (of cellSize x cellSize pixels) it overlaps, under its number: the order in which
+    boxes were inserted, which is their row in the DetectionArray (or DetectionStore) they came from. Boxes can
+    be inserted at any time, e.g. as tiles are scored. With a cell size of about twice the typical box size
+    (see IndexBoxes), a box overlaps at most a handful of cells, so finding the boxes that may overlap a box
+    costs about the same regardless of how many boxes there are.
+    """
+
+    def __init__(self, cellSize):
+        if (cellSize <= 0):
+            msg = f"Specified cell size {cellSize} cannot be less than / equal to zero"
+            logger.error(msg)
+            raise Exception(msg)
+
+        self.cellSize = float(cellSize)
+        self.count = 0
+        self.__cells = {}
+
+    def __len__(self):
+        return self.count
+
+    def __getCellRange(self, box):
+        return np.floor(np.asarray(box, dtype=np.float64) / self.cellSize).astype(np.int64).tolist()
+
+    def Insert(self, boxes):
+        """
+        Adds an (N, 4) array of (x1, y1, x2, y2) boxes, numbered on from the boxes already inserted.
+        """
+        cells = np.floor(boxes / self.cellSize).astype(np.int64).tolist()
+        for number, (cellX1, cellY1, cellX2, cellY2) in enumerate(cells, self.count):
+            for cellX in range(cellX1, cellX2 + 1):
+                for cellY in range(cellY1, cellY2 + 1):
+                    self.__cells.setdefault((cellX, cellY), []).append(number)
+        self.count += len(cells)
+
+    def GetCandidates(self, region):
+        """
+        Returns the (sorted) numbers of the boxes listed in the cells overlapped by an (x1, y1, x2, y2) region: every
+        box overlapping the region, along with some nearby boxes that don't.
+        """
+        cellX1, cellY1, cellX2, cellY2 = self.__getCellRange(region)
+
+        # Regions covering more cells than are in use (e.g. the whole image) go through the cells in use instead
+        if (cellX2 - cellX1 + 1) * (cellY2 - cellY1 + 1) > len(self.__cells):
+            lists = [numbers for (cellX, cellY), numbers in self.__cells.items() if cellX1 <= cellX <= cellX2 and cellY1 <= cellY <= cellY2]
+        else:
+            cells = ((cellX, cellY) for cellX in range(cellX1, cellX2 + 1) for cellY in range(cellY1, cellY2 + 1))
+            lists = [self.__cells[cell] for cell in cells if cell in self.__cells]
+
+        if len(lists) == 1:
+            return np.array(lists[0], dtype=np.int64)
+        return np.unique(np.fromiter(itertools.chain.from_iterable(lists), dtype=np.int64))
+
+def IndexBoxes(boxes, cellSize=None):
+    """
+    Returns a SpatialGridIndex of an (N, 4) array of boxes. Unless given, the cell size is twice the median
+    size (longest side) of the boxes.
+    """
+    if cellSize is None:
+        sizes = np.maximum(boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1])
+        cellSize = max(1.0, 2 * float(np.median(sizes))) if len(sizes) else 1.0
+    index = SpatialGridIndex(cellSize)
+    index.Insert(boxes)
+    return index
+
+def FindOverlapping(boxes, region, index=None):
+    """
+    Returns the (sorted) indices of the (N, 4) boxes that overlap an (x1, y1, x2, y2) region, using a
+    SpatialGridIndex of the boxes when given, rather than checking every box.
+    """
+    candidates = np.arange(boxes.shape[0]) if index is None else index.GetCandidates(region)
+    candidateBoxes = boxes[candidates]
+    overlapping = (candidateBoxes[:, 0] < region[2]) & (candidateBoxes[:, 2] > region[0]) & \
+                  (candidateBoxes[:, 1] < region[3]) & (candidateBoxes[:, 3] > region[1])
+    return candidates[overlapping]
+
+class DetectionStore:
+    """
+    Append-only store of detections, for collecting them as tiles are scored. Detections are held in the same
+    columns as a DetectionArray, in preallocated arrays that double in size when full, so each box costs a
+    fixed ~80 bytes rather than a dict with nested lists; tags are stored as indices into a list of tag names.
+    Given a cell size, the boxes are also added to a SpatialGridIndex as they are appended, for region queries
+    (see Query) and duplicate removal (see CoordinateOperations.NonMaxSuppression).
+    """
+    INITIAL_CAPACITY = 256
+
+    def __init__(self, cellSize=None):
+        self.count = 0
+        self.index = SpatialGridIndex(cellSize) if cellSize is not None else None
+        self.tagNames = []
+        self.__tagIndices = {}
+        self.__boxes = np.empty((self.INITIAL_CAPACITY, 4))
+        self.__tiles = np.empty((self.INITIAL_CAPACITY, 3), dtype=np.int64)
+        self.__scores = np.empty(self.INITIAL_CAPACITY)
+        self.__origins = np.empty((self.INITIAL_CAPACITY, 2))
+        self.__tags = np.empty(self.INITIAL_CAPACITY, dtype=np.int32)
+
+    def __len__(self):
+        return self.count
+
+    def __grow(self, capacity):
+        def resize(column):
+            grown = np.empty((capacity,) + column.shape[1:], dtype=column.dtype)
+            grown[0:self.count] = column[0:self.count]
+            return grown
+
+        self.__boxes = resize(self.__boxes)
+        self.__tiles = resize(self.__tiles)
+        self.__scores = resize(self.__scores)
+        self.__origins = resize(self.__origins)
+        self.__tags = resize(self.__tags)
+
+    def __getTagIndex(self, tag):
+        if tag not in self.__tagIndices:
+            self.__tagIndices[tag] = len(self.tagNames)
+            self.tagNames.append(tag)
+        return self.__tagIndices[tag]
+
+    def Append(self, detections):
+        """
+        Appends the detections of a DetectionArray.
+        """
+        start, end = self.count, self.count + len(detections)
+        if end > self.__scores.shape[0]:
+            self.__grow(max(end, 2 * self.__scores.shape[0]))
+
+        self.__boxes[start:end] = detections.boxes
+        self.__tiles[start:end] = detections.tiles
+        self.__scores[start:end] = detections.scores
+        self.__origins[start:end] = detections.origins
+        self.__tags[start:end] = [self.__getTagIndex(tag) for tag in detections.tags]
+        self.count = end
+        if self.index is not None:
+            self.index.Insert(detections.boxes)
+
+    def Query(self, region):
+        """
+        Returns the indices (in the order they were appended) of the stored detections whose boxes overlap an
+        (x1, y1, x2, y2) region.
+        """
+        return FindOverlapping(self.__boxes[0:self.count], region, self.index)
+
+    def ToDetections(self):
+        """
+        Returns the stored detections as a DetectionArray (a copy, so the store can keep growing).
+        """
+        tagNames = np.empty(len(self.tagNames), dtype=object)
+        tagNames[:] = self.tagNames
+        return DetectionArray(
+            self.__boxes[0:self.count].copy(),
+            self.__tiles[0:self.count].copy(),
+            self.__scores[0:self.count].copy(),
+            self.__origins[0:self.count].copy(),
+            tagNames[self.__tags[0:self.count]]
+        )
+
 class CoordinateOperations:
     def RemapBoundingBoxes(self, tileHeight, tileWidth, scores):
         """
         This method re-maps all bounding boxes found to the global space within the original source 
-        image.
+        image. Returns a list of (x1, y1, x2, y2) tuples; see RemapDetections for the batch version.
         """
-        # Start with an empty array
-        results = []
+        detections = self.RemapDetections(tileHeight, tileWidth, self.ScoresToDetections(scores))
+        return detections.ToBoxList()
 
-        # Here, socres is a list of results from our scoring API. 
+    def ScoresToDetections(self, scores):
+        """
+        Converts a list of results from our scoring API into a DetectionArray, parsing each tile name once.
+        """
+        boxes, tiles, values, origins, tags = [], [], [], [], []
         for score in scores:
+            # Given a tile file name, parse out the name into pieces
+            _, tileRow, tileCol, angle, x, y = ParseTileName(score["name"])
+            tile = (tileRow, tileCol, angle)
+            origin = (np.nan, np.nan) if x is None else (x, y)
+
             # Each score contains a list of boxes
             for box in score["boxes"]:
-                # Given a tile file name, parse out the name into pieces
-                _, index, tileRow, tileCol, angle = score["name"].split('.')[0].split('_')
-                x1, y1, x2, y2 = box
-
-                logger.info(f"Mapping box {x1},{y1},{x2},{y2} in row {tileRow}, col {tileCol}...")
-
-                # Translate box coords to R2 using TranslateR4toR2
-                x, y = self.TranslateR4toR2(
-                    tileWidth, 
-                    tileHeight, 
-                    int(tileCol), 
-                    int(tileRow), 
-                    x1, 
-                    y1
-                )
-                width = x2 - x1
-                height = y2 - y1
-
-                logger.info(f"New coordinates: {x}, {y} with width = {width} and height = {height}")
-
-                # Add box to output list
-                results.append((x, y, x + width, y + height))
+                boxes.append(box)
+                tiles.append(tile)
+                values.append(score["score"])
+                origins.append(origin)
+                tags.append(score.get("tag", ""))
+
+        return DetectionArray(
+            np.array(boxes, dtype=np.float64).reshape(-1, 4), 
+            np.array(tiles, dtype=np.int64).reshape(-1, 3), 
+            np.array(values, dtype=np.float64),
+            np.array(origins, dtype=np.float64).reshape(-1, 2),
+            np.array(tags, dtype=object).reshape(-1)
+        )
+
+    def RemapDetections(self, tileHeight, tileWidth, detections, scale=1.0):
+        """
+        Vectorized re-mapping of a DetectionArray from tile space to source image space: undoes any tile
+        rotation (see RotateBoxToTileSpace) and translates each box by its tile offset, for all boxes at once.
+        The offset is the tile's pixel origin when known (e.g. overlapping tiles), and is otherwise computed
+        from the tile row and column (see TranslateR4toR2). Tiles cut from a reduced copy of the source image
+        (see PyramidScoring) are scaled back up by the reduction factor given as the scale. Returns a new
+        DetectionArray.
+        """
+
+        # Validate range of params is correct
+        self.__validateDetections(tileWidth, tileHeight, detections, scale)
+
+        x1, y1, x2, y2 = detections.boxes.T
+        tileRows, tileCols, angles = detections.tiles.T
+        logger.info(f"Mapping {len(detections)} boxes to source image space...")
+
+        # Undo any rotation applied to the tiles, so boxes are in the tiles' original orientation
+        boxes = detections.boxes.copy()
+        rotated = angles == 90
+        boxes[rotated] = np.stack([tileWidth - y2, x1, tileWidth - y1, x2], axis=1)[rotated]
+        rotated = angles == 180
+        boxes[rotated] = np.stack([tileWidth - x2, tileHeight - y2, tileWidth - x1, tileHeight - y1], axis=1)[rotated]
+        rotated = angles == 270
+        boxes[rotated] = np.stack([y1, tileHeight - x2, y2, tileHeight - x1], axis=1)[rotated]
+
+        # Tranlate the coordinate system from R4 to R2
+        originX = np.where(np.isnan(detections.origins[:, 0]), tileWidth * tileCols, detections.origins[:, 0])
+        originY = np.where(np.isnan(detections.origins[:, 1]), tileHeight * tileRows, detections.origins[:, 1])
+        boxes[:, [0, 2]] += originX[:, np.newaxis]
+        boxes[:, [1, 3]] += originY[:, np.newaxis]
+        if scale != 1.0:
+            boxes *= scale
+
+        return DetectionArray(boxes, detections.tiles, detections.scores, detections.origins, detections.tags)
+
+    def NonMaxSuppression(self, detections, iouThreshold=0.5, index=None):
+        """
+        Removes duplicate detections (e.g. the same object found on neighboring tiles): boxes are visited in
+        order of decreasing score, and any remaining box overlapping a kept box with an IoU above the
+        threshold is discarded. Each kept box is only compared with the boxes sharing a cell of a
+        SpatialGridIndex of the detections (the given index, e.g. one built as tiles were scored, or else a new
+        one), rather than with every remaining box. Returns a new DetectionArray with the kept boxes, highest
+        score first.
+        """
+        boxes = detections.boxes
+        areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        order = np.argsort(-detections.scores, kind="stable")
+        ranks = np.empty(len(order), dtype=np.int64)
+        ranks[order] = np.arange(len(order))
+        suppressed = np.zeros(len(order), dtype=bool)
+        index = index if index is not None else IndexBoxes(boxes)
+        keep = []
+
+        for current in order.tolist():
+            if suppressed[current]:
+                continue
+            keep.append(current)
+
+            # Only boxes not visited yet can be suppressed
+            candidates = index.GetCandidates(boxes[current])
+            candidates = candidates[(ranks[candidates] > ranks[current]) & ~suppressed[candidates]]
+            intersection = self.__intersectionAreas(boxes[current], boxes[candidates])
+            iou = intersection / (areas[current] + areas[candidates] - intersection)
+
+            suppressed[candidates[~(iou <= iouThreshold)]] = True
+
+        logger.info(f"Non-max suppression kept {len(keep)} of {len(detections)} boxes")
+        return detections.Select(np.array(keep, dtype=np.int64))
+
+    def MergeSeamDuplicates(self, detections, overlapThreshold=0.5, index=None):
+        """
+        Merges duplicate detections of the same object from overlapping tiles. An object crossing a tile seam
+        is typically found whole on one tile and cut off on its neighbour, so the two boxes have a low IoU;
+        instead, boxes from different tiles are considered duplicates when their intersection covers more than
+        overlapThreshold of the smaller box. Boxes are visited in order of decreasing score, and each kept box
+        is grown to the union of the duplicates merged into it. As for NonMaxSuppression, each kept box is only
+        compared with the boxes sharing a cell of a SpatialGridIndex. Returns a new DetectionArray.
+        """
+        boxes = detections.boxes.copy()
+        areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        tileIds = detections.tiles[:, 0] * (detections.tiles[:, 1].max(initial=0) + 1) + detections.tiles[:, 1]
+        order = np.argsort(-detections.scores, kind="stable")
+        visited = np.zeros(len(order), dtype=bool)
+        index = index if index is not None else IndexBoxes(boxes)
+        keep = []
+
+        for current in order.tolist():
+            if visited[current]:
+                continue
+            visited[current] = True
+            keep.append(current)
+
+            # Boxes are only grown once visited, so the index still holds the boxes of those not visited yet
+            candidates = index.GetCandidates(boxes[current])
+            candidates = candidates[~visited[candidates]]
+            intersection = self.__intersectionAreas(boxes[current], boxes[candidates])
+            overlap = intersection / np.maximum(np.minimum(areas[current], areas[candidates]), np.finfo(np.float64).eps)
+            duplicates = (overlap > overlapThreshold) & (tileIds[candidates] != tileIds[current])
+
+            merged = candidates[duplicates]
+            if merged.size > 0:
+                boxes[current, 0:2] = np.minimum(boxes[current, 0:2], boxes[merged, 0:2].min(axis=0))
+                boxes[current, 2:4] = np.maximum(boxes[current, 2:4], boxes[merged, 2:4].max(axis=0))
+                visited[merged] = True
+
+        keep = np.array(keep, dtype=np.int64)
+        logger.info(f"Seam merging kept {len(keep)} of {len(detections)} boxes")
+        return DetectionArray(boxes[keep], detections.tiles[keep], detections.scores[keep], detections.origins[keep], detections.tags[keep])
+
+    def ClusterDetections(self, detections, maxDistance):
+        """
+        Groups repeated detections of the same object (e.g. from overlapping passes over the same area): detections
+        with the same tag whose box centres are within maxDistance pixels of each other are put in the same
+        cluster, as are detections linked through a chain of such neighbours. Neighbours are found through a
+        SpatialGridIndex of the box centres, with cells of maxDistance pixels. Returns an (N,) array with the
+        cluster number of each detection, numbered in order of each cluster's first detection.
+        """
+        centres = (detections.boxes[:, 0:2] + detections.boxes[:, 2:4]) / 2
+        index = IndexBoxes(np.concatenate([centres, centres], axis=1), max(maxDistance, np.finfo(np.float64).eps))
+        parents = np.arange(len(detections))
+
+        def findRoot(i):
+            while parents[i] != i:
+                parents[i] = parents[parents[i]]
+                i = parents[i]
+            return i
+
+        for i, (x, y) in enumerate(centres.tolist()):
+            neighbours = index.GetCandidates((x - maxDistance, y - maxDistance, x + maxDistance, y + maxDistance))
+            neighbours = neighbours[neighbours > i]
+            distances = np.hypot(centres[neighbours, 0] - x, centres[neighbours, 1] - y)
+            for j in neighbours[(distances <= maxDistance) & (detections.tags[neighbours] == detections.tags[i])].tolist():
+                rootI, rootJ = findRoot(i), findRoot(j)
+                parents[max(rootI, rootJ)] = min(rootI, rootJ)
+
+        roots = np.array([findRoot(i) for i in range(len(detections))], dtype=np.int64)
+        _, clusters = np.unique(roots, return_inverse=True)
+        logger.info(f"Clustered {len(detections)} boxes into {clusters.max(initial=-1) + 1} objects")
+        return clusters.reshape(-1)
+
+    def __intersectionAreas(self, box, boxes):
+        width = np.minimum(box[2], boxes[:, 2]) - np.maximum(box[0], boxes[:, 0])
+        height = np.minimum(box[3], boxes[:, 3]) - np.maximum(box[1], boxes[:, 1])
+        return np.clip(width, 0, None) * np.clip(height, 0, None)
+
+    def __validateDetections(self, tile_width, tile_height, detections, scale):
+        if (tile_width <= 0): 
+            msg = f"Specified tile width {tile_width} cannot be less than / equal to zero";
+            logger.error(msg)
+            raise Exception(msg)
         
+        if (tile_height <= 0): 
+            msg = f"Specified tile height {tile_height} cannot be less than / equal to zero";
+            logger.error(msg)
+            raise Exception(msg)
+
+        if (scale <= 0):
+            msg = f"Specified scale {scale} cannot be less than / equal to zero";
+            logger.error(msg)
+            raise Exception(msg)
+
+        if (detections.tiles[:, 0:2] < 0).any():
+            msg = "Specified tile rows/columns cannot be less than zero";
+            logger.error(msg)
+            raise Exception(msg)
+
+        if (detections.boxes < 0).any():
+            msg = "Specified R4 box coordinates cannot be less than zero";
+            logger.error(msg)
+            raise Exception(msg)
+
+        if not np.isin(detections.tiles[:, 2], (0, 90, 180, 270)).all():
+            msg = "Specified rotation angles must be one of 0, 90, 180, 270";
+            logger.error(msg)
+            raise Exception(msg)
+
+    def FuseAugmentedViews(self, tileHeight, tileWidth, scores, iouThreshold=0.55, viewCount=4, scoreThreshold=0.0):
+        """
+        Merges the detections from the rotated (0/90/180/270) views of each tile into a single set of
+        detections, using weighted box fusion. Boxes from each view are first rotated back into tile space,
+        then clustered by IoU (only boxes with the same tag are clustered together); each cluster becomes one box whose coordinates are the score-weighted average
+        of its members. The fused confidence is the mean member score scaled by the fraction of the
+        viewCount views that found the object, so objects only seen in one view are voted down. Results
+        are returned in the same format as the scoring output (as 0 degree tiles), ready for
+        RemapBoundingBoxes.
+        """
+        # Group all boxes by the tile they came from, regardless of rotation
+        tiles = {}
+        for score in scores:
+            index, tileRow, tileCol, angle, x, y = ParseTileName(score["name"])
+            detections = tiles.setdefault((index, tileRow, tileCol, x, y), [])
+            for box in score["boxes"]:
+                detections.append((
+                    score["score"], 
+                    self.RotateBoxToTileSpace(tileWidth, tileHeight, angle, box), 
+                    angle,
+                    score.get("tag", "")
+                ))
+
+        results = []
+        for (index, tileRow, tileCol, x, y), detections in sorted(tiles.items(), key=lambda t: t[0][0:3]):
+            # Each cluster is [fusedBox, members], visiting the most confident boxes first
+            clusters = []
+            for detection in sorted(detections, key=lambda d: d[0], reverse=True):
+                best, bestIou = None, iouThreshold
+                for cluster in clusters:
+                    if cluster[1][0][3] != detection[3]:
+                        continue
+                    iou = self.IntersectionOverUnion(cluster[0], detection[1])
+                    if iou >= bestIou:
+                        best, bestIou = cluster, iou
+
+                if best is None:
+                    clusters.append([detection[1], [detection]])
+                else:
+                    best[1].append(detection)
+                    totalScore = sum(d[0] for d in best[1])
+                    best[0] = tuple(sum(d[0] * d[1][i] for d in best[1]) / totalScore for i in range(4))
+
+            for fusedBox, members in clusters:
+                views = len(set(d[2] for d in members))
+                confidence = (sum(d[0] for d in members) / len(members)) * min(views, viewCount) / viewCount
+
+                if confidence < scoreThreshold:
+                    logger.info(f"Dropping fused box {fusedBox} seen in {views} view(s) with score {confidence}")
+                    continue
+
+                results.append({
+                    "name": f"tile_{index}_{tileRow}_{tileCol}_0.png" if x is None else f"tile_{index}_{tileRow}_{tileCol}_0_{x}_{y}.png",
+                    "score": confidence,
+                    "tag": members[0][3],
+                    "tileRow": tileRow,
+                    "tileColumn": tileCol,
+                    "angle": 0,
+                    "views": views,
+                    "boxes": [
+                        fusedBox
+                    ]
+                })
+
+        logger.info(f"Fused {sum(len(d) for d in tiles.values())} boxes from {len(tiles)} tiles into {len(results)} boxes")
         return results
+
+    def IntersectionOverUnion(self, boxA, boxB):
+        """
+        Computes the intersection-over-union of two (x1, y1, x2, y2) boxes.
+        """
+        width = min(boxA[2], boxB[2]) - max(boxA[0], boxB[0])
+        height = min(boxA[3], boxB[3]) - max(boxA[1], boxB[1])
+        if width <= 0 or height <= 0:
+            return 0.0
+
+        intersection = width * height
+        areaA = (boxA[2] - boxA[0]) * (boxA[3] - boxA[1])
+        areaB = (boxB[2] - boxB[0]) * (boxB[3] - boxB[1])
+        return intersection / (areaA + areaB - intersection)
+
+    def RotateBoxToTileSpace(self, tile_width, tile_height, angle, box):
+        """
+        Maps a box found on a rotated tile back to the coordinates of the original (0 degree) tile. Tiles are
+        rotated counter-clockwise (see DefaultImageTiler), so this applies the inverse rotation. Note that the
+        tile width/height given here are those of the original tile, not the rotated one.
+        """
+        x1, y1, x2, y2 = box
+
+        if angle == 0:
+            return x1, y1, x2, y2
+        elif angle == 90:
+            # (x, y) in the original tile was moved to (y, width - x)
+            points = [(tile_width - y1, x1), (tile_width - y2, x2)]
+        elif angle == 180:
+            # (x, y) in the original tile was moved to (width - x, height - y)
+            points = [(tile_width - x1, tile_height - y1), (tile_width - x2, tile_height - y2)]
+        elif angle == 270:
+            # (x, y) in the original tile was moved to (height - y, x)
+            points = [(y1, tile_height - x1), (y2, tile_height - x2)]
+        else:
+            msg = f"Specified rotation angle {angle} is not supported (must be one of 0, 90, 180, 270)";
+            logger.error(msg)
+            raise Exception(msg)
+
+        xs = [p[0] for p in points]
+        ys = [p[1] for p in points]
+        return min(xs), min(ys), max(xs), max(ys)
     
     def TranslateR4toR2(self, tile_width, tile_height, tile_col, tile_row, r4_x, r4_y):
         """
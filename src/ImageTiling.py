@@ -1,18 +1,128 @@
-import os, glob, logging
+import os, io, glob, logging, collections, itertools, multiprocessing, time
+import numpy as np
 from PIL import Image, ImageFilter
+from RasterReader import OpenRasterReader
+from Instrumentation import recorder
 
 logger = logging.getLogger("ImageTiling")
 
+# A single encoded tile, as handed from the tiler to the scoring engine. The name follows the same
+# tile_{index}_{row}_{col}_{angle}[_{x}_{y}].png convention used for tiles written to disk.
+Tile = collections.namedtuple("Tile", ["name", "index", "row", "col", "angle", "data"])
+
+def ParseTileName(tileName):
+    """
+    Parses a tile file name (or path) back into its (index, row, col, angle, x, y) components. The pixel
+    origin (x, y) of the tile within the source image is only encoded for tiles that are not laid out on a
+    simple grid (see SlidingWindowImageTiler), and is None otherwise.
+    """
+    parts = os.path.basename(tileName).split('.')[0].split('_')
+    index, tileRow, tileCol, angle = [int(p) for p in parts[1:5]]
+    if len(parts) == 7:
+        return index, tileRow, tileCol, angle, int(parts[5]), int(parts[6])
+    return index, tileRow, tileCol, angle, None, None
+
+def ReadTileFiles(tilePaths):
+    """
+    Lazily reads tile images previously written to disk, yielding Tile records. Used when scoring
+    from the temporary file location instead of streaming tiles directly from the tiler.
+    """
+    for tilePath in tilePaths:
+        index, tileRow, tileCol, angle, _, _ = ParseTileName(tilePath)
+        with open(tilePath, mode="rb") as tileFile:
+            data = tileFile.read()
+        yield Tile(os.path.basename(tilePath), index, tileRow, tileCol, angle, data)
+
+def EncodeTileImage(image):
+    """
+    Encodes a tile image as (uncompressed) PNG, the same way tiles are written to disk.
+    """
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", compress_level=0)
+    return buffer.getvalue()
+
+def GetTileViews(cropped, generatePermutations):
+    """
+    Yields the (angle, image) views of a cropped tile: the tile itself, followed by its 3 rotations if
+    permutations are required (yielding 4 samples per tile).
+    """
+    yield 0, cropped
+    if generatePermutations:
+        for angle in (90, 180, 270):
+            with recorder.Span("rotate", angle=angle):
+                rotated = cropped.rotate(angle, expand=(angle != 180))
+            yield angle, rotated
+
+# Source image reader of a parallel tiling worker process (see InitTileWorker), and the time it took to decode
+# the source image, until reported back to the parent process
+workerSourceReader = None
+workerDecodeSec = None
+
+def InitTileWorker(sourceImagePath):
+    """
+    Process pool initializer for parallel tiling. Each worker opens (and if needed, decodes) the source image
+    once, rather than having it pickled along with every task. Workers forked from a process that already
+    decoded the same image share its pixel data instead (copy-on-write), where the reader allows it.
+    """
+    global workerSourceReader, workerDecodeSec
+    workerDecodeSec = None
+    if workerSourceReader is None or workerSourceReader.path != sourceImagePath or not workerSourceReader.FORK_SAFE:
+        start = time.perf_counter()
+        workerSourceReader = OpenRasterReader(sourceImagePath)
+        workerSourceReader.Load()
+        workerDecodeSec = time.perf_counter() - start
+
+def CropTileRow(positions, tileWidth, tileHeight, generatePermutations, tileFilter):
+    """
+    Parallel tiling task: crops one row of tiles, given as (k, row, col, x, y) positions, from the worker's source
+    image. Returns (k, row, col, x, y, check, views) per position, where views are the (angle, PNG data) of each
+    encoded view, and check is the (statistics, hash) for the tile filter (or None without a filter). Tiles below
+    the filter's thresholds are not encoded; the final (order dependent) filter decision is left to the caller.
+    The (cropSec, encodeSec) time spent on each tile is returned as well, since spans recorded in a worker
+    process would be lost, along with the time the worker took to decode the source image (the first time
+    only, otherwise None), as (decodeSec, results).
+    """
+    global workerDecodeSec
+    decodeSec, workerDecodeSec = workerDecodeSec, None
+    results = []
+    for k, tileRow, tileCol, j, i in positions:
+        start = time.perf_counter()
+        cropped = workerSourceReader.Crop((j, i, j + tileWidth, i + tileHeight))
+        cropped.load()
+        cropSec = time.perf_counter() - start
+
+        check = None
+        if tileFilter is not None:
+            check = (tileFilter.GetStatistics(cropped), tileFilter.GetPerceptualHash(cropped))
+            if tileFilter.GetSkipReason(check[0]) is not None:
+                results.append((k, tileRow, tileCol, j, i, check, [], (cropSec, 0.0)))
+                continue
+
+        start = time.perf_counter()
+        views = [(angle, EncodeTileImage(image)) for angle, image in GetTileViews(cropped, generatePermutations)]
+        results.append((k, tileRow, tileCol, j, i, check, views, (cropSec, time.perf_counter() - start)))
+    return decodeSec, results
+
 class DefaultImageTiler:
     """
-    Basic image tiling support. Breaks down the source image into a number of tiles each of which 
+    Basic image tiling support. Breaks down the source image into a number of tiles each of which
     has a defined size. Tiles MUST evenly divide the width and height of the source image.
+
+    With more than one worker, tiles are cropped, rotated and encoded in a pool of worker processes, one row of
+    tiles per task. Tiles are still produced in the same order, with the same contents, as the serial path.
     """
 
-    def __init__(self, settings, tileHeight, tileWidth):
+    def __init__(self, settings, tileHeight, tileWidth, tileFilter=None, workerCount=1):
         self.tempFilePath = settings.tempFilePath
         self.tileHeight = tileHeight
         self.tileWidth = tileWidth
+        self.tileFilter = tileFilter
+        self.workerCount = workerCount
+
+        if (workerCount < 1):
+            msg = f"Specified tiling worker count {workerCount} must be at least one.";
+            logger.error(msg)
+            raise Exception(msg)
 
     def __writeImageFile(self, image, writePath):
         try:
@@ -21,21 +131,159 @@ class DefaultImageTiler:
         except:
             logger.error(f"Error while writing {writePath}")
             pass
-    
+
+    def __writeTileFile(self, data, writePath):
+        try:
+            logger.info(f"Writing tile: {writePath}")
+            with open(writePath, mode="wb") as tileFile:
+                tileFile.write(data)
+        except:
+            logger.error(f"Error while writing {writePath}")
+            pass
+
     def __validateTileSize(self, sourceHeight, sourceWidth):
         if (sourceHeight % self.tileHeight != 0):
             msg = f"Specified tile height {self.tileHeight} does not evenly divide source image {sourceHeight}.";
             logger.error(msg)
             raise Exception(msg)
-        
+
         if (sourceWidth % self.tileWidth != 0):
             msg = f"Specified tile width {self.tileWidth} does not evenly divide source image {sourceWidth}.";
             logger.error(msg)
             raise Exception(msg)
-    
+
+    def __getNumberedLayout(self, sourceWidth, sourceHeight, regions):
+        # Tiles are numbered across the whole layout, so a tile has the same name whether or not regions are given
+        layout = [(k, tileRow, tileCol, j, i) for k, (tileRow, tileCol, j, i) in enumerate(self.GetTileLayout(sourceWidth, sourceHeight), 1)]
+        if regions is None:
+            return layout
+
+        # Only keep the tiles overlapping any of the (x1, y1, x2, y2) regions
+        regions = np.asarray(regions, dtype=np.float64).reshape(-1, 4)
+        origins = np.array([(j, i) for _, _, _, j, i in layout], dtype=np.float64).reshape(-1, 2)
+        overlaps = (
+            (regions[np.newaxis, :, 0] < origins[:, 0:1] + self.tileWidth) & (regions[np.newaxis, :, 2] > origins[:, 0:1]) &
+            (regions[np.newaxis, :, 1] < origins[:, 1:2] + self.tileHeight) & (regions[np.newaxis, :, 3] > origins[:, 1:2])
+        ).any(axis=1)
+        selected = [position for position, overlap in zip(layout, overlaps) if overlap]
+        logger.info(f"Selected {len(selected)} of {len(layout)} tiles overlapping {len(regions)} regions")
+        return selected
+
+    def __iterateTileImages(self, sourceImagePath, generatePermutations, regions):
+        with recorder.Span("decode", source=os.path.basename(sourceImagePath)):
+            reader = OpenRasterReader(sourceImagePath)
+            reader.Load()
+        imgwidth, imgheight = reader.size
+        logger.info(f"Source image info: width={imgwidth}, height={imgheight}, mode={reader.mode}")
+        if self.tileFilter is not None:
+            self.tileFilter.Reset()
+
+        # Create tiles
+        for k, tileRow, tileCol, j, i in self.__getNumberedLayout(imgwidth, imgheight, regions):
+            box = (j, i, j + self.tileWidth, i + self.tileHeight)
+
+            # Crop image, change colorspace, etc.
+            with recorder.Span("crop", source=os.path.basename(sourceImagePath), tile=k, row=tileRow, col=tileCol):
+                cropped = reader.Crop(box)
+
+            # Few other options we could test: B&W and Edge enhanced
+            # cropped = cropped.convert(mode="L") # B&w...does it help?
+            # cropped = cropped.filter(ImageFilter.EDGE_ENHANCE) # Edge enhance
+
+            # Skip uninformative tiles (and their permutations) before they are encoded or scored
+            if self.tileFilter is not None and not self.tileFilter.IsInformative(cropped):
+                continue
+
+            # Generate permutations if required (3 per original image, yielding 4 samples per tile)
+            for angle, image in GetTileViews(cropped, generatePermutations):
+                yield self.GetTileName(k, tileRow, tileCol, angle, j, i), k, tileRow, tileCol, angle, image
+
+        reader.Close()
+        if self.tileFilter is not None:
+            logger.info(f"Skipped {self.tileFilter.skipped} of {self.tileFilter.checked} tiles as uninformative")
+
+    def __iterateEncodedTiles(self, sourceImagePath, generatePermutations, regions):
+        source = os.path.basename(sourceImagePath)
+        reader = OpenRasterReader(sourceImagePath)
+        imgwidth, imgheight = reader.size
+        logger.info(f"Source image info: width={imgwidth}, height={imgheight}, mode={reader.mode}")
+        reader.Close()
+
+        # Group the tile positions by row, numbering them the same way as the serial path
+        layout = self.__getNumberedLayout(imgwidth, imgheight, regions)
+        rows = iter([list(positions) for _, positions in itertools.groupby(layout, key=lambda p: p[1])])
+        logger.info(f"Tiling {len(layout)} tiles with {self.workerCount} worker processes...")
+        if self.tileFilter is not None:
+            self.tileFilter.Reset()
+
+        # Forked workers share the pixel data decoded here, instead of each decoding the source image again
+        global workerSourceReader
+        if multiprocessing.get_start_method() == "fork":
+            with recorder.Span("decode", source=source):
+                InitTileWorker(sourceImagePath)
+
+        try:
+            with multiprocessing.Pool(self.workerCount, InitTileWorker, (sourceImagePath,)) as pool:
+                # Keep a bounded number of rows in flight, so encoded tiles don't pile up in memory when the
+                # consumer (e.g. the scoring work queue) is slower than tiling
+                pending = collections.deque()
+                for positions in itertools.islice(rows, 2 * self.workerCount):
+                    pending.append(pool.apply_async(CropTileRow, (positions, self.tileWidth, self.tileHeight, generatePermutations, self.tileFilter)))
+
+                while pending:
+                    decodeSec, results = pending.popleft().get()
+                    if decodeSec is not None:
+                        recorder.Record("decode", decodeSec, source=source, worker=True)
+                    positions = next(rows, None)
+                    if positions is not None:
+                        pending.append(pool.apply_async(CropTileRow, (positions, self.tileWidth, self.tileHeight, generatePermutations, self.tileFilter)))
+
+                    for k, tileRow, tileCol, j, i, check, views, (cropSec, encodeSec) in results:
+                        recorder.Record("crop", cropSec, source=source, tile=k, row=tileRow, col=tileCol, worker=True)
+                        if views:
+                            recorder.Record("encode", encodeSec, source=source, tile=k, row=tileRow, col=tileCol, worker=True)
+
+                        # Skip uninformative tiles (and their permutations), in tile order
+                        if check is not None and not self.tileFilter.Check(*check):
+                            continue
+
+                        for angle, data in views:
+                            yield self.GetTileName(k, tileRow, tileCol, angle, j, i), k, tileRow, tileCol, angle, data
+        finally:
+            if workerSourceReader is not None:
+                workerSourceReader.Close()
+            workerSourceReader = None
+
+        if self.tileFilter is not None:
+            logger.info(f"Skipped {self.tileFilter.skipped} of {self.tileFilter.checked} tiles as uninformative")
+
+    def GetTileLayout(self, sourceWidth, sourceHeight):
+        """
+        Returns the (row, col, x, y) position of each tile for a source image of the given size, in the order
+        tiles are created. Tiles are laid out on a simple grid.
+        """
+
+        # Validate that stil size evenly divides source image
+        self.__validateTileSize(sourceHeight, sourceWidth)
+
+        layout = []
+        for tileRow, i in enumerate(range(0, sourceHeight, self.tileHeight)):
+            for tileCol, j in enumerate(range(0, sourceWidth, self.tileWidth)):
+                layout.append((tileRow, tileCol, j, i))
+        return layout
+
+    def GetTileName(self, index, tileRow, tileCol, angle, x, y):
+        """
+        Returns the name of a tile - note we're encoding tiling infomration into the filenames. Grid tiles
+        don't need their pixel origin encoded, since it follows from the row and column.
+        """
+        return f"tile_{index}_{tileRow}_{tileCol}_{angle}.png"
+
     def Cleanup(self):
         """
-        Cleans up temporary tile images that were created.
+        Cleans up temporary tile images that were created in the temporary file location. Note this removes every
+        tile there, including those of any other run; runs writing to a RunWorkspace (see Workspace) remove it
+        instead.
         """
         logger.info("Removing tiles...")
         filesToRemove = glob.glob(os.path.join(self.tempFilePath, "*.png"))
@@ -43,55 +291,101 @@ class DefaultImageTiler:
         for f in filesToRemove:
             os.remove(f)
 
-    def CreateTiles(self, sourceImagePath, generatePermutations):
+    def CreateTiles(self, sourceImagePath, generatePermutations, workspace=None):
         """
         Breaks a source image into smaller tiles, defined by the h/w passed in by caller. Tiles are written to an
-        intermediate location on disk storage, and used later by other modules.
+        intermediate location on disk storage, and used later by other modules: the given RunWorkspace (which
+        lists them in its manifest), or else the temporary file location.
         """
+        if workspace is not None:
+            for tile in self.GenerateTiles(sourceImagePath, generatePermutations):
+                logger.info(f"Writing tile: {tile.name}")
+                workspace.WriteTile(sourceImagePath, tile.name, tile.data)
+            return
 
-        k = 1
-        tileRow = 0
-        tileCol = 0
-        im = Image.open(sourceImagePath)
-        imgwidth, imgheight = im.size
-        logger.info(f"Source image info: width={imgwidth}, height={imgheight}, mode={im.mode}")
+        if self.workerCount > 1:
+            for name, k, tileRow, tileCol, angle, data in self.__iterateEncodedTiles(sourceImagePath, generatePermutations, None):
+                self.__writeTileFile(data, os.path.join(self.tempFilePath, name))
+            return
 
-        # Validate that stil size evenly divides source image
-        self.__validateTileSize(imgheight, imgwidth)
+        for name, k, tileRow, tileCol, angle, image in self.__iterateTileImages(sourceImagePath, generatePermutations, None):
+            # Write tile images
+            writePath = os.path.join(self.tempFilePath, name)
+            with recorder.Span("encode", tile=name):
+                self.__writeImageFile(image, writePath)
 
-        # Create tiles
-        for i in range(0, imgheight, self.tileHeight):
-            for j in range(0, imgwidth, self.tileWidth):
-                box = (j, i, j + self.tileWidth, i + self.tileHeight)
-                
-                # Crop image, change colorspace, etc.
-                cropped = im.crop(box)
-
-                # Few other options we could test: B&W and Edge enhanced
-                # cropped = cropped.convert(mode="L") # B&w...does it help?
-                # cropped = cropped.filter(ImageFilter.EDGE_ENHANCE) # Edge enhance
-
-                # Write tile images - note we're encoding tiling infomration into the filenames
-                writePath = os.path.join(self.tempFilePath, f"tile_{k}_{tileRow}_{tileCol}_0.png")
-                self.__writeImageFile(cropped, writePath)            
-
-                # Generate permutations if required (3 per original image, yielding 4 samples per tile)
-                if generatePermutations:
-                    cropped_r90 = cropped.rotate(90, expand=True)
-                    cropped_r180 = cropped.rotate(180)
-                    cropped_r270 = cropped.rotate(270, expand=True)
-
-                    writePath = os.path.join(self.tempFilePath, f"tile_{k}_{tileRow}_{tileCol}_90.png")
-                    self.__writeImageFile(cropped_r90, writePath)
-                    writePath = os.path.join(self.tempFilePath, f"tile_{k}_{tileRow}_{tileCol}_180.png")
-                    self.__writeImageFile(cropped_r180, writePath)
-                    writePath = os.path.join(self.tempFilePath, f"tile_{k}_{tileRow}_{tileCol}_270.png")
-                    self.__writeImageFile(cropped_r270, writePath)
-                
-                # Increment counters
-                k +=1
-                tileCol += 1
-            
-            tileCol = 0
-            tileRow += 1
-    
\ No newline at end of file
+    def GenerateTiles(self, sourceImagePath, generatePermutations, regions=None):
+        """
+        Same tiling as CreateTiles, but nothing is written to disk: each tile is encoded in memory and
+        yielded as a Tile record as soon as it is cropped, so it can be streamed straight into scoring.
+        If regions (an array of (x1, y1, x2, y2) boxes in source image pixels) are given, only the tiles
+        overlapping them are produced, named the same as when tiling the whole image.
+        """
+        if self.workerCount > 1:
+            for name, k, tileRow, tileCol, angle, data in self.__iterateEncodedTiles(sourceImagePath, generatePermutations, regions):
+                yield Tile(name, k, tileRow, tileCol, angle, data)
+            return
+
+        for name, k, tileRow, tileCol, angle, image in self.__iterateTileImages(sourceImagePath, generatePermutations, regions):
+            with recorder.Span("encode", tile=name):
+                data = EncodeTileImage(image)
+            yield Tile(name, k, tileRow, tileCol, angle, data)
+
+class SlidingWindowImageTiler(DefaultImageTiler):
+    """
+    Overlapping sliding-window tiling. Consecutive tiles overlap by a configurable number of pixels, so objects
+    crossing a tile seam are fully contained in at least one tile (the resulting duplicates are merged after
+    re-mapping). Any source image size is supported; the edge mode controls the last tile in each row/column:
+
+    * "shift": the last tile is shifted back so it ends exactly at the image edge (overlapping its neighbour more).
+    * "pad": the last tile extends past the image edge, and the area outside the image is filled with black.
+
+    Since tiles are no longer on a simple grid, each tile name also encodes its pixel origin in the source image.
+    """
+    EDGE_MODES = ("shift", "pad")
+
+    def __init__(self, settings, tileHeight, tileWidth, overlap=0, edgeMode="shift", tileFilter=None, workerCount=1):
+        super().__init__(settings, tileHeight, tileWidth, tileFilter, workerCount)
+        self.overlap = overlap
+        self.edgeMode = edgeMode
+
+        if (overlap < 0 or overlap >= min(tileHeight, tileWidth)):
+            msg = f"Specified tile overlap {overlap} must be at least zero and less than the tile size.";
+            logger.error(msg)
+            raise Exception(msg)
+
+        if (edgeMode not in self.EDGE_MODES):
+            msg = f"Specified edge mode {edgeMode} is not supported (must be one of {', '.join(self.EDGE_MODES)}).";
+            logger.error(msg)
+            raise Exception(msg)
+
+    def __getTileOrigins(self, sourceSize, tileSize):
+        stride = tileSize - self.overlap
+
+        if self.edgeMode == "shift" and sourceSize >= tileSize:
+            origins = list(range(0, sourceSize - tileSize + 1, stride))
+            if origins[-1] + tileSize < sourceSize:
+                origins.append(sourceSize - tileSize)
+            return origins
+
+        # Padding (also used when the source is smaller than a single tile)
+        origins = [0]
+        while origins[-1] + tileSize < sourceSize:
+            origins.append(origins[-1] + stride)
+        return origins
+
+    def GetTileLayout(self, sourceWidth, sourceHeight):
+        """
+        Returns the (row, col, x, y) position of each overlapping tile for a source image of the given size.
+        """
+        layout = []
+        for tileRow, i in enumerate(self.__getTileOrigins(sourceHeight, self.tileHeight)):
+            for tileCol, j in enumerate(self.__getTileOrigins(sourceWidth, self.tileWidth)):
+                layout.append((tileRow, tileCol, j, i))
+        return layout
+
+    def GetTileName(self, index, tileRow, tileCol, angle, x, y):
+        """
+        Returns the name of a tile, including its pixel origin.
+        """
+        return f"tile_{index}_{tileRow}_{tileCol}_{angle}_{x}_{y}.png"
@@ -0,0 +1,220 @@
+import collections
+import heapq
+import itertools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import numpy as np
+
+logger = logging.getLogger("Instrumentation")
+
+class Span:
+    """
+    Times a single pipeline stage (used as a context manager), recording it when the block exits.
+    """
+    __slots__ = ("recorder", "stage", "attributes", "start")
+
+    def __init__(self, recorder, stage, attributes):
+        self.recorder = recorder
+        self.stage = stage
+        self.attributes = attributes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.recorder.Record(self.stage, time.perf_counter() - self.start, **self.attributes)
+
+class NullSpan:
+    """
+    Stand-in for Span while recording is disabled, so instrumented code costs next to nothing.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+NULL_SPAN = NullSpan()
+
+class StageStatistics:
+    """
+    Running statistics of the spans of one stage: the count, total and maximum of all of them, the durations
+    of the most recent ones (for quantiles) and the slowest ones along with their attributes.
+    """
+    __slots__ = ("count", "totalSec", "maxSec", "durations", "slowest")
+
+    def __init__(self, samplesKept):
+        self.count = 0
+        self.totalSec = 0.0
+        self.maxSec = 0.0
+        self.durations = collections.deque(maxlen=samplesKept)
+        self.slowest = []
+
+    def Add(self, duration, order, attributes, slowestKept):
+        self.count += 1
+        self.totalSec += duration
+        self.maxSec = max(self.maxSec, duration)
+        self.durations.append(duration)
+
+        # A min-heap of the slowest spans, the order breaking ties so attributes are never compared
+        if len(self.slowest) < slowestKept:
+            heapq.heappush(self.slowest, (duration, order, attributes))
+        elif duration > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (duration, order, attributes))
+
+class SpanRecorder:
+    """
+    Records how long each stage of the pipeline takes (decode, crop, encode, queue wait, request, parse,
+    remap, NMS, draw, ...), as spans with per-tile attributes (e.g. the tile name), along with counters such as
+    the number of bytes uploaded. Spans can be recorded from any thread. Recording is disabled until Enable is
+    called. Spans are folded into per-stage statistics as they are recorded (see StageStatistics), so memory
+    stays bounded however long the process runs (e.g. '--serve'): quantiles are computed over the most recent
+    SPAN_SAMPLES_KEPT spans of each stage, while counts, totals and maximums cover all of them.
+    """
+    METRIC_PREFIX = "cvscoring"
+    QUANTILES = (0.5, 0.9, 0.99)
+    SLOWEST_SPANS = 10
+    SPAN_SAMPLES_KEPT = 10000
+
+    def __init__(self):
+        self.enabled = False
+        self.stages = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        self.__order = itertools.count()
+        self.__lock = threading.Lock()
+
+    def Enable(self):
+        self.enabled = True
+
+    def Span(self, stage, **attributes):
+        """
+        Returns a context manager timing the given stage.
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, stage, attributes)
+
+    def Record(self, stage, duration, **attributes):
+        """
+        Records a span measured elsewhere (e.g. in a worker process, or from HTTP client timings).
+        """
+        if self.enabled:
+            with self.__lock:
+                if stage not in self.stages:
+                    self.stages[stage] = StageStatistics(self.SPAN_SAMPLES_KEPT)
+                self.stages[stage].Add(duration, next(self.__order), attributes, self.SLOWEST_SPANS)
+
+    def Increment(self, counter, value=1):
+        if self.enabled:
+            with self.__lock:
+                self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def GetSummary(self):
+        """
+        Returns the per-stage statistics (count, total, mean, quantiles of the recent spans and the slowest
+        spans, with their attributes) and counters of the run.
+        """
+        summary = collections.OrderedDict()
+        with self.__lock:
+            for stage, stats in self.stages.items():
+                durations = np.array(stats.durations)
+                slowest = sorted(stats.slowest, key=lambda e: e[0], reverse=True)
+                summary[stage] = {
+                    "count": stats.count,
+                    "totalSec": stats.totalSec,
+                    "meanSec": stats.totalSec / stats.count,
+                    "quantilesSec": { str(q): float(np.quantile(durations, q)) for q in self.QUANTILES },
+                    "maxSec": stats.maxSec,
+                    "slowest": [dict(attributes, durationSec=duration) for duration, _, attributes in slowest]
+                }
+            counters = dict(self.counters)
+
+        return { "stages": summary, "counters": counters }
+
+    def WriteSummary(self, path):
+        """
+        Writes the run summary (see GetSummary) as JSON.
+        """
+        summary = self.GetSummary()
+        with open(path, "w") as f:
+            json.dump(summary, f, indent=2, default=str)
+
+        for stage, stats in summary["stages"].items():
+            logger.info(f"{stage}: {stats['count']} spans, {stats['totalSec']:.3f} sec total, {stats['meanSec'] * 1000:.2f} ms mean")
+        logger.info(f"Wrote run summary to {path}")
+
+    def WritePrometheusMetrics(self, path):
+        """
+        Writes the stage timings (as summaries) and counters in the Prometheus text exposition format, e.g.
+        for the node exporter's textfile collector.
+        """
+        summary = self.GetSummary()
+        name = f"{self.METRIC_PREFIX}_stage_seconds"
+        lines = [
+            f"# HELP {name} Time spent in each stage of the tiling and scoring pipeline.",
+            f"# TYPE {name} summary"
+        ]
+        for stage, stats in summary["stages"].items():
+            for q, value in stats["quantilesSec"].items():
+                lines.append(f'{name}{{stage="{stage}",quantile="{q}"}} {value}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {stats["totalSec"]}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {stats["count"]}')
+
+        for counter, value in summary["counters"].items():
+            lines.append(f"# TYPE {self.METRIC_PREFIX}_{counter}_total counter")
+            lines.append(f"{self.METRIC_PREFIX}_{counter}_total {value}")
+
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        logger.info(f"Wrote Prometheus metrics to {path}")
+
+# Spans for the whole process are recorded here (in the same way each module logs to its own logger)
+recorder = SpanRecorder()
+
+class SamplingProfiler:
+    """
+    Low overhead sampling profiler: a background thread periodically captures the stack of every thread
+    (including the IOLoop and executor threads, which cProfile only sees one of), and the samples are written
+    as collapsed stacks, the input format of flame graph tools.
+    """
+
+    def __init__(self, intervalSec=0.005):
+        self.intervalSec = intervalSec
+        self.samples = collections.Counter()
+        self.__stopped = threading.Event()
+        self.__thread = None
+
+    def __sample(self):
+        ownId = threading.get_ident()
+        while not self.__stopped.wait(self.intervalSec):
+            for threadId, frame in sys._current_frames().items():
+                if threadId == ownId:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_firstlineno})")
+                    frame = frame.f_back
+                self.samples[";".join(reversed(stack))] += 1
+
+    def Start(self):
+        self.__stopped.clear()
+        self.__thread = threading.Thread(target=self.__sample, name="SamplingProfiler", daemon=True)
+        self.__thread.start()
+
+    def Stop(self):
+        self.__stopped.set()
+        self.__thread.join()
+
+    def Write(self, path):
+        """
+        Writes the samples as collapsed stacks ("frame;frame;frame count" per line).
+        """
+        with open(path, "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        logger.info(f"Wrote {sum(self.samples.values())} profile samples to {path}")
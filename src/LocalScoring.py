@@ -0,0 +1,304 @@
+import io
+import os
+import time
+import collections
+import logging
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from tornado import gen, ioloop
+
+from ModelScoring import ScoringBackend
+from Instrumentation import recorder
+
+# Running exported ONNX models is optional (it requires onnxruntime); without it, only the REST and reference
+# backends are available.
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+LOCAL_BACKENDS = ("onnx", "reference")
+
+# One batch is decoded while the previous one runs through the model
+BATCHES_IN_FLIGHT = 2
+
+logger = logging.getLogger("LocalScoring")
+
+def ResizeBatch(pixels, width, height):
+    """
+    Resizes a batch of images, given as an (N, h, w, bands) array, to an (N, height, width, bands) float32 array
+    using bilinear interpolation, with the same sample positions for every image of the batch.
+    """
+    count, sourceHeight, sourceWidth = pixels.shape[0:3]
+    if (sourceWidth, sourceHeight) == (width, height):
+        return pixels.astype(np.float32)
+
+    def samplePositions(sourceSize, size):
+        # Pixel centres of the output, in input pixels
+        positions = np.clip((np.arange(size) + 0.5) * sourceSize / size - 0.5, 0, sourceSize - 1)
+        lower = np.floor(positions).astype(np.intp)
+        upper = np.minimum(lower + 1, sourceSize - 1)
+        return lower, upper, (positions - lower).astype(np.float32)
+
+    top, bottom, yWeights = samplePositions(sourceHeight, height)
+    left, right, xWeights = samplePositions(sourceWidth, width)
+
+    yWeights = yWeights[np.newaxis, :, np.newaxis, np.newaxis]
+    rows = pixels[:, top].astype(np.float32) * (1 - yWeights) + pixels[:, bottom].astype(np.float32) * yWeights
+    xWeights = xWeights[np.newaxis, np.newaxis, :, np.newaxis]
+    return rows[:, :, left] * (1 - xWeights) + rows[:, :, right] * xWeights
+
+def ToPredictionResults(boxes, scores, classes, tagNames):
+    """
+    Converts the detections of a batch of images, as (N, K, 4) boxes (left, top, right, bottom, relative to the
+    image size), (N, K) scores (0-1) and (N, K) class indices, into one prediction results dict per image, in
+    the format returned by the Custom Vision prediction API. Zero scores (padding) are left out.
+    """
+    boxes = np.clip(boxes, 0.0, 1.0)
+    results = []
+    for imageBoxes, imageScores, imageClasses in zip(boxes.tolist(), scores.tolist(), classes.tolist()):
+        predictions = []
+        for (left, top, right, bottom), score, tagIndex in zip(imageBoxes, imageScores, imageClasses):
+            if score <= 0:
+                continue
+            tagIndex = int(tagIndex)
+            predictions.append({
+                "probability": score,
+                "tagName": tagNames[tagIndex] if tagIndex < len(tagNames) else str(tagIndex),
+                "boundingBox": { "left": left, "top": top, "width": right - left, "height": bottom - top }
+            })
+        results.append({ "predictions": predictions })
+    return results
+
+class OnnxDetectionModel:
+    """
+    An object detection model exported from Custom Vision in ONNX format, run on the CPU with onnxruntime. The
+    exported models take a (batch, 3, height, width) float tensor of BGR pixel values (0-255), and return the
+    detected_boxes, detected_scores and detected_classes of each image. Tag names are read from the labels.txt
+    file exported along with the model, when present. Models exported with a fixed batch size are run in chunks
+    of that size.
+    """
+    OUTPUT_NAMES = ["detected_boxes", "detected_scores", "detected_classes"]
+
+    def __init__(self, modelPath):
+        if onnxruntime is None:
+            msg = "The onnx scoring backend was requested, but onnxruntime is not installed"
+            logger.error(msg)
+            raise Exception(msg)
+        if modelPath is None or not os.path.isfile(modelPath):
+            msg = f"Specified model {modelPath} does not exist"
+            logger.error(msg)
+            raise Exception(msg)
+
+        self.session = onnxruntime.InferenceSession(modelPath, providers=["CPUExecutionProvider"])
+        modelInput = self.session.get_inputs()[0]
+        batchSize, _, height, width = modelInput.shape
+        self.inputName = modelInput.name
+        self.inputSize = (width, height)
+        self.batchSize = batchSize if isinstance(batchSize, int) else None
+
+        self.tagNames = []
+        labelsPath = os.path.join(os.path.dirname(modelPath), "labels.txt")
+        if os.path.exists(labelsPath):
+            with open(labelsPath, "r") as labels:
+                self.tagNames = [line.strip() for line in labels if line.strip()]
+
+        logger.info(f"Loaded model {modelPath} with {width}x{height} input, batch size {self.batchSize or 'dynamic'} and {len(self.tagNames)} tags")
+
+    def Predict(self, pixels):
+        """
+        Runs a batch of images, given as an (N, height, width, 3) float32 array of RGB pixels at the input size
+        of the model, returning one prediction results dict per image.
+        """
+        inputs = np.ascontiguousarray(pixels[:, :, :, ::-1].transpose(0, 3, 1, 2))
+        chunkSize = self.batchSize or len(inputs)
+
+        results = []
+        for start in range(0, len(inputs), chunkSize):
+            chunk = inputs[start:start + chunkSize]
+            count = len(chunk)
+            if count < chunkSize:
+                chunk = np.concatenate([chunk, np.zeros((chunkSize - count,) + chunk.shape[1:], dtype=chunk.dtype)])
+
+            boxes, scores, classes = self.session.run(self.OUTPUT_NAMES, { self.inputName: chunk })
+            results.extend(ToPredictionResults(
+                np.reshape(boxes, (chunkSize, -1, 4))[0:count],
+                np.reshape(scores, (chunkSize, -1))[0:count],
+                np.reshape(classes, (chunkSize, -1))[0:count],
+                self.tagNames
+            ))
+        return results
+
+class ReferenceDetectionModel:
+    """
+    A pure NumPy stand-in for an exported model, used by the tests and to try out local scoring without a model.
+    It "detects" the bright part of each image: the box around all pixels brighter than BRIGHTNESS_THRESHOLD,
+    scored by their mean brightness.
+    """
+    INPUT_SIZE = (320, 320)
+    BRIGHTNESS_THRESHOLD = 200
+    TAG_NAMES = ["bright"]
+
+    def __init__(self):
+        self.inputSize = self.INPUT_SIZE
+
+    def Predict(self, pixels):
+        count, height, width = pixels.shape[0:3]
+        brightness = pixels.mean(axis=3)
+        bright = brightness > self.BRIGHTNESS_THRESHOLD
+        rows = bright.any(axis=2)
+        cols = bright.any(axis=1)
+
+        # First and last bright row/column of each image
+        top = rows.argmax(axis=1)
+        bottom = height - rows[:, ::-1].argmax(axis=1)
+        left = cols.argmax(axis=1)
+        right = width - cols[:, ::-1].argmax(axis=1)
+        boxes = np.stack([left / width, top / height, right / width, bottom / height], axis=1)
+
+        brightPixels = bright.sum(axis=(1, 2))
+        scores = np.where(bright, brightness, 0).sum(axis=(1, 2)) / np.maximum(brightPixels, 1) / 255
+        return ToPredictionResults(boxes[:, np.newaxis], scores[:, np.newaxis], np.zeros((count, 1)), self.TAG_NAMES)
+
+def OpenDetectionModel(backend, modelPath):
+    """
+    Opens the model for a local scoring backend: 'onnx' (an exported model, see OnnxDetectionModel) or
+    'reference' (see ReferenceDetectionModel).
+    """
+    if backend == "onnx":
+        return OnnxDetectionModel(modelPath)
+    if backend == "reference":
+        return ReferenceDetectionModel()
+
+    msg = f"Specified scoring backend {backend} is not a local backend (must be one of {', '.join(LOCAL_BACKENDS)})"
+    logger.error(msg)
+    raise Exception(msg)
+
+class BatchedLocalScoring(ScoringBackend):
+    """
+    Scores tiles locally, on the CPU, instead of sending one request per tile to the prediction API: tiles are
+    grouped into batches of InferenceBatchSize, decoded and resized to the input size of the model as one array,
+    and run through the model together. Results are captured as the same score dicts as when scoring through the
+    API (and journaled the same way), so the rest of the pipeline doesn't change. For offline sites, and bulk
+    reprocessing where request round trips are the bottleneck.
+    """
+
+    def __init__(self, settings, tileWidth, tileHeight, journal=None):
+        super().__init__(settings, tileWidth, tileHeight, journal)
+        self.batchSize = settings.inferenceBatchSize
+        self.model = OpenDetectionModel(settings.scoringBackend, settings.modelPath)
+        self.scoredTiles = 0
+        self.batches = 0
+
+        # Decoding and inference run on background threads (created on first use), so the IOLoop stays free to
+        # pull tiles from the tiler
+        self.executor = None
+
+    def __predictBatch(self, tiles):
+        width, height = self.model.inputSize
+        with recorder.Span("preprocess", tiles=len(tiles)):
+            decoded = [np.asarray(Image.open(io.BytesIO(tile.data)).convert("RGB")) for tile in tiles]
+
+            # Rotated (90/270) tiles have their width and height swapped, so tiles are resized in groups of the
+            # same shape
+            groups = collections.defaultdict(list)
+            for i, pixels in enumerate(decoded):
+                groups[pixels.shape].append(i)
+            inputs = np.empty((len(tiles), height, width, 3), dtype=np.float32)
+            for indices in groups.values():
+                inputs[indices] = ResizeBatch(np.stack([decoded[i] for i in indices]), width, height)
+
+        with recorder.Span("inference", tiles=len(tiles)):
+            return self.model.Predict(inputs)
+
+    async def ScoreJobsAsync(self, jobs, onJobScored=None):
+        start = time.time()
+        io_loop = ioloop.IOLoop.current()
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(BATCHES_IN_FLIGHT)
+        completions = []
+        running = []
+        batch = []
+
+        def completeJob(job):
+            completion = self.CompleteJob(job, onJobScored)
+            if completion is not None:
+                completions.append(completion)
+
+        async def scoreBatch(batch):
+            try:
+                results = await io_loop.run_in_executor(self.executor, self.__predictBatch, [tile for _, tile in batch])
+            except Exception as e:
+                logger.error(f"Exception: {e} scoring a batch of {len(batch)} tiles")
+                results = [None] * len(batch)
+
+            self.batches += 1
+            recorder.Increment("batches")
+            for (job, tile), tileResults in zip(batch, results):
+                if tileResults is None:
+                    self.FailTile(job, tile)
+                else:
+                    # Journal the results as soon as they arrive, so they survive the run being interrupted
+                    if self.journal is not None:
+                        self.journal.Put(job.key, tile.name, tileResults)
+                    self.CaptureTile(job, tile, tileResults)
+                    self.scoredTiles += 1
+                    recorder.Increment("tiles_scored")
+                job.pending -= 1
+                if job.enqueued and job.pending == 0:
+                    completeJob(job)
+
+        async def submitBatch():
+            # At most BATCHES_IN_FLIGHT batches are decoded/run at once, which bounds the tiles held in memory
+            nonlocal batch
+            running.append(gen.convert_yielded(scoreBatch(batch)))
+            batch = []
+            if len(running) >= BATCHES_IN_FLIGHT:
+                await running.pop(0)
+
+        # Pull each tile from the source on a background thread (tiles may be cropped/encoded lazily). Batches
+        # span images, but the last partial batch of each image is sent once it is tiled, so a job never waits
+        # on the next one (e.g. a service waiting for submissions).
+        async for job in jobs:
+            tiles = iter(job.tiles)
+            while True:
+                tile = await self.PullTile(job, tiles)
+                if tile is None:
+                    break
+
+                # Tiles already scored by an interrupted run are taken from the journal
+                if self.journal is not None:
+                    results = self.journal.Get(job.key, tile.name)
+                    if results is not None:
+                        logger.info(f"Using journaled predictions for tile {tile.name}")
+                        self.resumedTiles += 1
+                        recorder.Increment("tiles_resumed")
+                        self.CaptureTile(job, tile, results)
+                        continue
+
+                job.pending += 1
+                batch.append((job, tile))
+                if len(batch) >= self.batchSize:
+                    await submitBatch()
+
+            if batch:
+                await submitBatch()
+            job.enqueued = True
+            if job.pending == 0:
+                completeJob(job)
+
+        # Wait for the last batches, and any post-processing still running
+        await gen.multi(running)
+        await gen.multi(completions)
+        logger.info(f"Done in {(time.time() - start)} seconds, scored {self.scoredTiles} tiles in {self.batches} batches ({self.resumedTiles} from the journal)...")
+        self.LogFailedTiles()
+
+    def Close(self):
+        """
+        Stops the background threads used for decoding and inference.
+        """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
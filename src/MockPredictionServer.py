@@ -0,0 +1,169 @@
+import argparse
+import hashlib
+import logging
+import random
+import json
+import math
+import time
+
+from tornado import gen, ioloop, web
+
+logger = logging.getLogger("MockPredictionServer")
+
+LATENCY_DISTRIBUTIONS = ("constant", "uniform", "exponential", "lognormal")
+
+class MockPredictionServer:
+    """
+    Local stand-in for the Custom Vision object detection prediction endpoint, used for load testing the
+    scoring engine without using any prediction quota. Request latency is drawn from a configurable
+    distribution, a configurable fraction of requests fail (HTTP 500) or are throttled (HTTP 429), and
+    successful requests return synthetic predictions. Predictions are derived from a hash of the uploaded
+    tile, so the same tile always gets the same predictions.
+    """
+
+    def __init__(self, latency="constant", latencyMeanSec=0.05, latencyStdevSec=0.0, errorRate=0.0,
+                 throttleRate=0.0, retryAfterSec=1, predictionsPerTile=2, predictionKey=None, seed=None):
+        if latency not in LATENCY_DISTRIBUTIONS:
+            msg = f"Specified latency distribution {latency} is not supported (must be one of {', '.join(LATENCY_DISTRIBUTIONS)})"
+            logger.error(msg)
+            raise Exception(msg)
+
+        self.latency = latency
+        self.latencyMeanSec = latencyMeanSec
+        self.latencyStdevSec = latencyStdevSec
+        self.errorRate = errorRate
+        self.throttleRate = throttleRate
+        self.retryAfterSec = retryAfterSec
+        self.predictionsPerTile = predictionsPerTile
+        self.predictionKey = predictionKey
+        self.random = random.Random(seed)
+
+        # Request statistics
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.bytesReceived = 0
+
+    def SampleLatency(self):
+        """
+        Draws a request latency (in seconds) from the configured distribution.
+        """
+        if self.latency == "constant":
+            return self.latencyMeanSec
+        elif self.latency == "uniform":
+            return max(0.0, self.random.uniform(self.latencyMeanSec - self.latencyStdevSec, self.latencyMeanSec + self.latencyStdevSec))
+        elif self.latency == "exponential":
+            return self.random.expovariate(1.0 / self.latencyMeanSec) if self.latencyMeanSec > 0 else 0.0
+
+        # Log-normal, parameterized by the mean and standard deviation of the latency itself
+        if self.latencyMeanSec <= 0:
+            return 0.0
+        variance = math.log(1 + (self.latencyStdevSec ** 2) / (self.latencyMeanSec ** 2))
+        return self.random.lognormvariate(math.log(self.latencyMeanSec) - (variance / 2), math.sqrt(variance))
+
+    def CreatePredictions(self, projectId, iterationName, data):
+        """
+        Creates a synthetic prediction response for the given tile data.
+        """
+        digest = hashlib.sha256(data).digest()
+        tileRandom = random.Random(digest)
+        predictions = []
+        for _ in range(self.predictionsPerTile):
+            width, height = tileRandom.uniform(0.02, 0.3), tileRandom.uniform(0.02, 0.3)
+            predictions.append({
+                "probability": tileRandom.random(),
+                "tagId": "00000000-0000-0000-0000-000000000001",
+                "tagName": "mock",
+                "boundingBox": {
+                    "left": tileRandom.uniform(0, 1 - width),
+                    "top": tileRandom.uniform(0, 1 - height),
+                    "width": width,
+                    "height": height
+                }
+            })
+
+        return {
+            "id": digest.hex()[0:32],
+            "project": projectId,
+            "iteration": iterationName,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()),
+            "predictions": predictions
+        }
+
+    def MakeApplication(self):
+        """
+        Creates the Tornado application serving the prediction endpoint.
+        """
+        return web.Application([
+            (r"/customvision/v3.0/Prediction/([^/]+)/detect/iterations/([^/]+)/image/nostore", MockPredictionHandler, { "server": self }),
+        ])
+
+    def Listen(self, port, address="127.0.0.1"):
+        """
+        Starts listening for requests on the given port (on the current IOLoop).
+        """
+        app = self.MakeApplication()
+        logger.info(f"Mock prediction server listening on http://{address}:{port}/")
+        return app.listen(port, address)
+
+class MockPredictionHandler(web.RequestHandler):
+
+    def initialize(self, server):
+        self.server = server
+
+    async def post(self, projectId, iterationName):
+        server = self.server
+        server.requests += 1
+        server.bytesReceived += len(self.request.body)
+
+        if server.predictionKey is not None and self.request.headers.get("Prediction-Key") != server.predictionKey:
+            self.set_status(401)
+            return
+
+        await gen.sleep(server.SampleLatency())
+
+        outcome = server.random.random()
+        if outcome < server.throttleRate:
+            server.throttled += 1
+            self.set_status(429)
+            self.set_header("Retry-After", str(server.retryAfterSec))
+            self.write(json.dumps({ "code": "429", "message": "Rate limit is exceeded." }))
+        elif outcome < server.throttleRate + server.errorRate:
+            server.errors += 1
+            self.set_status(500)
+            self.write(json.dumps({ "code": "InternalServerError", "message": "Mock server error." }))
+        else:
+            self.set_header("Content-Type", "application/json")
+            self.write(json.dumps(server.CreatePredictions(projectId, iterationName, self.request.body)))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Local mock of the Custom Vision prediction endpoint, for load testing without using prediction quota."
+    )
+    parser.add_argument("--port", help="The port to listen on", type=int, default=8080)
+    parser.add_argument("--latency", help="The request latency distribution", choices=LATENCY_DISTRIBUTIONS, default="lognormal")
+    parser.add_argument("--latencyMean", help="Mean request latency (in seconds)", type=float, default=0.2)
+    parser.add_argument("--latencyStdev", help="Standard deviation of the request latency (in seconds)", type=float, default=0.1)
+    parser.add_argument("--errorRate", help="Fraction of requests that fail with HTTP 500", type=float, default=0.0)
+    parser.add_argument("--throttleRate", help="Fraction of requests that are throttled with HTTP 429", type=float, default=0.0)
+    parser.add_argument("--retryAfter", help="Retry-After value (in seconds) sent with throttled responses", type=int, default=1)
+    parser.add_argument("--predictionsPerTile", help="Number of synthetic predictions returned per tile", type=int, default=2)
+    parser.add_argument("--seed", help="Random seed, for repeatable latencies and failures", type=int)
+    args = parser.parse_args()
+
+    server = MockPredictionServer(
+        latency=args.latency,
+        latencyMeanSec=args.latencyMean,
+        latencyStdevSec=args.latencyStdev,
+        errorRate=args.errorRate,
+        throttleRate=args.throttleRate,
+        retryAfterSec=args.retryAfter,
+        predictionsPerTile=args.predictionsPerTile,
+        seed=args.seed
+    )
+    server.Listen(args.port)
+    ioloop.IOLoop.current().start()
+
+if __name__=='__main__':
+    logging.basicConfig(format="%(asctime)s: %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    main()
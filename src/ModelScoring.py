@@ -1,132 +1,841 @@
-import logging, os
-import glob
+import logging
 import time
 import random
 import asyncio
+import collections
 import configparser
 import json
+import numpy as np
 
-from datetime import timedelta
-from tornado import gen, httpclient, ioloop, queues
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from tornado import gen, httpclient, ioloop, locks, queues
+
+from ImageTiling import ParseTileName
+from BoundingBoxes import DetectionArray
+from PredictionCache import PredictionCache
+from UploadEncoding import UploadEncoder
+from Instrumentation import recorder
+
+# The curl based HTTP client is optional (it requires pycurl), but unlike the default client it keeps
+# connections to the scoring endpoint alive between requests.
+try:
+    from tornado.curl_httpclient import CurlAsyncHTTPClient
+except ImportError:
+    CurlAsyncHTTPClient = None
 
 # Async/tornado settings
 TASK_CONCURRENCY = 8
 WORK_QUEUE_TIMEOUT_SEC = 300
+HTTP_BACKENDS = ("auto", "curl", "simple")
+
+# Only the most recent failed tile names and request latencies are kept, since a long-running service never
+# stops scoring (totals are counted)
+FAILED_TILES_KEPT = 1000
+LATENCY_SAMPLES_KEPT = 10000
 
 logger = logging.getLogger("ModelScoring")
 
-class ParallelScoring:
+class ScoringJob:
     """
-    Implements scoring calls against the Custom Vision API in a parallel manner.
+    Tracks the tiles of a single source image as they go through the shared scoring work queue.
     """
 
-    def __init__(self, settings, tileWidth, tileHeight):
+    def __init__(self, key, tiles, scores=None, scoreThreshold=None, onTileScored=None):
+        self.key = key
+        self.tiles = tiles
+        self.scores = scores if scores is not None else []
+        self.scoreThreshold = scoreThreshold
+        self.onTileScored = onTileScored
+        self.failedTiles = []
+        self.error = None
+        self.pending = 0
+        self.enqueued = False
+
+def CaptureResults(tile, results, scores, scoreThreshold, tileWidth, tileHeight):
+    """
+    Appends the predictions for a tile, in the format returned by the Custom Vision prediction API (boxes relative
+    to the tile size), to scores as score dicts with boxes in tile pixels. Predictions scoring at or below the
+    threshold are skipped.
+    """
+    # Rotated (90/270) tiles have their width and height swapped
+    if tile.angle in (90, 270):
+        tileWidth, tileHeight = tileHeight, tileWidth
+
+    # Capture the results.    
+    for prediction in results["predictions"]:
+        score = prediction["probability"] * 100
+        x1 = prediction["boundingBox"]["left"] * tileWidth
+        y1 = prediction["boundingBox"]["top"] * tileHeight
+        x2 = x1 + (prediction["boundingBox"]["width"] * tileWidth)
+        y2 = y1 + (prediction["boundingBox"]["height"] * tileHeight)
+
+        if (score > scoreThreshold):
+            logger.info(f"Found box at ({x1}, {y1}, {x2}, {y2}) with probability {score}")
+    
+            scores.append({
+                "name": tile.name,
+                "score": score,
+                "tag": prediction.get("tagName", ""),
+                "tileRow": tile.row,
+                "tileColumn": tile.col,
+                "angle": tile.angle,
+                "boxes": [
+                    (x1, y1, x2, y2)
+                ]
+            })
+        else:
+            logger.info(f"**Skipping box with threshold {score}**")
+
+def CaptureDetections(tile, results, scoreThreshold, tileWidth, tileHeight):
+    """
+    Array version of CaptureResults: returns the predictions for a tile scoring above the threshold as a
+    DetectionArray (see BoundingBoxes), with boxes in tile pixels, without building a dict per box.
+    """
+    # Rotated (90/270) tiles have their width and height swapped
+    if tile.angle in (90, 270):
+        tileWidth, tileHeight = tileHeight, tileWidth
+
+    predictions = results["predictions"]
+    scores = np.array([p["probability"] for p in predictions], dtype=np.float64) * 100
+    boxes = np.array([
+        (p["boundingBox"]["left"], p["boundingBox"]["top"], p["boundingBox"]["width"], p["boundingBox"]["height"]) for p in predictions
+    ], dtype=np.float64).reshape(-1, 4) * (tileWidth, tileHeight, tileWidth, tileHeight)
+    boxes[:, 2:4] += boxes[:, 0:2]
+    tags = np.array([p.get("tagName", "") for p in predictions], dtype=object).reshape(-1)
+
+    keep = scores > scoreThreshold
+    count = int(keep.sum())
+    logger.info(f"Found {count} boxes on tile {tile.name} (skipped {len(predictions) - count} below the threshold)")
+
+    _, _, _, _, x, y = ParseTileName(tile.name)
+    return DetectionArray(
+        boxes[keep],
+        np.tile(np.array([tile.row, tile.col, tile.angle], dtype=np.int64), (count, 1)),
+        scores[keep],
+        np.tile(np.array([np.nan, np.nan] if x is None else [x, y], dtype=np.float64), (count, 1)),
+        tags[keep]
+    )
+
+class ScoringBackend:
+    """
+    Base class of the scoring engines, which turn tiles into score dicts (see CaptureResults), or hand each
+    tile's detections to a callback as soon as it is scored (see CaptureDetections): ParallelScoring sends each
+    tile to the Custom Vision prediction API, while LocalScoring.BatchedLocalScoring runs batches of tiles
+    through an exported model. Subclasses implement ScoreJobsAsync; scoring several images, resuming from the
+    journal and reporting failed tiles work the same way for every backend.
+    """
+
+    def __init__(self, settings, tileWidth, tileHeight, journal=None):
         self.tiles = []
         self.scores = []
         self.tileWidth = tileWidth
         self.tileHeight = tileHeight
-        self.tempFilePath = settings.tempFilePath
+        self.maxTilesInFlight = settings.maxTilesInFlight
+        self.boundingBoxScoreThreshold = settings.boundingBoxScoreThreshold
+        self.failedTiles = collections.deque(maxlen=FAILED_TILES_KEPT)
+        self.failedTileCount = 0
+        self.resumedTiles = 0
+
+        # Optional journal of scored tiles (see ScoringJournal), used to resume interrupted runs
+        self.journal = journal
+
+    async def ScoreJobsAsync(self, jobs, onJobScored=None):
+        """
+        Scores the tiles of the ScoringJob records from the async iterable jobs, appending score dicts to each
+        job's scores and the names of tiles that couldn't be scored to its failedTiles (see FailTile).
+        Once all tiles of a job are done, onJobScored(job) is called on a background thread. A job whose tiles
+        can't be produced (e.g. an unreadable source image) gets an error instead, and the next job is scored.
+        """
+        raise NotImplementedError()
+
+    async def PullTile(self, job, tiles):
+        """
+        Called by backends to pull the next tile of a job from the iterator tiles, on a background thread (tiles
+        may be cropped/encoded lazily). Returns None once the job has no more tiles, or when tiling it fails, in
+        which case the job's error is set, so one bad image doesn't stop the others from being scored.
+        """
+        try:
+            return await ioloop.IOLoop.current().run_in_executor(None, next, tiles, None)
+        except Exception as e:
+            logger.error(f"Failed to tile {job.key}: {e}")
+            recorder.Increment("images_failed")
+            job.error = f"Failed to tile {job.key}: {e}"
+            return None
+
+    def FailTile(self, job, tile):
+        """
+        Called by backends for each tile that couldn't be scored: lists it in the job's failedTiles, and in
+        failedTiles, which only keeps the most recent FAILED_TILES_KEPT names (failedTileCount counts them all).
+        """
+        job.failedTiles.append(tile.name)
+        self.failedTiles.append(tile.name)
+        self.failedTileCount += 1
+        recorder.Increment("tiles_failed")
+
+    def LogFailedTiles(self):
+        """
+        Called by backends at the end of a run, to log the tiles that couldn't be scored.
+        """
+        if self.failedTileCount > len(self.failedTiles):
+            logger.error(f"Failed to score {self.failedTileCount} tiles, the last {len(self.failedTiles)} of them: {', '.join(self.failedTiles)}")
+        elif self.failedTiles:
+            logger.error(f"Failed to score {len(self.failedTiles)} tiles: {', '.join(self.failedTiles)}")
+
+    def CaptureTile(self, job, tile, results):
+        """
+        Called by backends with the prediction results of each scored tile of a job: hands the tile's detections
+        to the job's onTileScored callback if it has one, and otherwise appends them to its scores.
+        """
+        threshold = job.scoreThreshold if job.scoreThreshold is not None else self.boundingBoxScoreThreshold
+        if job.onTileScored is None:
+            CaptureResults(tile, results, job.scores, threshold, self.tileWidth, self.tileHeight)
+            return
+
+        # A failing consumer doesn't fail the tile, which was scored (and journaled) fine
+        try:
+            job.onTileScored(tile, CaptureDetections(tile, results, threshold, self.tileWidth, self.tileHeight))
+        except Exception as e:
+            logger.error(f"Exception while processing detections for tile {tile.name} of {job.key}: {e}")
+
+    def CompleteJob(self, job, onJobScored):
+        """
+        Called by backends once all tiles of a job are done. Logs the tiles that failed, and runs onJobScored(job),
+        if given, on a background thread, so post-processing carries on while scoring continues. Jobs that failed
+        to tile aren't passed on, since their scores are incomplete. Returns the future of the callback (or None).
+        """
+        if job.failedTiles:
+            logger.error(f"Failed to score {len(job.failedTiles)} tiles of {job.key}: {', '.join(job.failedTiles)}")
+        if onJobScored is None or job.error is not None:
+            return None
+
+        def runCallback():
+            try:
+                onJobScored(job)
+            except Exception as e:
+                logger.error(f"Exception while processing scores for {job.key}: {e}")
+
+        return ioloop.IOLoop.current().run_in_executor(None, runCallback)
+
+    def Close(self):
+        """
+        Releases any resources held by the backend (connections, model sessions).
+        """
+        pass
+
+    def ScoreTiles(self, tiles, source=None, onTileScored=None):
+        """
+        Scores tiles. Tiles can be any iterable of Tile records (e.g. the generator returned by
+        DefaultImageTiler.GenerateTiles, or the tile files listed in a RunWorkspace manifest). The source (image
+        path) identifies the tiles in the journal, if any.
+
+        Returns the score dicts of all tiles, unless onTileScored is given: it is then called on the IOLoop with
+        (tile, detections) as each tile is scored, where detections is a DetectionArray of the tile's boxes in
+        tile pixels, and no score dicts are kept.
+        """
+
+        logger.info(f"Scoring tiles with at most {self.maxTilesInFlight} tiles in flight...")
+        job = ScoringJob(source, tiles, self.scores, onTileScored=onTileScored)
+        self.tiles = tiles
+        self.ScoreJobs([job])
+
+        # With a single image, failing to tile it fails the run
+        if job.error is not None:
+            raise Exception(job.error)
+        return self.scores
+
+    def ScoreJobs(self, jobs):
+        """
+        Scores the tiles of a list of ScoringJob records on the current IOLoop, through one work queue, returning
+        once they are all done. Each job then holds its scores (unless it has an onTileScored callback), failed
+        tiles and error.
+        """
+        async def iterateJobs():
+            for job in jobs:
+                yield job
+
+        io_loop = ioloop.IOLoop.current()
+        io_loop.run_sync(lambda: self.ScoreJobsAsync(iterateJobs()))
+
+    async def StreamTilesAsync(self, tiles, source=None):
+        """
+        Async iterator version of ScoreTiles with onTileScored: scores tiles on the current IOLoop, yielding
+        (tile, detections) as each tile is scored.
+        """
+        scored = queues.Queue()
+        job = ScoringJob(source, tiles, onTileScored=lambda tile, detections: scored.put_nowait((tile, detections)))
+
+        async def iterateJobs():
+            yield job
+
+        done = gen.convert_yielded(self.ScoreJobsAsync(iterateJobs()))
+        done.add_done_callback(lambda _: scored.put_nowait(None))
+        while True:
+            item = await scored.get()
+            if item is None:
+                break
+            yield item
+        await done
+        if job.error is not None:
+            raise Exception(job.error)
+
+    def ScoreImages(self, images, onImageScored, scoreThreshold=None, onTileScored=None):
+        """
+        Scores the tiles of several source images through one shared work queue. Images is an iterable of (key,
+        tiles) pairs, where tiles is an iterable of Tile records for that image (e.g. from
+        DefaultImageTiler.GenerateTiles). Images are tiled one after another, while the tiles of earlier images
+        are still being scored. As soon as all tiles of an image are scored, onImageScored(key, scores) is called
+        on a background thread, so results can be written while scoring continues. Images that fail to tile are
+        logged and skipped (onImageScored isn't called for them). The score threshold, if
+        given, overrides BoundingBoxScoreThreshold for these images. When onTileScored is given, it is called
+        with (key, tile, detections) as each tile is scored, and the scores passed to onImageScored are empty
+        (see ScoreTiles).
+        """
+
+        async def iterateImages():
+            for image in images:
+                yield image
+
+        io_loop = ioloop.IOLoop.current()
+        io_loop.run_sync(lambda: self.ScoreImagesAsync(iterateImages(), onImageScored, scoreThreshold, onTileScored))
+
+    async def ScoreImagesAsync(self, images, onImageScored, scoreThreshold=None, onTileScored=None):
+        """
+        Coroutine version of ScoreImages, running on the current IOLoop, where images is an async iterable of
+        (key, tiles) pairs. Returns once images is exhausted, so a long-running service can keep feeding it
+        images as they are submitted, reusing the same workers and warm connections (or loaded model).
+        """
+
+        def bindKey(key):
+            if onTileScored is None:
+                return None
+            return lambda tile, detections: onTileScored(key, tile, detections)
+
+        async def iterateJobs():
+            async for key, tiles in images:
+                yield ScoringJob(key, tiles, scoreThreshold=scoreThreshold, onTileScored=bindKey(key))
+
+        await self.ScoreJobsAsync(iterateJobs(), lambda job: onImageScored(job.key, job.scores))
+
+class RetryableScoringError(Exception):
+    """
+    Raised for scoring responses that are worth retrying (throttling, server errors, timeouts).
+    """
+
+    def __init__(self, message, statusCode, retryAfter=None):
+        super().__init__(message)
+        self.statusCode = statusCode
+        self.retryAfter = retryAfter
+
+    @property
+    def throttled(self):
+        return self.statusCode == 429
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Limits the number of concurrent scoring requests using AIMD (additive increase, multiplicative decrease):
+    while request latency stays under the target, the limit grows by roughly one request per round of
+    successful requests; when the service throttles us (429) or latency goes over the target, the limit is
+    cut by the decrease factor. Decreases happen at most once per latency target interval, so a burst of
+    throttled in-flight requests only counts as one congestion signal.
+    """
+
+    def __init__(self, initialLimit, minLimit, maxLimit, latencyTargetSec, decreaseFactor=0.5):
+        self.minLimit = minLimit
+        self.maxLimit = maxLimit
+        self.limit = float(min(max(initialLimit, minLimit), maxLimit))
+        self.latencyTargetSec = latencyTargetSec
+        self.decreaseFactor = decreaseFactor
+        self.inFlight = 0
+        self.__lastDecrease = 0.0
+        self.__condition = locks.Condition()
+
+    async def Acquire(self):
+        while self.inFlight >= int(self.limit):
+            await self.__condition.wait()
+        self.inFlight += 1
+
+    def Release(self):
+        self.inFlight -= 1
+        self.__condition.notify()
+
+    def OnSuccess(self, latencySec):
+        if latencySec > self.latencyTargetSec:
+            self.OnCongestion()
+            return
+
+        previous = int(self.limit)
+        self.limit = min(self.maxLimit, self.limit + (1.0 / self.limit))
+        if int(self.limit) > previous:
+            logger.info(f"Increasing scoring concurrency to {int(self.limit)}")
+            self.__condition.notify(int(self.limit) - previous)
+
+    def OnCongestion(self):
+        now = time.time()
+        if now - self.__lastDecrease < self.latencyTargetSec:
+            return
+
+        self.__lastDecrease = now
+        self.limit = max(self.minLimit, self.limit * self.decreaseFactor)
+        logger.info(f"Decreasing scoring concurrency to {int(self.limit)}")
+
+class TokenBucket:
+    """
+    Limits the rate of requests sent to an endpoint: tokens are added at a fixed rate (per second), up to one
+    second's worth, and each request takes one. A rate of 0 means unlimited. The bucket can also be paused, e.g.
+    for the Retry-After period of a throttled request.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.pausedUntil = 0.0
+        self.__updated = time.monotonic()
+
+    def __refill(self, now):
+        if now > self.__updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.__updated) * self.rate)
+            self.__updated = now
+
+    def GetWait(self, now):
+        """
+        Returns how long (in seconds) until a token is available, 0 if one is available now.
+        """
+        if now < self.pausedUntil:
+            return self.pausedUntil - now
+        if self.rate <= 0:
+            return 0.0
+        self.__refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def Take(self, now):
+        if self.rate > 0:
+            self.__refill(now)
+            self.tokens -= 1
+
+    def Pause(self, seconds, now):
+        self.pausedUntil = max(self.pausedUntil, now + seconds)
+
+class ScoringEndpoint:
+    """
+    A prediction endpoint requests are dispatched to (see ParallelScoring), with its rate limit, weight, health
+    and statistics. When there are other endpoints to fail over to, after FAILURE_THRESHOLD consecutive failed
+    requests the endpoint is taken out of rotation for a cooldown period, which doubles (up to MAX_COOLDOWN_SEC)
+    each time it fails again once back in rotation. Failures of requests that were already in flight when it
+    was taken out of rotation don't count towards this.
+    """
+    FAILURE_THRESHOLD = 3
+    BASE_COOLDOWN_SEC = 5.0
+    MAX_COOLDOWN_SEC = 120.0
+
+    def __init__(self, endpointSettings, projectId, publishIterationName, failover=True):
+        self.name = endpointSettings.name
+        self.failover = failover
+        if endpointSettings.weight <= 0 or endpointSettings.requestsPerSecond < 0:
+            msg = f"Endpoint {self.name} must have a positive weight, and a requests per second limit of 0 (unlimited) or more"
+            logger.error(msg)
+            raise Exception(msg)
+
+        self.weight = endpointSettings.weight
+        self.bucket = TokenBucket(endpointSettings.requestsPerSecond)
+
+        # Build API URL and headers once: https://{endpoint}/customvision/v3.0/Prediction/{projectId}/detect/iterations/{publishedName}/url/nostore[?application]
+        self.url = f"{endpointSettings.serviceEndpoint}customvision/v3.0/Prediction/{projectId}/detect/iterations/{publishIterationName}/image/nostore"
+        self.headers = {
+            "Prediction-Key": endpointSettings.predictionKey, 
+            "Content-Type": "application/octet-stream"
+        }
+
+        # Health, and smooth weighted round robin state (see ParallelScoring)
+        self.consecutiveFailures = 0
+        self.cooldowns = 0
+        self.unhealthyUntil = 0.0
+        self.currentWeight = 0.0
+
+        # Request statistics
+        self.requests = 0
+        self.failures = 0
+        self.throttled = 0
+        self.bytesUploaded = 0
+        self.totalLatencySec = 0.0
+
+    def IsHealthy(self, now):
+        return now >= self.unhealthyUntil
+
+    def OnRequest(self, tile, latencySec):
+        self.requests += 1
+        self.bytesUploaded += len(tile.data)
+        self.totalLatencySec += latencySec
+
+    def OnSuccess(self):
+        self.consecutiveFailures = 0
+        self.cooldowns = 0
+
+    def OnFailure(self, error, now, sentAt):
+        """
+        Records a failed request, sent at sentAt (both monotonic times).
+        """
+        self.failures += 1
+        if isinstance(error, RetryableScoringError):
+            if error.throttled:
+                self.throttled += 1
+            if error.retryAfter is not None:
+                self.bucket.Pause(error.retryAfter, now)
+
+        # Requests sent before the endpoint was back in rotation were in flight when it was taken out (or were
+        # sent anyway, with every endpoint out of rotation), so they don't tell anything new about its health
+        if sentAt < self.unhealthyUntil:
+            return
+
+        self.consecutiveFailures += 1
+        if self.failover and self.consecutiveFailures >= self.FAILURE_THRESHOLD:
+            cooldown = min(self.MAX_COOLDOWN_SEC, self.BASE_COOLDOWN_SEC * (2 ** self.cooldowns))
+            self.cooldowns += 1
+            self.unhealthyUntil = now + cooldown
+            logger.warning(f"Endpoint {self.name} failed {self.consecutiveFailures} requests in a row, taking it out of rotation for {cooldown:.0f} seconds")
+
+    def GetStats(self):
+        return {
+            "endpoint": self.name,
+            "requests": self.requests,
+            "failures": self.failures,
+            "throttled": self.throttled,
+            "bytesUploaded": self.bytesUploaded,
+            "meanLatencySec": self.totalLatencySec / self.requests if self.requests else None
+        }
+
+class ParallelScoring(ScoringBackend):
+    """
+    Implements scoring calls against the Custom Vision API in a parallel manner.
+    """
+
+    def __init__(self, settings, tileWidth, tileHeight, journal=None):
+        super().__init__(settings, tileWidth, tileHeight, journal)
+
+        # Request statistics (latencies of the most recent requests only)
+        self.requestLatencies = collections.deque(maxlen=LATENCY_SAMPLES_KEPT)
+        self.requestCount = 0
+        self.bytesUploaded = 0
+        self.bytesSaved = 0
+        self.cacheHits = 0
+
+        # Concurrency and retry settings
+        self.minConcurrency = settings.minConcurrency
+        self.maxConcurrency = settings.maxConcurrency
+        self.latencyTargetSec = settings.latencyTargetSec
+        self.maxRetries = settings.maxRetries
+        self.retryBaseDelaySec = settings.retryBaseDelaySec
+        self.retryMaxDelaySec = settings.retryMaxDelaySec
 
         # Grab configuration settings
-        self.serviceEndpoint = settings.serviceEndpoint
-        self.predictionKey = settings.predictionKey
-        self.predictionResourceId = settings.predictionResourceId
         self.publishIterationName = settings.publishIterationName
         self.projectId = settings.projectId
-        self.boundingBoxScoreThreshold = settings.boundingBoxScoreThreshold
+        self.httpBackend = settings.httpBackend
+
+        if self.httpBackend not in HTTP_BACKENDS:
+            msg = f"Specified HTTP backend {self.httpBackend} is not supported (must be one of {', '.join(HTTP_BACKENDS)})"
+            logger.error(msg)
+            raise Exception(msg)
+
+        # Requests are spread over the prediction endpoints (resources), each with its own rate limit
+        endpoints = settings.GetEndpoints()
+        self.endpoints = [ScoringEndpoint(e, self.projectId, self.publishIterationName, len(endpoints) > 1) for e in endpoints]
+
+        # Shared HTTP client, created on first use (see __getHttpClient)
+        self.httpClient = None
+
+        # Optional cache of prediction results, keyed by tile contents and model iteration
+        self.predictionCache = None
+        if settings.predictionCachePath:
+            self.predictionCache = PredictionCache(settings.predictionCachePath, settings.predictionCacheMaxMB * 1024 * 1024)
 
-    async def __sendApiRequest(self, tileName):
-        logger.info(f"Scoring tile {tileName}...")
+        # Tiles may be scaled down and compressed before they are uploaded (see UploadEncoder)
+        self.uploadEncoder = UploadEncoder(settings.uploadFormat, settings.uploadMaxSize, settings.uploadQuality)
 
-        # Disassemble tile name so we can build results collections
-        _, index, tileRow, tileCol, angle = tileName.split('.')[0].split('_')
+    def __getHttpClient(self):
+        # One client (and connection pool) is used for all requests made by this instance, sized to match the
+        # maximum concurrency. The curl backend is used when available, since it reuses connections.
+        if self.httpClient is None:
+            useCurl = self.httpBackend == "curl" or (self.httpBackend == "auto" and CurlAsyncHTTPClient is not None)
 
-        # Build API URL: https://{endpoint}/customvision/v3.0/Prediction/{projectId}/detect/iterations/{publishedName}/url/nostore[?application]
-        apiUrl = f"{self.serviceEndpoint}customvision/v3.0/Prediction/{self.projectId}/detect/iterations/{self.publishIterationName}/image/nostore"
+            if useCurl:
+                if CurlAsyncHTTPClient is None:
+                    msg = "The curl HTTP backend was requested, but pycurl is not installed"
+                    logger.error(msg)
+                    raise Exception(msg)
+                self.httpClient = CurlAsyncHTTPClient(force_instance=True, max_clients=self.maxConcurrency)
+            else:
+                self.httpClient = httpclient.AsyncHTTPClient(force_instance=True, max_clients=self.maxConcurrency)
+
+            logger.info(f"Using {type(self.httpClient).__name__} with {self.maxConcurrency} connections")
+
+        return self.httpClient
 
-        # Open the sample image and get back the prediction results.
-        with open(tileName, mode="rb") as test_data:
-            response = await httpclient.AsyncHTTPClient().fetch(
+    async def __sendApiRequest(self, tile, endpoint):
+        logger.info(f"Scoring tile {tile.name} on endpoint {endpoint.name}...")
+
+        # Send the encoded tile and get back the prediction results.
+        start = time.time()
+        self.bytesUploaded += len(tile.data)
+        recorder.Increment("bytes_uploaded", len(tile.data))
+        try:
+            response = await self.__getHttpClient().fetch(
                 method="POST", 
-                body=test_data.read(), 
-                request=apiUrl, 
-                headers={
-                    "Prediction-Key": self.predictionKey, 
-                    "Content-Type": "application/octet-stream"
-                },
+                body=tile.data, 
+                request=endpoint.url, 
+                headers=endpoint.headers,
                 raise_error=False
             )
-            results = json.loads(response.body.decode())
-
-        # Capture the results.    
-        for prediction in results["predictions"]:
-            score = prediction["probability"] * 100
-            x1 = prediction["boundingBox"]["left"] * self.tileWidth
-            y1 = prediction["boundingBox"]["top"] * self.tileHeight
-            x2 = x1 + (prediction["boundingBox"]["width"] * self.tileWidth)
-            y2 = y1 + (prediction["boundingBox"]["height"] * self.tileHeight)
-
-            if (score > self.boundingBoxScoreThreshold):
-                logger.info(f"Found box at ({x1}, {y1}, {x2}, {y2}) with probability {score}")
-        
-                self.scores.append({
-                    "name": tileName,
-                    "score": score,
-                    "tileRow": int(tileRow),
-                    "tileColumn": int(tileCol),
-                    "boxes": [
-                        (x1, y1, x2, y2)
-                    ]
-                })
-            else:
-                logger.info(f"**Skipping box with threshold {score}**")
+        except (httpclient.HTTPClientError, OSError) as e:
+            # raise_error=False only covers HTTP error responses: timeouts (599) and refused or reset connections
+            # are still raised, and are retried like server errors
+            self.requestLatencies.append(time.time() - start)
+            self.requestCount += 1
+            endpoint.OnRequest(tile, time.time() - start)
+            recorder.Increment("requests")
+            raise RetryableScoringError(f"Scoring request failed: {e}", getattr(e, "code", 599))
+        self.requestLatencies.append(time.time() - start)
+        self.requestCount += 1
+        endpoint.OnRequest(tile, time.time() - start)
+        self.__recordRequestTimings(tile, endpoint, response, time.time() - start)
+
+        # Throttling, server errors and timeouts/connection errors (599, when the client returns them as a
+        # response rather than raising them) can be retried; anything else can't.
+        # With several endpoints, authentication and not found errors are specific to the endpoint (e.g. a wrong
+        # key, or the iteration not being published to its resource), so the tile is retried on another one.
+        if response.code == 429 or response.code >= 500 or (len(self.endpoints) > 1 and response.code in (401, 403, 404)):
+            raise RetryableScoringError(
+                f"Scoring request failed with status {response.code}", 
+                response.code, 
+                self.__parseRetryAfter(response.headers.get("Retry-After"))
+            )
+        if response.code != 200:
+            raise Exception(f"Scoring request failed with status {response.code}: {response.body}")
+
+        with recorder.Span("parse", tile=tile.name):
+            return json.loads(response.body.decode())
+
+    def __recordRequestTimings(self, tile, endpoint, response, latency):
+        recorder.Increment("requests")
+        recorder.Record("request", latency, tile=tile.name, endpoint=endpoint.name, status=response.code, bytes=len(tile.data))
+
+        # The curl client also reports when the request was fully sent, and when the first byte of the response
+        # arrived, which separates connection setup, upload + server processing, and downloading the response
+        timeInfo = response.time_info or {}
+        if "pretransfer" in timeInfo and "starttransfer" in timeInfo:
+            recorder.Record("connect", timeInfo["pretransfer"], tile=tile.name)
+            recorder.Record("server", timeInfo["starttransfer"] - timeInfo["pretransfer"], tile=tile.name)
+            recorder.Record("download", timeInfo.get("total", timeInfo["starttransfer"]) - timeInfo["starttransfer"], tile=tile.name)
+
+    def __parseRetryAfter(self, value):
+        # Retry-After is either a number of seconds, or an HTTP date
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+    def __getRetryDelay(self, attempt, error):
+        # Honor the service's Retry-After when given, otherwise use exponential backoff with full jitter
+        if error.retryAfter is not None:
+            return error.retryAfter
+        return random.uniform(0, min(self.retryMaxDelaySec, self.retryBaseDelaySec * (2 ** attempt)))
+
+    def __getHealthyEndpoints(self, now):
+        # When every endpoint is out of rotation, keep trying all of them (the retry backoff still applies)
+        return [e for e in self.endpoints if e.IsHealthy(now)] or self.endpoints
+
+    async def __acquireEndpoint(self):
+        # Picks the endpoint for a request among the healthy endpoints with a token available, using smooth
+        # weighted round robin so requests are spread evenly in proportion to the endpoint weights. When no
+        # endpoint has a token, waits until the first one does.
+        while True:
+            now = time.monotonic()
+            candidates = self.__getHealthyEndpoints(now)
+            waits = [e.bucket.GetWait(now) for e in candidates]
+            ready = [e for e, wait in zip(candidates, waits) if wait <= 0]
+            if ready:
+                for endpoint in ready:
+                    endpoint.currentWeight += endpoint.weight
+                chosen = max(ready, key=lambda e: e.currentWeight)
+                chosen.currentWeight -= sum(e.weight for e in ready)
+                chosen.bucket.Take(now)
+                return chosen
 
-    async def __doWork(self):
+            await gen.sleep(min(waits))
+
+    async def __scoreWithRetries(self, tile, limiter):
+        attempt = 0
+        while True:
+            await limiter.Acquire()
+            try:
+                endpoint = await self.__acquireEndpoint()
+                start = time.time()
+                sentAt = time.monotonic()
+                results = await self.__sendApiRequest(tile, endpoint)
+                limiter.OnSuccess(time.time() - start)
+                endpoint.OnSuccess()
+                return results
+            except RetryableScoringError as e:
+                endpoint.OnFailure(e, time.monotonic(), sentAt)
+                if e.throttled:
+                    limiter.OnCongestion()
+                if attempt >= self.maxRetries:
+                    raise
+
+                # Fail over to another endpoint right away when there is a healthy one to take the request
+                if any(other is not endpoint and other.IsHealthy(time.monotonic()) for other in self.endpoints):
+                    delay = 0.0
+                else:
+                    delay = self.__getRetryDelay(attempt, e)
+                recorder.Increment("retries")
+                logger.warning(f"{e} for tile {tile.name} on endpoint {endpoint.name}, retrying in {delay:.2f} seconds (attempt {attempt + 1} of {self.maxRetries})")
+            finally:
+                limiter.Release()
+
+            attempt += 1
+            await gen.sleep(delay)
+
+    async def __scoreTile(self, source, tile, limiter):
+        # Tiles already scored by an interrupted run are taken from the journal
+        if self.journal is not None:
+            results = self.journal.Get(source, tile.name)
+            if results is not None:
+                logger.info(f"Using journaled predictions for tile {tile.name}")
+                self.resumedTiles += 1
+                recorder.Increment("tiles_resumed")
+                return results
+
+        results = await self.__fetchResults(tile, limiter)
+
+        # Journal the results as soon as they arrive, so they survive the run being interrupted
+        if self.journal is not None:
+            self.journal.Put(source, tile.name, results)
+        return results
+
+    def __prepareUpload(self, tile):
+        # Returns the tile with the payload to upload, and its prediction cache key. Predictions are cached by
+        # payload, since that is what the model sees.
+        upload = tile._replace(data=self.uploadEncoder.Encode(tile.data))
+        cacheKey = None
+        if self.predictionCache is not None:
+            cacheKey = self.predictionCache.GetKey(self.projectId, self.publishIterationName, upload.data)
+        return upload, cacheKey
+
+    async def __fetchResults(self, tile, limiter):
+        # Check the prediction cache before sending anything (encoding and hashing large tiles happens off the IOLoop)
+        upload, cacheKey = tile, None
+        if self.predictionCache is not None or self.uploadEncoder.enabled:
+            upload, cacheKey = await ioloop.IOLoop.current().run_in_executor(None, self.__prepareUpload, tile)
+
+        if cacheKey is not None:
+            results = self.predictionCache.Get(cacheKey)
+            if results is not None:
+                logger.info(f"Using cached predictions for tile {tile.name}")
+                self.cacheHits += 1
+                recorder.Increment("cache_hits")
+                return results
+
+        saved = len(tile.data) - len(upload.data)
+        self.bytesSaved += saved
+        recorder.Increment("upload_bytes_saved", saved)
+        results = await self.__scoreWithRetries(upload, limiter)
+
+        if cacheKey is not None:
+            self.predictionCache.Put(cacheKey, results)
+        return results
+
+    async def ScoreJobsAsync(self, jobs, onJobScored=None):
         start = time.time()
-        q = queues.Queue()
-        fetching, fetched = [], []
+        q = queues.Queue(maxsize=self.maxTilesInFlight)
+        limiter = AdaptiveConcurrencyLimiter(TASK_CONCURRENCY, self.minConcurrency, self.maxConcurrency, self.latencyTargetSec)
+        completions = []
+        # Only counted (rather than listing tile names), since a long-running service never stops scoring
+        fetched = 0
+
+        def completeJob(job):
+            completion = self.CompleteJob(job, onJobScored)
+            if completion is not None:
+                completions.append(completion)
 
-        async def score(tileName):
-            fetching.append(tileName)
-            await self.__sendApiRequest(tileName)
-            fetched.append(tileName)
+        async def score(job, tile):
+            nonlocal fetched
+            results = await self.__scoreTile(job.key, tile, limiter)
+            self.CaptureTile(job, tile, results)
+            fetched += 1
+            recorder.Increment("tiles_scored")
 
         async def worker():
-            async for tileName in q:
-                if tileName is None:
+            async for item in q:
+                if item is None:
                     return
+                job, tile, enqueued = item
+                recorder.Record("queue", time.perf_counter() - enqueued, tile=tile.name)
                 try:
-                    await score(tileName)
+                    await score(job, tile)
                 except Exception as e:
-                    logger.error(f"Exception: {e} {tileName}")
+                    logger.error(f"Exception: {e} {tile.name}")
+                    self.FailTile(job, tile)
                 finally:
+                    job.pending -= 1
+                    if job.enqueued and job.pending == 0:
+                        completeJob(job)
                     q.task_done()
 
-        # Enqueue each tile path/name for workers to grab
-        for tile in self.tiles:
-            await q.put(tile)
+        # Start workers first so uploads begin while later tiles are still being produced. There is one worker
+        # per possible concurrent request; the limiter decides how many of them actually send at any time.
+        workers = gen.multi([worker() for _ in range(self.maxConcurrency)])
+
+        # Pull each tile from the source on a background thread (tiles may be cropped/encoded lazily), and
+        # enqueue it for workers to grab. The queue is bounded, so at most maxTilesInFlight tiles wait in memory.
+        # Jobs are processed in order, so the next image is already being tiled while the last tiles of the
+        # previous one are still being scored. Jobs may arrive at any time (e.g. submitted to the service).
+        async for job in jobs:
+            tiles = iter(job.tiles)
+            while True:
+                tile = await self.PullTile(job, tiles)
+                if tile is None:
+                    break
+                job.pending += 1
+                await q.put((job, tile, time.perf_counter()))
+
+            job.enqueued = True
+            if job.pending == 0:
+                completeJob(job)
 
-        # Start workers, then wait for the work queue to be empty.
-        workers = gen.multi([worker() for _ in range(TASK_CONCURRENCY)])
+        # Wait for the work queue to be empty.
         await q.join(timeout=timedelta(seconds=WORK_QUEUE_TIMEOUT_SEC))
-        logger.info(f"Done in {(time.time() - start)} seconds, scored {len(fetched)} tiles...")
+        logger.info(f"Done in {(time.time() - start)} seconds, scored {fetched} tiles ({self.cacheHits} from the prediction cache, {self.resumedTiles} from the journal)...")
+        if self.uploadEncoder.enabled:
+            logger.info(f"Uploaded {self.bytesUploaded} bytes, saving {self.bytesSaved} bytes by re-encoding tiles ({self.uploadEncoder.uploadFormat}, max size {self.uploadEncoder.maxSize})")
+        self.LogFailedTiles()
+        for stats in self.GetEndpointStats():
+            logger.info(f"Endpoint {stats['endpoint']}: {stats['requests']} requests, {stats['failures']} failed ({stats['throttled']} throttled), {stats['bytesUploaded']} bytes uploaded")
 
         # Signal all the workers to exit.
-        for _ in range(TASK_CONCURRENCY):
+        for _ in range(self.maxConcurrency):
             await q.put(None)
 
-        # wait for workers
+        # wait for workers, and any post-processing still running
         await workers
+        await gen.multi(completions)
 
-    def ScoreTiles(self):
+    def GetEndpointStats(self):
         """
-        Reads the tiles from the specified directory, and sends those to the scoring API endpoint in parallel.
+        Returns the request statistics of each endpoint.
         """
+        return [endpoint.GetStats() for endpoint in self.endpoints]
 
-        self.tiles = glob.glob(os.path.join(self.tempFilePath, "*.png"))
-        logger.info(f"Found {len(self.tiles)} tiles for scoring...")
-
-        io_loop = ioloop.IOLoop.current()
-        io_loop.run_sync(self.__doWork)
-
-        return self.scores
\ No newline at end of file
+    def Close(self):
+        """
+        Closes the shared HTTP client, along with any open connections.
+        """
+        if self.httpClient is not None:
+            self.httpClient.close()
+            self.httpClient = None
@@ -0,0 +1,110 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+
+logger = logging.getLogger("PredictionCache")
+
+class PredictionCache:
+    """
+    On-disk, content-addressed cache of prediction results. Entries are keyed by a hash of the tile bytes
+    along with the project and published iteration, so rescoring identical imagery is free, while publishing
+    a new iteration automatically misses the cache. The raw prediction results are stored (before any score
+    threshold is applied). Once the cache grows beyond its maximum size, the least recently used entries are
+    evicted.
+    """
+
+    def __init__(self, cachePath, maxSizeBytes):
+        self.cachePath = cachePath
+        self.maxSizeBytes = maxSizeBytes
+        self.hits = 0
+        self.misses = 0
+        self.sizeBytes = 0
+
+        # Index of key -> entry size, in least to most recently used order
+        self.__entries = collections.OrderedDict()
+
+        os.makedirs(cachePath, exist_ok=True)
+        self.__loadIndex()
+
+    def __loadIndex(self):
+        # Rebuild the LRU order from the entry modification times (which are updated on every hit)
+        entries = []
+        for shard in os.scandir(self.cachePath):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".json"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.name[:-len(".json")], stat.st_size))
+
+        for _, key, size in sorted(entries):
+            self.__entries[key] = size
+            self.sizeBytes += size
+
+        logger.info(f"Prediction cache at {self.cachePath} holds {len(self.__entries)} entries ({self.sizeBytes} bytes)")
+
+    def __getEntryPath(self, key):
+        return os.path.join(self.cachePath, key[0:2], key + ".json")
+
+    def __evict(self):
+        while self.sizeBytes > self.maxSizeBytes and self.__entries:
+            key, size = self.__entries.popitem(last=False)
+            self.sizeBytes -= size
+            try:
+                os.remove(self.__getEntryPath(key))
+            except FileNotFoundError:
+                pass
+
+    def GetKey(self, projectId, iterationName, data):
+        """
+        Returns the cache key for a tile scored against the given project and published iteration.
+        """
+        digest = hashlib.sha256()
+        digest.update(f"{projectId}\n{iterationName}\n".encode())
+        digest.update(data)
+        return digest.hexdigest()
+
+    def Get(self, key):
+        """
+        Returns the cached prediction results for the key, or None if they aren't cached.
+        """
+        if key not in self.__entries:
+            self.misses += 1
+            return None
+
+        entryPath = self.__getEntryPath(key)
+        try:
+            with open(entryPath, "r") as entry:
+                results = json.load(entry)
+            os.utime(entryPath)
+        except (OSError, ValueError):
+            # Removed or corrupted behind our back; treat as a miss
+            self.sizeBytes -= self.__entries.pop(key)
+            self.misses += 1
+            return None
+
+        self.__entries.move_to_end(key)
+        self.hits += 1
+        return results
+
+    def Put(self, key, results):
+        """
+        Stores the prediction results for the key, evicting least recently used entries if needed.
+        """
+        entryPath = self.__getEntryPath(key)
+        os.makedirs(os.path.dirname(entryPath), exist_ok=True)
+
+        # Write to a temporary file first, so readers (or a crash) never see a partial entry
+        data = json.dumps(results).encode()
+        tempPath = f"{entryPath}.{os.getpid()}.tmp"
+        with open(tempPath, "wb") as entry:
+            entry.write(data)
+        os.replace(tempPath, entryPath)
+
+        if key in self.__entries:
+            self.sizeBytes -= self.__entries.pop(key)
+        self.__entries[key] = len(data)
+        self.sizeBytes += len(data)
+        self.__evict()
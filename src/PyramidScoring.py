@@ -0,0 +1,97 @@
+import logging
+import os
+import tempfile
+import numpy as np
+
+from ImageTiling import ParseTileName, SlidingWindowImageTiler
+from Instrumentation import recorder
+from ModelScoring import ScoringJob
+from RasterReader import ReadReducedImage
+
+logger = logging.getLogger("PyramidScoring")
+
+class CoarseToFineScoring:
+    """
+    Coarse-to-fine (two level pyramid) tiling, for imagery where objects are sparse (e.g. ships at sea). The
+    source image is first reduced by an integer factor and scored with tiles of the same size, so each coarse
+    tile covers factor x factor full resolution tiles, keeping boxes down to a low score threshold
+    (CoarseScoreThreshold). Full resolution tiles are then only cut where they overlap a coarse box, grown by a
+    margin (RefineMargin pixels), instead of across the whole image. Coarse tiles that fail to score are refined
+    in full, so nothing is missed because of a failed request.
+    """
+
+    def __init__(self, settings, scoringMethod, tiler, coordinateOps, factor):
+        if (factor < 2):
+            msg = f"Specified coarse factor {factor} must be at least 2."
+            logger.error(msg)
+            raise Exception(msg)
+
+        self.scoringMethod = scoringMethod
+        self.tiler = tiler
+        self.coordinateOps = coordinateOps
+        self.factor = factor
+        self.scoreThreshold = settings.coarseScoreThreshold
+        self.margin = settings.refineMargin
+
+        # The reduced image rarely divides evenly into tiles, so coarse tiles extend past its edges
+        self.coarseTiler = SlidingWindowImageTiler(
+            settings,
+            tiler.tileHeight,
+            tiler.tileWidth,
+            getattr(tiler, "overlap", 0),
+            "pad",
+            tiler.tileFilter,
+            tiler.workerCount
+        )
+
+    def __scoreCoarseImage(self, sourceImage):
+        # The reduced image is stored as a raw raster, which tiling workers memory map rather than decode
+        fd, coarsePath = tempfile.mkstemp(suffix=".npy")
+        os.close(fd)
+        try:
+            with recorder.Span("reduce", source=os.path.basename(sourceImage), factor=self.factor):
+                reduced = ReadReducedImage(sourceImage, self.factor)
+                np.save(coarsePath, np.asarray(reduced))
+            logger.info(f"Scoring {reduced.width}x{reduced.height} coarse image (1/{self.factor} scale)...")
+
+            # Coarse tiles are named like full resolution ones, so they are journaled under their own key
+            job = ScoringJob(
+                f"{sourceImage}#coarse{self.factor}",
+                self.coarseTiler.GenerateTiles(coarsePath, False),
+                scoreThreshold=self.scoreThreshold
+            )
+            self.scoringMethod.ScoreJobs([job])
+            if job.error is not None:
+                raise Exception(job.error)
+            return job.scores, job.failedTiles
+        finally:
+            os.remove(coarsePath)
+
+    def GetRegions(self, sourceImage):
+        """
+        Scores the reduced source image, and returns the regions to refine, as an (N, 4) array of (x1, y1, x2, y2)
+        boxes in source image pixels: the coarse boxes grown by the margin, and the area of any coarse tile that
+        failed to score.
+        """
+        scores, failedTiles = self.__scoreCoarseImage(sourceImage)
+        detections = self.coordinateOps.RemapDetections(
+            self.tiler.tileHeight,
+            self.tiler.tileWidth,
+            self.coordinateOps.ScoresToDetections(scores),
+            scale=self.factor
+        )
+        regions = [detections.boxes + np.array([-self.margin, -self.margin, self.margin, self.margin])]
+
+        for tileName in failedTiles:
+            _, _, _, _, x, y = ParseTileName(tileName)
+            regions.append(np.array([[x, y, x + self.tiler.tileWidth, y + self.tiler.tileHeight]], dtype=np.float64) * self.factor)
+
+        logger.info(f"Found {len(detections)} coarse boxes to refine ({len(failedTiles)} coarse tiles failed to score)")
+        return np.concatenate(regions)
+
+    def GenerateTiles(self, sourceImage, generatePermutations):
+        """
+        Runs the coarse pass for a source image, and returns its full resolution tiles to score (see
+        DefaultImageTiler.GenerateTiles): only those overlapping the regions found by the coarse pass.
+        """
+        return self.tiler.GenerateTiles(sourceImage, generatePermutations, self.GetRegions(sourceImage))
@@ -0,0 +1,225 @@
+import collections
+import logging
+import math
+import os
+import numpy as np
+from PIL import Image
+
+# Windowed reading of TIFF/BigTIFF files is optional (it requires tifffile); without it, TIFF files are read
+# with Pillow, which decodes the whole image.
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+logger = logging.getLogger("RasterReader")
+
+# Pillow image modes for the supported numbers of 8 bit bands
+BAND_MODES = { 1: "L", 3: "RGB", 4: "RGBA" }
+
+class PillowRasterReader:
+    """
+    Reads source images with Pillow. Simple and supports every format Pillow does, but the whole image is decoded
+    into memory on the first crop.
+    """
+    FORK_SAFE = True
+
+    def __init__(self, path):
+        self.path = path
+        self.image = Image.open(path)
+        self.size = self.image.size
+        self.mode = self.image.mode
+
+    def Load(self):
+        """
+        Decodes the whole image up front (e.g. so forked processes can share the pixel data).
+        """
+        self.image.load()
+
+    def Crop(self, box):
+        """
+        Returns the (x1, y1, x2, y2) region of the image; areas outside the image are black.
+        """
+        return self.image.crop(box)
+
+    def Close(self):
+        self.image.close()
+
+class WindowedRasterReader:
+    """
+    Base class for readers that only decode the part of the source image a crop needs, so peak memory depends
+    on the size of the crop rather than the size of the image. Subclasses set size/bands and implement
+    ReadWindow.
+    """
+    FORK_SAFE = False
+
+    def __init__(self, path, width, height, bands):
+        if bands not in BAND_MODES:
+            msg = f"Source image {path} has {bands} bands, only 1 (grayscale), 3 (RGB) or 4 (RGBA) are supported"
+            logger.error(msg)
+            raise Exception(msg)
+
+        self.path = path
+        self.size = (width, height)
+        self.bands = bands
+        self.mode = BAND_MODES[bands]
+
+    def Load(self):
+        pass
+
+    def ReadWindow(self, x1, y1, x2, y2):
+        """
+        Returns the pixels of a window that lies within the image, as a (height, width, bands) uint8 array.
+        """
+        raise NotImplementedError()
+
+    def Crop(self, box):
+        """
+        Returns the (x1, y1, x2, y2) region of the image; areas outside the image are black.
+        """
+        x1, y1, x2, y2 = [int(v) for v in box]
+        width, height = self.size
+        pixels = np.zeros((y2 - y1, x2 - x1, self.bands), dtype=np.uint8)
+
+        # Only read the part of the region that lies within the image
+        left, top, right, bottom = max(x1, 0), max(y1, 0), min(x2, width), min(y2, height)
+        if left < right and top < bottom:
+            pixels[top - y1:bottom - y1, left - x1:right - x1] = self.ReadWindow(left, top, right, bottom)
+
+        if self.bands == 1:
+            pixels = pixels[:, :, 0]
+        return Image.fromarray(pixels, self.mode)
+
+    def Close(self):
+        pass
+
+class MemoryMappedRasterReader(WindowedRasterReader):
+    """
+    Reads raw rasters stored as NumPy .npy files, of shape (height, width) or (height, width, bands) and type
+    uint8. The file is memory mapped, so a crop only pages in the rows it touches.
+    """
+    FORK_SAFE = True
+
+    def __init__(self, path):
+        self.pixels = np.load(path, mmap_mode="r")
+        if self.pixels.dtype != np.uint8 or self.pixels.ndim not in (2, 3):
+            msg = f"Raw raster {path} must be a 2 or 3 dimensional uint8 array (got {self.pixels.ndim} dimensions of {self.pixels.dtype})"
+            logger.error(msg)
+            raise Exception(msg)
+
+        if self.pixels.ndim == 2:
+            self.pixels = self.pixels[:, :, np.newaxis]
+        super().__init__(path, self.pixels.shape[1], self.pixels.shape[0], self.pixels.shape[2])
+
+    def ReadWindow(self, x1, y1, x2, y2):
+        return self.pixels[y1:y2, x1:x2]
+
+class TiffRasterReader(WindowedRasterReader):
+    """
+    Reads tiled or stripped TIFF/BigTIFF files with tifffile, decoding only the tiles/strips (segments) a crop
+    overlaps. Decoded segments are kept in a small LRU cache, since neighbouring crops (e.g. overlapping tiles,
+    or tiles next to each other on a strip) usually share segments.
+    """
+    SEGMENT_CACHE_MB = 64
+
+    def __init__(self, path):
+        self.file = tifffile.TiffFile(path)
+        page = self.file.pages[0]
+        if page.dtype != np.uint8 or page.planarconfig != 1 or page.imagedepth != 1:
+            self.file.close()
+            msg = f"TIFF source image {path} must be 8 bit, with interleaved (contiguous) samples"
+            logger.error(msg)
+            raise Exception(msg)
+
+        super().__init__(path, page.imagewidth, page.imagelength, page.samplesperpixel)
+        self.page = page
+        if page.is_tiled:
+            self.segmentWidth, self.segmentHeight = page.tilewidth, page.tilelength
+        else:
+            self.segmentWidth, self.segmentHeight = page.imagewidth, min(page.rowsperstrip or page.imagelength, page.imagelength)
+        self.segmentsAcross = -(-self.size[0] // self.segmentWidth)
+
+        # Index of segment -> decoded pixels, in least to most recently used order
+        self.__segments = collections.OrderedDict()
+        self.__cachedBytes = 0
+
+    def __readSegment(self, index):
+        if index in self.__segments:
+            self.__segments.move_to_end(index)
+            return self.__segments[index]
+
+        segment = np.zeros((self.segmentHeight, self.segmentWidth, self.bands), dtype=np.uint8)
+        if self.page.databytecounts[index] > 0:
+            fh = self.file.filehandle
+            fh.seek(self.page.dataoffsets[index])
+            data = fh.read(self.page.databytecounts[index])
+            decoded, _, _ = self.page.decode(data, index, jpegtables=self.page.jpegtables)
+            decoded = decoded.reshape(decoded.shape[-3:])
+            segment[:decoded.shape[0], :decoded.shape[1]] = decoded[:self.segmentHeight, :self.segmentWidth]
+
+        self.__segments[index] = segment
+        self.__cachedBytes += segment.nbytes
+        while self.__cachedBytes > self.SEGMENT_CACHE_MB * 1024 * 1024 and len(self.__segments) > 1:
+            _, evicted = self.__segments.popitem(last=False)
+            self.__cachedBytes -= evicted.nbytes
+        return segment
+
+    def ReadWindow(self, x1, y1, x2, y2):
+        window = np.empty((y2 - y1, x2 - x1, self.bands), dtype=np.uint8)
+        for segmentRow in range(y1 // self.segmentHeight, (y2 - 1) // self.segmentHeight + 1):
+            for segmentCol in range(x1 // self.segmentWidth, (x2 - 1) // self.segmentWidth + 1):
+                segment = self.__readSegment(segmentRow * self.segmentsAcross + segmentCol)
+                originX, originY = segmentCol * self.segmentWidth, segmentRow * self.segmentHeight
+                left, top = max(x1, originX), max(y1, originY)
+                right, bottom = min(x2, originX + self.segmentWidth), min(y2, originY + self.segmentHeight)
+                window[top - y1:bottom - y1, left - x1:right - x1] = segment[top - originY:bottom - originY, left - originX:right - originX]
+        return window
+
+    def Close(self):
+        self.file.close()
+
+def ReduceRaster(reader, factor, stripHeight=256):
+    """
+    Reduces an open source image by an integer factor (each pixel is the mean of a factor x factor block), as an
+    RGB image, a strip at a time, so only one strip of the full resolution image is held in memory.
+    """
+    width, height = reader.size
+
+    # Strips are a multiple of the factor, so blocks never straddle strips
+    stripHeight = factor * max(1, stripHeight // factor)
+    reduced = Image.new("RGB", (math.ceil(width / factor), math.ceil(height / factor)))
+    for top in range(0, height, stripHeight):
+        strip = reader.Crop((0, top, width, min(top + stripHeight, height))).convert("RGB")
+        reduced.paste(strip.reduce(factor), (0, top // factor))
+    return reduced
+
+def ReadReducedImage(path, factor):
+    """
+    Reads a source image reduced by an integer factor, as an RGB image of (ceil(width / factor), ceil(height /
+    factor)) pixels, without decoding the full resolution image where possible: JPEG sources are decoded at
+    reduced scale, and windowed sources are reduced a strip at a time (see ReduceRaster).
+    """
+    reader = OpenRasterReader(path)
+    try:
+        width, height = reader.size
+        size = (math.ceil(width / factor), math.ceil(height / factor))
+        if isinstance(reader, PillowRasterReader):
+            image = reader.image
+            image.draft("RGB", size)
+            return image.convert("RGB").resize(size, Image.BILINEAR)
+        return ReduceRaster(reader, factor)
+    finally:
+        reader.Close()
+
+def OpenRasterReader(path):
+    """
+    Opens a source image with the most memory efficient reader available for it: raw .npy rasters are memory
+    mapped, TIFF/BigTIFF files are read a segment at a time (when tifffile is installed), and everything else is
+    read with Pillow.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".npy":
+        return MemoryMappedRasterReader(path)
+    if extension in (".tif", ".tiff") and tifffile is not None:
+        return TiffRasterReader(path)
+    return PillowRasterReader(path)
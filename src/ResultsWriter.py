@@ -1,33 +1,305 @@
+import json
 import logging
+import math
+import os
+import numpy as np
 from PIL import Image, ImageDraw
+from RasterReader import OpenRasterReader, PillowRasterReader, ReduceRaster
+from BoundingBoxes import DetectionStore
+from Instrumentation import recorder
+
+# Streaming TIFF output is optional (it requires tifffile)
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
 
 logger = logging.getLogger("ResultsWriter")
 
 class ImageWithBoundingBoxes:
     """
-    Draws a final image with boxes overlayed on it.
+    Draws a final image with boxes overlayed on it, at full resolution.
     """
     COLOR = "#ffff00"
     BORDER_WIDTH = 4
+    STRIP_HEIGHT = 256
+
+    def GetOutputPath(self, outputDir, sourceImage):
+        """
+        The result / output file is named the same as the source image, but in the output dir.
+        """
+        return os.path.join(outputDir, os.path.basename(sourceImage))
+
+    def WriteDetections(self, originalSource, detections, outputPath):
+        """
+        Writes the final image for a DetectionArray (see BoundingBoxes).
+        """
+        self.Write(originalSource, detections.ToBoxList(), outputPath)
+
+    def __drawBoxes(self, image, boundingBoxes, offsetY=0):
+        draw = ImageDraw.Draw(image)
+        for x1, y1, x2, y2 in boundingBoxes:
+            # PIL truncates coordinates, so truncate before shifting to land on the same rows as a full size canvas
+            draw.rectangle((x1, int(y1) - offsetY, x2, int(y2) - offsetY), fill=None, outline=self.COLOR, width=self.BORDER_WIDTH)
+        del draw
+
+    def __iterateStrips(self, reader, boundingBoxes):
+        width, height = reader.size
+        for top in range(0, height, self.STRIP_HEIGHT):
+            bottom = min(top + self.STRIP_HEIGHT, height)
+            strip = reader.Crop((0, top, width, bottom))
+
+            # Only the boxes crossing this strip are drawn, shifted into strip coordinates (PIL clips the rest)
+            self.__drawBoxes(strip, [b for b in boundingBoxes if b[1] < bottom and b[3] >= top], top)
+            yield np.asarray(strip)
+
+    def __writeStrips(self, reader, boundingBoxes, outputPath):
+        width, height = reader.size
+        shape = (height, width) if reader.bands == 1 else (height, width, reader.bands)
+
+        if outputPath.lower().endswith(".npy"):
+            output = np.lib.format.open_memmap(outputPath, mode="w+", dtype=np.uint8, shape=shape)
+            for top, strip in zip(range(0, height, self.STRIP_HEIGHT), self.__iterateStrips(reader, boundingBoxes)):
+                output[top:top + strip.shape[0]] = strip
+            output.flush()
+            del output
+            return
+
+        if tifffile is None:
+            msg = f"Writing {outputPath} strip by strip requires tifffile (or a .npy output path)"
+            logger.error(msg)
+            raise Exception(msg)
+
+        tifffile.imwrite(
+            outputPath,
+            self.__iterateStrips(reader, boundingBoxes),
+            shape=shape,
+            dtype=np.uint8,
+            rowsperstrip=self.STRIP_HEIGHT,
+            photometric="minisblack" if reader.bands == 1 else "rgb",
+            bigtiff=(width * height * reader.bands) > 2 ** 31
+        )
 
     def Write(self, originalSource, boundingBoxes, outputPath):
         """
-        Writes the final image using the bounding boxes defined in the boundingBoxes paramters. 
+        Writes the final image using the bounding boxes defined in the boundingBoxes paramters.
         Bounding boxes are an array, with each element being a 4-tuple containing (x1, y1, x2, y2).
+
+        Sources that can be read a window at a time (tiled/stripped TIFF and raw .npy rasters, see RasterReader)
+        are written strip by strip, as TIFF (or .npy, depending on the output path), so the full canvas is never
+        held in memory. Any other source is drawn in one go and written as JPEG.
         """
 
         logger.info("Creating results image with overlays...")
+        reader = OpenRasterReader(originalSource)
+
+        if not isinstance(reader, PillowRasterReader):
+            logger.info(f"- Drawing bounding boxes strip by strip ({self.STRIP_HEIGHT} rows at a time)")
+            try:
+                self.__writeStrips(reader, boundingBoxes, outputPath)
+            finally:
+                reader.Close()
+            logger.info("Done!!")
+            return
 
         # Open the image and create 2D drawing context
-        im = Image.open(originalSource)
-        draw = ImageDraw.Draw(im)
+        im = reader.image
 
         # Iterate the boxes that were given
         logger.info("- Drawing bounding boxes")
-        for box in boundingBoxes:
-            draw.rectangle(box, fill=None, outline=self.COLOR, width=self.BORDER_WIDTH)
+        self.__drawBoxes(im, boundingBoxes)
 
-        # Close the drawing context and write the image
-        del draw
+        # Write the image
         im.save(outputPath, "JPEG")
-        logger.info("Done!!")
\ No newline at end of file
+        logger.info("Done!!")
+
+class DetectionsAsJsonLines:
+    """
+    Writes detections as compact JSON lines, one detection per line, with its box (in source image pixels),
+    score, tag and the tile it was found on. This is much faster than rendering an image, and easy to load
+    into other tools. With geoJson set, each line is a GeoJSON Feature instead, whose Polygon geometry is
+    in source image pixel coordinates (y pointing down).
+    """
+
+    def __init__(self, geoJson=False):
+        self.geoJson = geoJson
+
+    def GetOutputPath(self, outputDir, sourceImage):
+        """
+        The detections file is named after the source image, in the output dir.
+        """
+        name = os.path.splitext(os.path.basename(sourceImage))[0]
+        return os.path.join(outputDir, name + (".geojsonl" if self.geoJson else ".jsonl"))
+
+    def GetPartialPath(self, outputPath):
+        """
+        Detections streamed while the image is still being scored (see ProgressiveDetections) are written here,
+        until the final detections are written to the output path.
+        """
+        return outputPath + ".partial"
+
+    def GetRecords(self, originalSource, detections):
+        """
+        Yields the record (a dict, as written on each line) of each detection in a DetectionArray.
+        """
+        source = os.path.basename(originalSource)
+        for box, tile, score, origin, tag in zip(detections.boxes.tolist(), detections.tiles.tolist(),
+                                                 detections.scores.tolist(), detections.origins.tolist(), detections.tags):
+            x1, y1, x2, y2 = [round(v, 2) for v in box]
+            properties = {
+                "source": source,
+                "score": round(score, 3),
+                "tag": tag,
+                "tile": { "row": tile[0], "col": tile[1], "angle": tile[2] }
+            }
+            if not math.isnan(origin[0]):
+                properties["tile"]["x"], properties["tile"]["y"] = int(origin[0]), int(origin[1])
+
+            if self.geoJson:
+                yield {
+                    "type": "Feature",
+                    "geometry": { "type": "Polygon", "coordinates": [[[x1, y1], [x2, y1], [x2, y2], [x1, y2], [x1, y1]]] },
+                    "properties": properties
+                }
+            else:
+                yield dict(box=[x1, y1, x2, y2], **properties)
+
+    def AppendDetections(self, originalSource, detections, output):
+        """
+        Writes the lines of a DetectionArray (see BoundingBoxes) to an open file.
+        """
+        for record in self.GetRecords(originalSource, detections):
+            output.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    def WriteDetections(self, originalSource, detections, outputPath):
+        """
+        Writes a DetectionArray (see BoundingBoxes) to the output path, replacing any partial detections.
+        """
+        logger.info(f"Writing {len(detections)} detections to {outputPath}...")
+
+        with open(outputPath, "w") as output:
+            self.AppendDetections(originalSource, detections, output)
+
+        partialPath = self.GetPartialPath(outputPath)
+        if os.path.exists(partialPath):
+            os.remove(partialPath)
+        logger.info("Done!!")
+
+class ProgressiveDetections:
+    """
+    Consumes the detections of a source image as its tiles are scored (see ScoringBackend.ScoreTiles), so results
+    build up during a long run instead of all at the end: the boxes of each tile are re-mapped to source image
+    space as they arrive, appended to a DetectionStore, and (given a JSON lines writer) written to its partial
+    detections file right away. Duplicates across tiles can only be removed once every tile is in, so the
+    partial file may hold duplicate boxes until the final detections replace it. The store also indexes the boxes
+    as they arrive (in cells the size of a tile), for removing those duplicates.
+    """
+
+    def __init__(self, coordinateOps, tileHeight, tileWidth, sourceImage, jsonWriter=None, outputPath=None):
+        self.coordinateOps = coordinateOps
+        self.tileHeight = tileHeight
+        self.tileWidth = tileWidth
+        self.sourceImage = sourceImage
+        self.jsonWriter = jsonWriter
+        self.store = DetectionStore(max(tileHeight, tileWidth))
+        self.partialFile = None
+
+        if jsonWriter is not None:
+            partialPath = jsonWriter.GetPartialPath(jsonWriter.GetOutputPath(outputPath, sourceImage))
+            self.partialFile = open(partialPath, "w")
+
+    def OnTileScored(self, tile, detections):
+        """
+        Takes the detections (a DetectionArray, in tile pixels) of a scored tile.
+        """
+        if len(detections) == 0:
+            return
+
+        with recorder.Span("remap", tile=tile.name, boxes=len(detections)):
+            detections = self.coordinateOps.RemapDetections(self.tileHeight, self.tileWidth, detections)
+        self.store.Append(detections)
+
+        if self.partialFile is not None:
+            self.jsonWriter.AppendDetections(self.sourceImage, detections, self.partialFile)
+            self.partialFile.flush()
+
+    def GetDetections(self):
+        """
+        Returns the detections of all tiles scored so far, in source image space, as a DetectionArray, and closes
+        the partial detections file.
+        """
+        if self.partialFile is not None:
+            self.partialFile.close()
+            self.partialFile = None
+        return self.store.ToDetections()
+
+class PreviewWithBoundingBoxes:
+    """
+    Draws the boxes over a downsampled preview of the source image, no larger than maxSize pixels on its
+    longest side, which is far cheaper than re-rendering the full resolution image. JPEG sources are decoded
+    at reduced scale, and windowed sources (see RasterReader) are reduced a strip at a time, so the full
+    resolution image is never held in memory. With more than one level, an image pyramid is written: each
+    further level is half the size of the previous one.
+    """
+    BORDER_WIDTH = 2
+
+    def __init__(self, maxSize=2048, levels=1):
+        self.maxSize = maxSize
+        self.levels = levels
+
+    def __getPreviewPath(self, outputPath, level):
+        if level == 0:
+            return outputPath
+        base, extension = os.path.splitext(outputPath)
+        return f"{base}_{level}{extension}"
+
+    def __readPreview(self, originalSource):
+        reader = OpenRasterReader(originalSource)
+        try:
+            width, height = reader.size
+            factor = max(1, math.ceil(max(width, height) / self.maxSize))
+
+            if isinstance(reader, PillowRasterReader):
+                # Let the decoder skip detail we don't need (JPEG can decode at 1/2, 1/4 or 1/8 scale)
+                image = reader.image
+                image.draft("RGB", (width // factor, height // factor))
+                image = image.convert("RGB")
+                image.thumbnail((self.maxSize, self.maxSize), Image.BILINEAR)
+                return image, (width, height)
+
+            # Reduce the image a strip at a time
+            return ReduceRaster(reader, factor, ImageWithBoundingBoxes.STRIP_HEIGHT), (width, height)
+        finally:
+            reader.Close()
+
+    def GetOutputPath(self, outputDir, sourceImage):
+        """
+        The preview is named after the source image, in the output dir.
+        """
+        name = os.path.splitext(os.path.basename(sourceImage))[0]
+        return os.path.join(outputDir, name + "_preview.jpg")
+
+    def WriteDetections(self, originalSource, detections, outputPath):
+        """
+        Writes the preview (and any further pyramid levels) for a DetectionArray (see BoundingBoxes).
+        """
+        logger.info("Creating preview image with overlays...")
+        preview, (width, height) = self.__readPreview(originalSource)
+
+        for level in range(self.levels):
+            if level > 0:
+                preview = preview.reduce(2)
+
+            # Scale the boxes to match this level
+            scaleX, scaleY = preview.width / width, preview.height / height
+            boxes = detections.boxes * np.array([scaleX, scaleY, scaleX, scaleY])
+
+            logger.info(f"- Drawing bounding boxes on {preview.width}x{preview.height} preview")
+            overlay = preview.copy()
+            draw = ImageDraw.Draw(overlay)
+            for box in boxes.tolist():
+                draw.rectangle(box, fill=None, outline=ImageWithBoundingBoxes.COLOR, width=self.BORDER_WIDTH)
+            del draw
+            overlay.save(self.__getPreviewPath(outputPath, level), "JPEG")
+
+        logger.info("Done!!")
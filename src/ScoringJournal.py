@@ -0,0 +1,80 @@
+import json
+import logging
+import os
+
+logger = logging.getLogger("ScoringJournal")
+
+class ScoringJournal:
+    """
+    Append-only journal (JSON lines) of the prediction results of each scored tile, keyed by source image and
+    tile name (which encodes the tile position and rotation). Results are appended as soon as they arrive, so a
+    run that times out or dies can be resumed, only scoring the tiles that weren't scored yet. Each entry also
+    records the run key (model iteration and tile size), and entries from a different run are ignored on resume.
+    As with the prediction cache, the raw prediction results are stored (before any score threshold is applied).
+    """
+
+    def __init__(self, journalPath, runKey, resume=False):
+        self.journalPath = journalPath
+        self.runKey = runKey
+        self.resumed = 0
+        self.__entries = {}
+
+        if resume and os.path.exists(journalPath):
+            self.__load()
+        else:
+            logger.info(f"Starting new scoring journal at {journalPath}")
+
+        self.__file = open(journalPath, "a" if resume else "w")
+
+        # A crash may have left a partial last line; start appending on a fresh line
+        if self.__file.tell() > 0:
+            with open(journalPath, "rb") as journal:
+                journal.seek(-1, os.SEEK_END)
+                if journal.read(1) != b"\n":
+                    self.__file.write("\n")
+
+    def __load(self):
+        ignored = 0
+        with open(self.journalPath, "r") as journal:
+            for lineNumber, line in enumerate(journal, 1):
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    logger.warning(f"Ignoring incomplete entry on line {lineNumber} of {self.journalPath}")
+                    continue
+
+                if entry.get("run") != self.runKey:
+                    ignored += 1
+                    continue
+                self.__entries[(entry["source"], entry["tile"])] = entry["results"]
+
+        logger.info(f"Resuming from scoring journal {self.journalPath} with {len(self.__entries)} scored tiles ({ignored} entries from other runs ignored)")
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def Get(self, source, tileName):
+        """
+        Returns the journaled prediction results for a tile, or None if it hasn't been scored yet.
+        """
+        results = self.__entries.get((source, tileName))
+        if results is not None:
+            self.resumed += 1
+        return results
+
+    def Put(self, source, tileName, results):
+        """
+        Appends the prediction results for a tile. Entries are flushed right away, so they survive the process
+        dying; they are synced to disk when the journal is closed.
+        """
+        self.__entries[(source, tileName)] = results
+        self.__file.write(json.dumps({ "run": self.runKey, "source": source, "tile": tileName, "results": results }) + "\n")
+        self.__file.flush()
+
+    def Close(self):
+        if not self.__file.closed:
+            self.__file.flush()
+            os.fsync(self.__file.fileno())
+            self.__file.close()
@@ -0,0 +1,370 @@
+import collections
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+
+from tornado import ioloop, locks, queues, web
+
+from BoundingBoxes import IndexBoxes, FindOverlapping
+from ResultsWriter import DetectionsAsJsonLines
+
+logger = logging.getLogger("ScoringService")
+
+# Extensions given to uploaded images (which decide how they are read, see RasterReader), by content type
+UPLOAD_EXTENSIONS = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/tiff": ".tif",
+    "image/bmp": ".bmp",
+    "application/x-npy": ".npy"
+}
+
+class ServiceBusyError(Exception):
+    """
+    Raised when a job is submitted while the service already has as many jobs as it accepts.
+    """
+
+class ServiceJob:
+    """
+    A source image submitted to the scoring service, and its progress: queued, scoring (tiles are being
+    produced and scored), writing (the results are being written), and finally done or failed.
+    """
+
+    def __init__(self, jobId, sourceImage, outputPath, upload=False):
+        self.id = jobId
+        self.sourceImage = sourceImage
+        self.outputPath = outputPath
+        self.upload = upload
+        self.state = "queued"
+        self.tiles = 0
+        self.detections = None
+        self.boxes = None
+        self.index = None
+        self.error = None
+        self.submitted = time.time()
+        self.finished = None
+        self.changed = locks.Condition()
+
+    @property
+    def done(self):
+        return self.state in ("done", "failed")
+
+    def GetStatus(self):
+        return {
+            "id": self.id,
+            "state": self.state,
+            "source": os.path.basename(self.sourceImage),
+            "tiles": self.tiles,
+            "detections": len(self.detections) if self.detections is not None else None,
+            "error": self.error,
+            "elapsedSec": round((self.finished or time.time()) - self.submitted, 3)
+        }
+
+class ScoringService:
+    """
+    Long-running scoring service: source images (paths, or uploaded image data) are submitted over HTTP, and
+    scored through one persistent ParallelScoring instance, so the interpreter, settings, worker pool and warm
+    HTTP connections are shared by all jobs instead of being set up for each image. Clients poll (or long-poll)
+    the status of a job, or stream its status changes and detections. At most maxQueuedJobs jobs are accepted
+    at a time; beyond that submissions are refused (HTTP 503 with Retry-After), which pushes back on the client
+    instead of queueing unbounded work.
+
+    generateTiles(sourceImage) returns the tiles of a source image, and processScores(sourceImage, scores,
+    outputPath) turns the scores of a source image into a DetectionArray, writing any results to outputPath.
+    Each job writes its results to its own directory under outputPath.
+    """
+    FINISHED_JOBS_KEPT = 1000
+    RETRY_AFTER_SEC = 1
+    MAX_WAIT_SEC = 300
+
+    def __init__(self, scoringMethod, generateTiles, processScores, outputPath, maxQueuedJobs=16):
+        self.scoringMethod = scoringMethod
+        self.generateTiles = generateTiles
+        self.processScores = processScores
+        self.outputPath = outputPath
+        self.maxQueuedJobs = maxQueuedJobs
+        self.activeJobs = 0
+        self.ioLoop = None
+
+        # Job id -> job, in submission order
+        self.jobs = collections.OrderedDict()
+        self.__records = DetectionsAsJsonLines()
+        self.__queue = queues.Queue()
+        self.__stopped = locks.Event()
+
+    def Submit(self, sourceImage, jobId=None, upload=False):
+        """
+        Queues a source image for scoring, and returns its job. Uploaded images are deleted once scored.
+        """
+        if self.activeJobs >= self.maxQueuedJobs:
+            raise ServiceBusyError(f"The service already has {self.activeJobs} jobs queued or running")
+
+        jobId = jobId or uuid.uuid4().hex
+        job = ServiceJob(jobId, sourceImage, os.path.join(self.outputPath, jobId), upload)
+        os.makedirs(job.outputPath, exist_ok=True)
+
+        self.jobs[jobId] = job
+        self.activeJobs += 1
+        self.__queue.put_nowait(job)
+        logger.info(f"Queued job {jobId} for {sourceImage} ({self.activeJobs} active jobs)")
+        return job
+
+    def SaveUpload(self, jobId, name, data):
+        """
+        Saves uploaded image data for a job, returning its path.
+        """
+        uploadPath = os.path.join(self.outputPath, jobId, "upload")
+        os.makedirs(uploadPath, exist_ok=True)
+        path = os.path.join(uploadPath, os.path.basename(name))
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    async def WaitForChange(self, job, timeoutSec=None):
+        """
+        Waits until the state of a job changes (or the timeout expires).
+        """
+        timeout = None if timeoutSec is None else time.time() + timeoutSec
+        await job.changed.wait(timeout=timeout)
+
+    def __update(self, job, state):
+        job.state = state
+        job.changed.notify_all()
+
+    def __finish(self, job, detections, boxes=None, index=None):
+        job.detections = detections
+        job.boxes = boxes
+        job.index = index
+        job.finished = time.time()
+        self.activeJobs -= 1
+        self.__update(job, "failed" if job.error is not None else "done")
+        logger.info(f"Job {job.id} {job.state} in {job.finished - job.submitted:.2f} seconds ({self.activeJobs} active jobs)")
+
+        # Forget the oldest finished jobs (their results stay on disk)
+        finished = [j for j in self.jobs.values() if j.done]
+        for oldJob in finished[0:max(0, len(finished) - self.FINISHED_JOBS_KEPT)]:
+            del self.jobs[oldJob.id]
+
+    def __iterateTiles(self, job):
+        # Runs on a background thread (see ParallelScoring.ScoreImagesAsync); state changes are made on the IOLoop
+        self.ioLoop.add_callback(self.__update, job, "scoring")
+        try:
+            for tile in self.generateTiles(job.sourceImage):
+                job.tiles += 1
+                yield tile
+        except Exception as e:
+            logger.error(f"Failed to tile {job.sourceImage} for job {job.id}: {e}")
+            job.error = f"Failed to tile {os.path.basename(job.sourceImage)}: {e}"
+
+    async def __iterateImages(self):
+        async for job in self.__queue:
+            if job is None:
+                return
+            yield job.id, self.__iterateTiles(job)
+
+    def __onImageScored(self, jobId, scores):
+        # Runs on a background thread, so scoring carries on while the results are written
+        job = self.jobs[jobId]
+        detections, boxes, index = None, None, None
+        if job.error is None:
+            self.ioLoop.add_callback(self.__update, job, "writing")
+            try:
+                results = self.processScores(job.sourceImage, scores, job.outputPath)
+                detections = list(self.__records.GetRecords(job.sourceImage, results))
+
+                # The boxes are indexed for region queries (see JobDetectionsHandler)
+                boxes, index = results.boxes, IndexBoxes(results.boxes)
+            except Exception as e:
+                logger.error(f"Failed to write the results of job {job.id}: {e}")
+                job.error = f"Failed to write results: {e}"
+
+        if job.upload:
+            shutil.rmtree(os.path.dirname(job.sourceImage), ignore_errors=True)
+        self.ioLoop.add_callback(self.__finish, job, detections, boxes, index)
+
+    async def __scoreImages(self):
+        try:
+            await self.scoringMethod.ScoreImagesAsync(self.__iterateImages(), self.__onImageScored)
+        except Exception as e:
+            logger.error(f"Scoring stopped: {e}")
+        finally:
+            self.__stopped.set()
+
+    def Start(self):
+        """
+        Starts scoring submitted jobs on the current IOLoop.
+        """
+        self.ioLoop = ioloop.IOLoop.current()
+        self.ioLoop.spawn_callback(self.__scoreImages)
+
+    async def Stop(self):
+        """
+        Stops accepting work, and waits for the queued jobs to finish.
+        """
+        await self.__queue.put(None)
+        await self.__stopped.wait()
+
+    def MakeApplication(self):
+        """
+        Creates the Tornado application serving the job API.
+        """
+        return web.Application(self.GetHandlers())
+
+    def GetHandlers(self):
+        return [
+            (r"/jobs", JobsHandler, { "service": self }),
+            (r"/jobs/([0-9a-f]+)", JobHandler, { "service": self }),
+            (r"/jobs/([0-9a-f]+)/events", JobEventsHandler, { "service": self }),
+            (r"/jobs/([0-9a-f]+)/detections", JobDetectionsHandler, { "service": self }),
+        ]
+
+    def Listen(self, port, address="127.0.0.1"):
+        """
+        Starts listening for requests on the given port (on the current IOLoop).
+        """
+        app = self.MakeApplication()
+        logger.info(f"Scoring service listening on http://{address}:{port}/ (accepting up to {self.maxQueuedJobs} jobs)")
+        return app.listen(port, address)
+
+class ServiceHandler(web.RequestHandler):
+
+    def initialize(self, service):
+        self.service = service
+
+    def getJob(self, jobId):
+        job = self.service.jobs.get(jobId)
+        if job is None:
+            raise web.HTTPError(404, f"Unknown job {jobId}")
+        return job
+
+    def writeJson(self, value):
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(value))
+
+    def write_error(self, status_code, **kwargs):
+        error = kwargs.get("exc_info", (None, None))[1]
+        self.writeJson({ "error": getattr(error, "log_message", None) or self._reason })
+
+class JobsHandler(ServiceHandler):
+    """
+    POST /jobs submits a job: either a JSON body naming a source image on the service's filesystem
+    ({"sourceImage": "/data/image.tif"}), or the image data itself (with its content type, and optionally
+    ?name=image.jpg). Responds 202 with the job status, or 503 when the service is busy.
+    GET /jobs lists the jobs the service knows about.
+    """
+
+    def get(self):
+        self.writeJson({
+            "activeJobs": self.service.activeJobs,
+            "maxQueuedJobs": self.service.maxQueuedJobs,
+            "jobs": [job.GetStatus() for job in self.service.jobs.values()]
+        })
+
+    async def post(self):
+        if self.service.activeJobs >= self.service.maxQueuedJobs:
+            self.writeBusy()
+            return
+
+        contentType = self.request.headers.get("Content-Type", "").split(";")[0].strip()
+        if contentType == "application/json":
+            try:
+                sourceImage = json.loads(self.request.body.decode())["sourceImage"]
+            except (ValueError, KeyError, TypeError):
+                raise web.HTTPError(400, "Expected a JSON object with a 'sourceImage' path")
+            if not os.path.isfile(sourceImage):
+                raise web.HTTPError(400, f"Source image {sourceImage} does not exist")
+            jobId, upload = None, False
+        else:
+            if not self.request.body:
+                raise web.HTTPError(400, "Expected image data, or a JSON object with a 'sourceImage' path")
+            name = self.get_query_argument("name", "image" + UPLOAD_EXTENSIONS.get(contentType, ""))
+            jobId, upload = uuid.uuid4().hex, True
+            sourceImage = await ioloop.IOLoop.current().run_in_executor(None, self.service.SaveUpload, jobId, name, self.request.body)
+
+        try:
+            job = self.service.Submit(sourceImage, jobId, upload)
+        except ServiceBusyError:
+            # Became busy while the upload was being saved
+            if upload:
+                shutil.rmtree(os.path.dirname(sourceImage), ignore_errors=True)
+            self.writeBusy()
+            return
+
+        self.set_status(202)
+        self.set_header("Location", f"/jobs/{job.id}")
+        self.writeJson(job.GetStatus())
+
+    def writeBusy(self):
+        # Written directly rather than raised, since error responses drop any headers already set
+        self.set_status(503)
+        self.set_header("Retry-After", str(self.service.RETRY_AFTER_SEC))
+        self.writeJson({ "error": f"The service is busy ({self.service.activeJobs} jobs queued or running), retry later" })
+
+class JobHandler(ServiceHandler):
+    """
+    GET /jobs/{id} returns the status of a job. With ?wait=N, waits up to N seconds for the job to finish
+    (long polling).
+    """
+
+    async def get(self, jobId):
+        job = self.getJob(jobId)
+        try:
+            waitSec = min(float(self.get_query_argument("wait", 0)), self.service.MAX_WAIT_SEC)
+        except ValueError:
+            raise web.HTTPError(400, "Expected the number of seconds to wait")
+        deadline = time.time() + waitSec
+        while not job.done and time.time() < deadline:
+            await self.service.WaitForChange(job, deadline - time.time())
+        self.writeJson(job.GetStatus())
+
+class JobEventsHandler(ServiceHandler):
+    """
+    GET /jobs/{id}/events streams the status of a job (as JSON lines) each time it changes, until it finishes.
+    """
+
+    async def get(self, jobId):
+        job = self.getJob(jobId)
+        self.set_header("Content-Type", "application/x-ndjson")
+        while True:
+            self.write(json.dumps(job.GetStatus()) + "\n")
+            await self.flush()
+            if job.done:
+                return
+            await self.service.WaitForChange(job)
+
+class JobDetectionsHandler(ServiceHandler):
+    """
+    GET /jobs/{id}/detections waits for a job to finish, and streams its detections as JSON lines (see
+    DetectionsAsJsonLines). With ?bbox=x1,y1,x2,y2 (in source image pixels), only the detections overlapping that
+    region are returned, found through a spatial index of the job's boxes.
+    """
+    CHUNK_RECORDS = 1000
+
+    async def get(self, jobId):
+        job = self.getJob(jobId)
+        region = self.get_query_argument("bbox", None)
+        if region is not None:
+            try:
+                region = [float(v) for v in region.split(",")]
+            except ValueError:
+                region = None
+            if region is None or len(region) != 4:
+                raise web.HTTPError(400, "Expected a bbox of x1,y1,x2,y2 source image pixels")
+
+        while not job.done:
+            await self.service.WaitForChange(job)
+        if job.error is not None:
+            raise web.HTTPError(500, f"Job {jobId} failed: {job.error}")
+
+        records = job.detections
+        if region is not None:
+            records = [job.detections[i] for i in FindOverlapping(job.boxes, region, job.index).tolist()]
+
+        self.set_header("Content-Type", "application/x-ndjson")
+        for start in range(0, len(records), self.CHUNK_RECORDS):
+            chunk = records[start:start + self.CHUNK_RECORDS]
+            self.write("".join(json.dumps(record, separators=(",", ":")) + "\n" for record in chunk))
+            await self.flush()
@@ -4,6 +4,23 @@ import os
 
 logger = logging.getLogger("Settings")
 
+# Further prediction endpoints are configured in sections named CustomVisionService.<name>
+ENDPOINT_SECTION_PREFIX = "CustomVisionService."
+
+class EndpointSettings:
+    """
+    A prediction endpoint (Custom Vision prediction resource) that scoring requests can be sent to, with its
+    rate limit (requests per second, 0 for unlimited) and weight (its share of the requests).
+    """
+
+    def __init__(self, name, serviceEndpoint, predictionKey, predictionResourceId=None, requestsPerSecond=0.0, weight=1.0):
+        self.name = name
+        self.serviceEndpoint = serviceEndpoint
+        self.predictionKey = predictionKey
+        self.predictionResourceId = predictionResourceId
+        self.requestsPerSecond = requestsPerSecond
+        self.weight = weight
+
 class ConfigSettings:
     """
     Wraps access to a configuration file, allowing the storage to be swapped out as needed
@@ -12,12 +29,40 @@ class ConfigSettings:
     serviceEndpoint = None
     predictionKey = None
     predictionResourceId = None
+    requestsPerSecond = 0.0
+    endpointWeight = 1.0
     publishIterationName = None
     projectId = None
     boundingBoxScoreThreshold = 0.0
     tempFilePath = None
+    maxTilesInFlight = 32
+    nmsIouThreshold = 0.5
+    minConcurrency = 1
+    maxConcurrency = 32
+    latencyTargetSec = 2.0
+    maxRetries = 5
+    retryBaseDelaySec = 0.5
+    retryMaxDelaySec = 30.0
+    httpBackend = "auto"
+    predictionCachePath = None
+    predictionCacheMaxMB = 1024
+    minTileVariance = 4.0
+    minTileEntropy = 0.0
+    minTileEdgeDensity = 0.0
+    maxTileHashDistance = 4
+    coarseScoreThreshold = 10.0
+    refineMargin = 32
+    scoringBackend = "rest"
+    modelPath = None
+    inferenceBatchSize = 16
+    augmentUncertaintyBand = 15.0
+    uploadFormat = "tile"
+    uploadMaxSize = 0
+    uploadQuality = 90
+    workspacePath = None
 
     def __init__(self, file = None):
+        self.additionalEndpoints = []
         
         if file is None:
             logger.info("No conig file specified - creating default config.")
@@ -42,15 +87,97 @@ class ConfigSettings:
             self.predictionResourceId = customVisionSection["PredictionResourceId"]
             self.publishIterationName = customVisionSection["PublishIterationName"]
             self.projectId = customVisionSection["ProjectId"]
+            self.requestsPerSecond = customVisionSection.getfloat("RequestsPerSecond", self.requestsPerSecond)
+            self.endpointWeight = customVisionSection.getfloat("Weight", self.endpointWeight)
+
+            # The model iteration must be published to every endpoint, under the same name
+            for section in config.sections():
+                if section.startswith(ENDPOINT_SECTION_PREFIX):
+                    endpointSection = config[section]
+                    self.additionalEndpoints.append(EndpointSettings(
+                        section[len(ENDPOINT_SECTION_PREFIX):],
+                        endpointSection["ServiceEndpoint"],
+                        endpointSection["PredictionKey"],
+                        endpointSection.get("PredictionResourceId"),
+                        endpointSection.getfloat("RequestsPerSecond", 0.0),
+                        endpointSection.getfloat("Weight", 1.0)
+                    ))
 
             utilitySection = config["UtilityDefaults"]
             self.boundingBoxScoreThreshold = float(utilitySection["BoundingBoxScoreThreshold"])
             self.tempFilePath = utilitySection["TempFilePath"]
+            self.maxTilesInFlight = utilitySection.getint("MaxTilesInFlight", self.maxTilesInFlight)
+            self.nmsIouThreshold = utilitySection.getfloat("NmsIouThreshold", self.nmsIouThreshold)
+            self.minConcurrency = utilitySection.getint("MinConcurrency", self.minConcurrency)
+            self.maxConcurrency = utilitySection.getint("MaxConcurrency", self.maxConcurrency)
+            self.latencyTargetSec = utilitySection.getfloat("LatencyTargetSec", self.latencyTargetSec)
+            self.maxRetries = utilitySection.getint("MaxRetries", self.maxRetries)
+            self.retryBaseDelaySec = utilitySection.getfloat("RetryBaseDelaySec", self.retryBaseDelaySec)
+            self.retryMaxDelaySec = utilitySection.getfloat("RetryMaxDelaySec", self.retryMaxDelaySec)
+            self.httpBackend = utilitySection.get("HttpBackend", self.httpBackend)
+            self.predictionCachePath = utilitySection.get("PredictionCachePath", self.predictionCachePath)
+            self.predictionCacheMaxMB = utilitySection.getint("PredictionCacheMaxMB", self.predictionCacheMaxMB)
+            self.minTileVariance = utilitySection.getfloat("MinTileVariance", self.minTileVariance)
+            self.minTileEntropy = utilitySection.getfloat("MinTileEntropy", self.minTileEntropy)
+            self.minTileEdgeDensity = utilitySection.getfloat("MinTileEdgeDensity", self.minTileEdgeDensity)
+            self.maxTileHashDistance = utilitySection.getint("MaxTileHashDistance", self.maxTileHashDistance)
+            self.coarseScoreThreshold = utilitySection.getfloat("CoarseScoreThreshold", self.coarseScoreThreshold)
+            self.refineMargin = utilitySection.getint("RefineMargin", self.refineMargin)
+            self.scoringBackend = utilitySection.get("ScoringBackend", self.scoringBackend)
+            self.modelPath = utilitySection.get("ModelPath", self.modelPath)
+            self.inferenceBatchSize = utilitySection.getint("InferenceBatchSize", self.inferenceBatchSize)
+            self.augmentUncertaintyBand = utilitySection.getfloat("AugmentUncertaintyBand", self.augmentUncertaintyBand)
+            self.uploadFormat = utilitySection.get("UploadFormat", self.uploadFormat)
+            self.uploadMaxSize = utilitySection.getint("UploadMaxSize", self.uploadMaxSize)
+            self.uploadQuality = utilitySection.getint("UploadQuality", self.uploadQuality)
+            self.workspacePath = utilitySection.get("WorkspacePath", self.workspacePath)
     
+    def GetEndpoints(self):
+        """
+        Returns the prediction endpoints to score against: the one in the CustomVisionService section first,
+        followed by any CustomVisionService.<name> sections.
+        """
+        primary = EndpointSettings(
+            "default", 
+            self.serviceEndpoint, 
+            self.predictionKey, 
+            self.predictionResourceId, 
+            self.requestsPerSecond, 
+            self.endpointWeight
+        )
+        return [primary] + self.additionalEndpoints
+
     def DumpSettingsToLog(self):
         logger.info("Configured with the following settings:")
         logger.info(f"BoudingBoxScoreThreshold = {self.boundingBoxScoreThreshold}")
         logger.info(f"TempFilePath = {self.tempFilePath}")
+        logger.info(f"MaxTilesInFlight = {self.maxTilesInFlight}")
+        logger.info(f"NmsIouThreshold = {self.nmsIouThreshold}")
+        logger.info(f"MinConcurrency = {self.minConcurrency}")
+        logger.info(f"MaxConcurrency = {self.maxConcurrency}")
+        logger.info(f"LatencyTargetSec = {self.latencyTargetSec}")
+        logger.info(f"MaxRetries = {self.maxRetries}")
+        logger.info(f"RetryBaseDelaySec = {self.retryBaseDelaySec}")
+        logger.info(f"RetryMaxDelaySec = {self.retryMaxDelaySec}")
+        logger.info(f"HttpBackend = {self.httpBackend}")
+        logger.info(f"PredictionCachePath = {self.predictionCachePath}")
+        logger.info(f"PredictionCacheMaxMB = {self.predictionCacheMaxMB}")
+        logger.info(f"MinTileVariance = {self.minTileVariance}")
+        logger.info(f"MinTileEntropy = {self.minTileEntropy}")
+        logger.info(f"MinTileEdgeDensity = {self.minTileEdgeDensity}")
+        logger.info(f"MaxTileHashDistance = {self.maxTileHashDistance}")
+        logger.info(f"CoarseScoreThreshold = {self.coarseScoreThreshold}")
+        logger.info(f"RefineMargin = {self.refineMargin}")
+        logger.info(f"ScoringBackend = {self.scoringBackend}")
+        logger.info(f"ModelPath = {self.modelPath}")
+        logger.info(f"InferenceBatchSize = {self.inferenceBatchSize}")
+        logger.info(f"AugmentUncertaintyBand = {self.augmentUncertaintyBand}")
+        logger.info(f"UploadFormat = {self.uploadFormat}")
+        logger.info(f"UploadMaxSize = {self.uploadMaxSize}")
+        logger.info(f"UploadQuality = {self.uploadQuality}")
+        logger.info(f"WorkspacePath = {self.workspacePath}")
+        for endpoint in self.GetEndpoints():
+            logger.info(f"Endpoint {endpoint.name}: RequestsPerSecond = {endpoint.requestsPerSecond}, Weight = {endpoint.weight}")
         
         # NOTE we are redacting the Custom Vision service settings as to not end up with secrets 
         # in log streams.
\ No newline at end of file
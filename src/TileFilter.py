@@ -0,0 +1,115 @@
+import logging
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger("TileFilter")
+
+class InformativeTileFilter:
+    """
+    Cheap pre-scoring check that skips uninformative tiles (uniform sky or water, no-data padding, etc.) so
+    they don't cost a scoring request. Statistics are computed on a small grayscale thumbnail of each tile:
+
+    * variance of the pixel values,
+    * entropy (in bits) of the pixel value histogram,
+    * edge density, the fraction of pixels whose gradient magnitude exceeds EDGE_THRESHOLD.
+
+    A tile falling below any of the configured minimums is skipped (a minimum of 0 disables that check). Only the
+    variance check is enabled by default: a single small object on a uniform background (e.g. a ship at sea)
+    has a very low histogram entropy and edge density, but still a clearly non-zero variance. A
+    perceptual hash (dHash) of each skipped tile is also kept, and later tiles within maxHashDistance bits of
+    a skipped tile are skipped too, which catches repeats of the same uninformative content (e.g. noisy
+    no-data borders) that land just above the thresholds. Hashes with almost no structure (such as those of
+    flat tiles) are not remembered, since they would match any smooth tile. Skipped hashes and counts are kept
+    per source image (see Reset), so a filter can be shared by all the images a tiler goes through.
+    """
+    EDGE_THRESHOLD = 16
+    HASH_SIZE = 8
+
+    def __init__(self, minVariance=4.0, minEntropy=0.0, minEdgeDensity=0.0, maxHashDistance=4, thumbnailSize=128):
+        self.minVariance = minVariance
+        self.minEntropy = minEntropy
+        self.minEdgeDensity = minEdgeDensity
+        self.maxHashDistance = maxHashDistance
+        self.thumbnailSize = thumbnailSize
+        self.Reset()
+
+    def Reset(self):
+        """
+        Forgets the skipped tiles and counts, before the tiles of another source image are checked.
+        """
+        self.checked = 0
+        self.skipped = 0
+        self.__skippedHashes = []
+
+    def GetStatistics(self, image):
+        """
+        Returns the (variance, entropy, edgeDensity) statistics for a tile image.
+        """
+        thumbnail = image.convert("L")
+        thumbnail.thumbnail((self.thumbnailSize, self.thumbnailSize), Image.BILINEAR)
+        pixels = np.asarray(thumbnail, dtype=np.float32)
+
+        variance = float(pixels.var())
+
+        histogram = np.bincount(pixels.astype(np.uint8).ravel(), minlength=256)
+        probabilities = histogram[histogram > 0] / pixels.size
+        entropy = float(-(probabilities * np.log2(probabilities)).sum())
+
+        gradientX = np.abs(np.diff(pixels, axis=1))[:-1, :]
+        gradientY = np.abs(np.diff(pixels, axis=0))[:, :-1]
+        edgeDensity = float((np.hypot(gradientX, gradientY) > self.EDGE_THRESHOLD).mean()) if gradientX.size else 0.0
+
+        return variance, entropy, edgeDensity
+
+    def GetPerceptualHash(self, image):
+        """
+        Returns the 64 bit difference hash (dHash) of a tile image: whether each pixel of a tiny grayscale
+        version of the tile is brighter than its right-hand neighbour.
+        """
+        tiny = np.asarray(image.convert("L").resize((self.HASH_SIZE + 1, self.HASH_SIZE), Image.BILINEAR), dtype=np.int16)
+        bits = (tiny[:, 1:] > tiny[:, :-1]).ravel()
+        return int(np.packbits(bits).view(">u8")[0])
+
+    def GetSkipReason(self, statistics):
+        """
+        Returns why a tile with the given (variance, entropy, edgeDensity) statistics falls below the configured
+        minimums, or None if it doesn't.
+        """
+        variance, entropy, edgeDensity = statistics
+        if variance < self.minVariance:
+            return f"variance {variance:.1f}"
+        elif entropy < self.minEntropy:
+            return f"entropy {entropy:.2f}"
+        elif edgeDensity < self.minEdgeDensity:
+            return f"edge density {edgeDensity:.4f}"
+        return None
+
+    def Check(self, statistics, tileHash):
+        """
+        Checks whether a tile with the given statistics and perceptual hash is worth scoring, counting the tiles
+        that are skipped. Used directly when the statistics were computed elsewhere (e.g. in a tiling worker).
+        """
+        self.checked += 1
+
+        reason = self.GetSkipReason(statistics)
+        if reason is None:
+            for skippedHash in self.__skippedHashes:
+                if bin(tileHash ^ skippedHash).count("1") <= self.maxHashDistance:
+                    reason = "near-duplicate of a skipped tile"
+                    break
+
+        if reason is None:
+            return True
+
+        bitsSet = bin(tileHash).count("1")
+        if 2 * self.maxHashDistance < bitsSet < 64 - (2 * self.maxHashDistance) and tileHash not in self.__skippedHashes:
+            self.__skippedHashes.append(tileHash)
+        self.skipped += 1
+        logger.info(f"Skipping uninformative tile ({reason})")
+        return False
+
+    def IsInformative(self, image):
+        """
+        Checks whether a tile is worth scoring, counting the tiles that are skipped.
+        """
+        return self.Check(self.GetStatistics(image), self.GetPerceptualHash(image))
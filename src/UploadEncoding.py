@@ -0,0 +1,72 @@
+import io
+import logging
+from PIL import Image, features
+
+logger = logging.getLogger("UploadEncoding")
+
+UPLOAD_FORMATS = ("tile", "png", "jpeg", "webp")
+
+class UploadEncoder:
+    """
+    Re-encodes tiles before they are uploaded for scoring. Tiles are cut as uncompressed PNG (so tiling stays
+    cheap, and tiles written to disk are lossless), which is several MB per tile, while the prediction service
+    scales its input down to the model's resolution anyway. Tiles larger than maxSize (on their longest side,
+    0 to keep the tile size) are scaled down, keeping their aspect ratio, and encoded as:
+
+    * tile: as cut (uncompressed PNG), unless scaled down,
+    * png: optimized (compressed) PNG, still lossless,
+    * jpeg or webp: lossy, at the given quality (1 to 100).
+
+    The prediction API returns boxes relative to the image it was sent, so scaling a tile down needs no change
+    to how boxes are mapped back to tile (and source image) pixels.
+    """
+
+    def __init__(self, uploadFormat="tile", maxSize=0, quality=90):
+        if uploadFormat not in UPLOAD_FORMATS:
+            msg = f"Specified upload format {uploadFormat} is not supported (must be one of {', '.join(UPLOAD_FORMATS)})"
+            logger.error(msg)
+            raise Exception(msg)
+
+        if uploadFormat == "webp" and not features.check("webp"):
+            msg = "The webp upload format was requested, but Pillow was built without WebP support"
+            logger.error(msg)
+            raise Exception(msg)
+
+        if maxSize < 0 or not (1 <= quality <= 100):
+            msg = f"Specified upload size {maxSize} must not be negative, and quality {quality} must be from 1 to 100."
+            logger.error(msg)
+            raise Exception(msg)
+
+        self.uploadFormat = uploadFormat
+        self.maxSize = maxSize
+        self.quality = quality
+
+    @property
+    def enabled(self):
+        return self.uploadFormat != "tile" or self.maxSize > 0
+
+    def Encode(self, data):
+        """
+        Returns the payload to upload for an encoded tile: the tile as is when re-encoding doesn't make it any
+        smaller. Safe to call from several threads at once.
+        """
+        if not self.enabled:
+            return data
+
+        with Image.open(io.BytesIO(data)) as image:
+            image.load()
+            if self.maxSize > 0 and max(image.size) > self.maxSize:
+                image.thumbnail((self.maxSize, self.maxSize), Image.BILINEAR)
+
+            buffer = io.BytesIO()
+            if self.uploadFormat == "jpeg":
+                image.convert("RGB").save(buffer, format="JPEG", quality=self.quality)
+            elif self.uploadFormat == "webp":
+                image.save(buffer, format="WEBP", quality=self.quality)
+            elif self.uploadFormat == "png":
+                image.save(buffer, format="PNG", optimize=True)
+            else:
+                image.save(buffer, format="PNG", compress_level=0)
+
+        payload = buffer.getvalue()
+        return payload if len(payload) < len(data) else data
@@ -0,0 +1,72 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from ImageTiling import ReadTileFiles
+
+logger = logging.getLogger("Workspace")
+
+MANIFEST_NAME = "manifest.jsonl"
+
+class RunWorkspace:
+    """
+    A directory of its own for the tile files of a single run, created under a root directory that any number of
+    runs can share (TempFilePath, or WorkspacePath, e.g. on a tmpfs mount such as /dev/shm), so concurrent runs
+    on one host never score or delete each other's tiles. Each tile written is listed in a manifest (JSON lines,
+    appended as tiles are written), and tiles are read back for scoring from the manifest, in the order they
+    were written, rather than from whatever files are in the directory. Close removes the whole directory at
+    once; a run that dies leaves its workspace behind, which is safe to delete once no run is using it.
+    """
+
+    def __init__(self, rootPath):
+        if rootPath is None:
+            msg = "A workspace root (TempFilePath or WorkspacePath) must be configured to write tile files."
+            logger.error(msg)
+            raise Exception(msg)
+
+        # Workspace names are unique (and created atomically), whatever other runs are doing
+        os.makedirs(rootPath, exist_ok=True)
+        self.path = tempfile.mkdtemp(prefix=time.strftime("run-%Y%m%d-%H%M%S-"), dir=rootPath)
+        self.manifestPath = os.path.join(self.path, MANIFEST_NAME)
+        self.tiles = 0
+        self.__manifest = open(self.manifestPath, "w")
+        logger.info(f"Created run workspace {self.path}")
+
+    def WriteTile(self, sourceImage, name, data):
+        """
+        Writes an encoded tile of a source image to the workspace, and lists it in the manifest.
+        """
+        with open(os.path.join(self.path, name), mode="wb") as tileFile:
+            tileFile.write(data)
+        self.__manifest.write(json.dumps({ "source": sourceImage, "tile": name, "bytes": len(data) }) + "\n")
+        self.__manifest.flush()
+        self.tiles += 1
+
+    def GetTileNames(self):
+        """
+        Returns the names of the tiles listed in the manifest, in the order they were written.
+        """
+        with open(self.manifestPath, "r") as manifest:
+            return [json.loads(line)["tile"] for line in manifest if line.strip()]
+
+    def ReadTiles(self):
+        """
+        Yields the tiles listed in the manifest as Tile records (see ImageTiling.ReadTileFiles).
+        """
+        return ReadTileFiles(os.path.join(self.path, name) for name in self.GetTileNames())
+
+    def Close(self, keep=False):
+        """
+        Closes the manifest, and removes the workspace directory along with all its tiles, unless kept (e.g.
+        training tiles). Closing more than once is harmless.
+        """
+        if not self.__manifest.closed:
+            self.__manifest.close()
+        if keep:
+            logger.info(f"Kept {self.tiles} tiles in run workspace {self.path} (listed in {MANIFEST_NAME})")
+        elif os.path.isdir(self.path):
+            logger.info(f"Removing run workspace {self.path} ({self.tiles} tiles)...")
+            shutil.rmtree(self.path, ignore_errors=True)
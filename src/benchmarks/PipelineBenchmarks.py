@@ -0,0 +1,256 @@
+import argparse
+import logging
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root)
+
+from ImageTiling import SlidingWindowImageTiler
+from BoundingBoxes import CoordinateOperations
+from ResultsWriter import ImageWithBoundingBoxes, PreviewWithBoundingBoxes, DetectionsAsJsonLines
+from Settings import ConfigSettings
+from Workspace import RunWorkspace
+from SyntheticImages import createSourceImage
+
+# Peak RSS comes from getrusage, which isn't available on Windows
+try:
+    import resource
+except ImportError:
+    resource = None
+
+LOG_FORMAT="%(asctime)s: %(name)s - %(levelname)s - %(message)s"
+
+# Source images up to this size are JPEG (decoded whole by Pillow), larger ones memory mapped .npy rasters
+MAX_JPEG_SIZE = 8192
+
+# Timings differing by less than this are noise, whatever the ratio
+MIN_REGRESSION_SEC = 0.005
+
+logger = logging.getLogger("PipelineBenchmarks")
+
+def getPeakRssMB():
+    """
+    Returns the peak resident set size of this process so far, in MB (None where it can't be measured). On
+    Linux this is VmHWM, since getrusage's ru_maxrss is carried over from the parent process when a process is
+    spawned, and would report the parent's peak whenever it is higher.
+    """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def createScores(count, tileSize, columns=None, seed=0):
+    """
+    Returns count synthetic detections in the format returned by the scoring engine (see ModelScoring.CaptureResults),
+    on a grid of columns x columns square tiles of the given size (by default, about 100 detections to a tile).
+    """
+    rng = np.random.default_rng(seed)
+    columns = columns or max(1, int(np.ceil(np.sqrt(count / 100))))
+    tiles = rng.integers(0, columns, size=(count, 2))
+    origins = rng.uniform(0, tileSize - 64, size=(count, 2))
+    sizes = rng.uniform(8, 64, size=(count, 2))
+    values = rng.uniform(30, 100, size=count)
+    tags = ("ship", "plane", "vehicle")
+
+    return [
+        {
+            "name": f"tile_{row * columns + col + 1}_{row}_{col}_0.png",
+            "score": score,
+            "tag": tags[i % len(tags)],
+            "tileRow": row,
+            "tileColumn": col,
+            "angle": 0,
+            "boxes": [(x, y, x + w, y + h)]
+        }
+        for i, ((row, col), (x, y), (w, h), score) in enumerate(zip(tiles.tolist(), origins.tolist(), sizes.tolist(), values.tolist()))
+    ]
+
+# Stages of each kind of case, each timed in a process of its own (see runCase)
+IMAGE_STAGES = ("tile", "overlay", "preview")
+DETECTION_STAGES = ("remap", "nms", "jsonl")
+
+# Sizes benchmarked by default, and by '--profile full' (full scale source images and detection counts)
+PROFILES = {
+    "quick": { "imageSizes": [2048, 8192], "detectionCounts": [1000, 10000, 100000] },
+    "full": { "imageSizes": [2048, 8192, 30000], "detectionCounts": [1000, 10000, 100000, 1000000] }
+}
+
+def timeStage(case, stage, repeat, run, cleanup=None):
+    """
+    Runs a stage repeat times, returning the fastest run and the peak RSS of the process once it has run.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+        if cleanup is not None:
+            cleanup()
+    return { "case": case, "stage": stage, "seconds": min(timings), "peakRssMB": getPeakRssMB() }
+
+def runImageStage(stage, sourceImage, size, tileSize, boxCount, repeat, caseDir):
+    """
+    Times one stage on a synthetic source image of size x size pixels (see SyntheticImages.createSourceImage): tiling it to
+    tile files, or drawing boxCount boxes on the full resolution image or on its preview. Runs in a process
+    of its own (see runCase), so the peak RSS is that of the stage and of its inputs only.
+    """
+    case = f"image-{size}"
+    if stage == "tile":
+        tiler = SlidingWindowImageTiler(ConfigSettings(), tileSize, tileSize, 0, "pad")
+        workspaces = []
+
+        def createTiles():
+            workspaces.append(RunWorkspace(caseDir))
+            tiler.CreateTiles(sourceImage, False, workspaces[-1])
+
+        return timeStage(case, stage, repeat, createTiles, lambda: workspaces.pop().Close())
+
+    # Boxes spread over the whole image
+    coordinateOps = CoordinateOperations()
+    detections = coordinateOps.RemapDetections(tileSize, tileSize, coordinateOps.ScoresToDetections(
+        createScores(boxCount, tileSize, max(1, size // tileSize))
+    ))
+    outputDir = tempfile.mkdtemp(prefix=f"{stage}-", dir=caseDir)
+
+    if stage == "overlay":
+        boxes = detections.ToBoxList()
+        overlay = ImageWithBoundingBoxes()
+        overlayPath = overlay.GetOutputPath(outputDir, sourceImage)
+        return timeStage(case, stage, repeat, lambda: overlay.Write(sourceImage, boxes, overlayPath), lambda: os.remove(overlayPath))
+
+    preview = PreviewWithBoundingBoxes()
+    return timeStage(case, stage, repeat, lambda: preview.WriteDetections(sourceImage, detections, preview.GetOutputPath(outputDir, sourceImage)))
+
+def runDetectionStage(stage, count, tileSize, repeat, workDir):
+    """
+    Times one stage on count synthetic detections: re-mapping them to source image space, removing
+    duplicates, or writing them as JSON lines. Runs in a process of its own (see runCase).
+    """
+    case = f"detections-{count}"
+    scores = createScores(count, tileSize)
+    coordinateOps = CoordinateOperations()
+    if stage == "remap":
+        return timeStage(case, stage, repeat, lambda: coordinateOps.RemapBoundingBoxes(tileSize, tileSize, scores))
+
+    detections = coordinateOps.RemapDetections(tileSize, tileSize, coordinateOps.ScoresToDetections(scores))
+    del scores
+    if stage == "nms":
+        return timeStage(case, stage, repeat, lambda: coordinateOps.NonMaxSuppression(detections))
+
+    writer = DetectionsAsJsonLines()
+    outputPath = os.path.join(workDir, f"{case}.jsonl")
+    return timeStage(case, stage, repeat, lambda: writer.WriteDetections("source.jpg", detections, outputPath), lambda: os.remove(outputPath))
+
+def runCase(function, *args):
+    """
+    Runs a benchmark stage in a fresh process, so its peak RSS (a high-water mark for the whole process) is
+    not that of the stages run before it.
+    """
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(function, args)
+
+def compareWithBaseline(results, baseline, tolerance, rssTolerance):
+    """
+    Compares results with a baseline (results of an earlier run), returning a list of regressions: stages
+    slower than the baseline by more than tolerance (a fraction), or whose peak RSS is higher by more than
+    rssTolerance. Stages missing from the baseline are not compared.
+    """
+    baselineStages = { (b["case"], b["stage"]): b for b in baseline }
+    regressions = []
+    for r in results:
+        b = baselineStages.get((r["case"], r["stage"]))
+        if b is None:
+            r["baselineSeconds"] = None
+            continue
+
+        r["baselineSeconds"] = b["seconds"]
+        if r["seconds"] > b["seconds"] * (1 + tolerance) and r["seconds"] - b["seconds"] > MIN_REGRESSION_SEC:
+            regressions.append(f"{r['case']} {r['stage']}: {r['seconds']:.3f} sec, baseline {b['seconds']:.3f} sec")
+        if r["peakRssMB"] is not None and b.get("peakRssMB") is not None and r["peakRssMB"] > b["peakRssMB"] * (1 + rssTolerance):
+            regressions.append(f"{r['case']} {r['stage']}: peak RSS {r['peakRssMB']:.0f} MB, baseline {b['peakRssMB']:.0f} MB")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="CPU micro-benchmarks for tiling, re-mapping and writing results, on synthetic images and detections, compared against a baseline."
+    )
+    parser.add_argument("--profile", help="Sizes to benchmark: 'quick' (up to 8192 pixel images and 100000 detections), or 'full' (up to 30000 pixel images and 1000000 detections)", type=str, choices=sorted(PROFILES), default="quick")
+    parser.add_argument("--imageSizes", help="Sizes (in pixels, square images) of the synthetic source images. Overrides the profile.", type=int, nargs="*")
+    parser.add_argument("--detectionCounts", help="Numbers of synthetic detections. Overrides the profile.", type=int, nargs="*")
+    parser.add_argument("--tileSize", help="Tile size (in pixels, square tiles)", type=int, default=1024)
+    parser.add_argument("--overlayBoxes", help="Number of boxes drawn on the results images", type=int, default=1000)
+    parser.add_argument("--repeat", help="Number of times each stage is run (the fastest run is kept)", type=int, default=3)
+    parser.add_argument("--workDir", help="Directory synthetic images, tiles and results are written to (e.g. on tmpfs). Defaults to a temporary directory.", type=str)
+    parser.add_argument("--baseline", help="Baseline results (JSON) to compare with", type=str)
+    parser.add_argument("--updateBaseline", help="If present, writes the results to the baseline path instead of comparing with it", action="store_true")
+    parser.add_argument("--tolerance", help="Slowdown (as a fraction of the baseline time) counted as a regression", type=float, default=0.25)
+    parser.add_argument("--rssTolerance", help="Peak RSS increase (as a fraction of the baseline) counted as a regression", type=float, default=0.25)
+    parser.add_argument("--output", help="Optional path to write the results to (as JSON)", type=str)
+    args = parser.parse_args()
+
+    logging.basicConfig(format=LOG_FORMAT, level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+
+    if args.updateBaseline and not args.baseline:
+        raise Exception("'--updateBaseline' requires '--baseline'!!!")
+    imageSizes = args.imageSizes if args.imageSizes is not None else PROFILES[args.profile]["imageSizes"]
+    detectionCounts = args.detectionCounts if args.detectionCounts is not None else PROFILES[args.profile]["detectionCounts"]
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.workDir) as workDir:
+        for size in imageSizes:
+            logger.info(f"Benchmarking a {size}x{size} source image...")
+            caseDir = tempfile.mkdtemp(prefix=f"image-{size}-", dir=workDir)
+            sourceImage = os.path.join(caseDir, f"source-{size}.jpg" if size <= MAX_JPEG_SIZE else f"source-{size}.npy")
+            createSourceImage(sourceImage, size, size)
+            for stage in IMAGE_STAGES:
+                results.append(runCase(runImageStage, stage, sourceImage, size, args.tileSize, args.overlayBoxes, args.repeat, caseDir))
+        for count in detectionCounts:
+            logger.info(f"Benchmarking {count} detections...")
+            for stage in DETECTION_STAGES:
+                results.append(runCase(runDetectionStage, stage, count, args.tileSize, args.repeat, workDir))
+
+    regressions = []
+    if args.baseline and not args.updateBaseline:
+        with open(args.baseline, "r") as f:
+            regressions = compareWithBaseline(results, json.load(f), args.tolerance, args.rssTolerance)
+
+    print(f"{'case':>18} {'stage':>8} {'sec':>9} {'baseline':>9} {'change':>8} {'peak MB':>8}")
+    for r in results:
+        baselineSeconds = r.get("baselineSeconds")
+        baseline = f"{baselineSeconds:.3f}" if baselineSeconds else "-"
+        change = f"{(r['seconds'] / baselineSeconds - 1) * 100:+.0f}%" if baselineSeconds else "-"
+        peakRss = f"{r['peakRssMB']:.0f}" if r["peakRssMB"] is not None else "-"
+        print(f"{r['case']:>18} {r['stage']:>8} {r['seconds']:>9.3f} {baseline:>9} {change:>8} {peakRss:>8}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.updateBaseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"Wrote baseline {args.baseline}")
+
+    if regressions:
+        for regression in regressions:
+            logger.error(f"Regression: {regression}")
+        sys.exit(1)
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,148 @@
+import argparse
+import logging
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root)
+
+from ImageTiling import SlidingWindowImageTiler
+from ModelScoring import ParallelScoring
+from BoundingBoxes import CoordinateOperations
+from Settings import ConfigSettings
+from SyntheticImages import createSourceImage
+
+LOG_FORMAT="%(asctime)s: %(name)s - %(levelname)s - %(message)s"
+
+logger = logging.getLogger("ScoringThroughput")
+
+def startMockServer(args):
+    """
+    Starts the mock prediction server in a separate process (so it doesn't compete with the scoring engine for
+    the IOLoop), and waits until it accepts connections.
+    """
+    command = [
+        sys.executable, os.path.join(root, "MockPredictionServer.py"),
+        "--port", str(args.port),
+        "--latency", args.latency,
+        "--latencyMean", str(args.latencyMean),
+        "--latencyStdev", str(args.latencyStdev),
+        "--errorRate", str(args.errorRate),
+        "--throttleRate", str(args.throttleRate),
+        "--seed", "1"
+    ]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", args.port), timeout=0.5).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+
+    server.kill()
+    raise Exception(f"Mock prediction server did not start on port {args.port}")
+
+def runWorkload(args, sourceImage, tileSize, concurrency):
+    settings = ConfigSettings()
+    settings.serviceEndpoint = f"http://127.0.0.1:{args.port}/"
+    settings.predictionKey = "benchmark"
+    settings.projectId = "benchmark"
+    settings.publishIterationName = "benchmark"
+    settings.boundingBoxScoreThreshold = 30
+    settings.minConcurrency = concurrency
+    settings.maxConcurrency = concurrency
+    settings.httpBackend = args.httpBackend
+
+    # Same pipeline as 'main.py -s', minus writing the output image
+    tiler = SlidingWindowImageTiler(settings, tileSize, tileSize)
+    scoring = ParallelScoring(settings, tileSize, tileSize)
+    coordinateOps = CoordinateOperations()
+
+    start = time.time()
+    scores = scoring.ScoreTiles(tiler.GenerateTiles(sourceImage, False))
+    detections = coordinateOps.RemapDetections(tileSize, tileSize, coordinateOps.ScoresToDetections(scores))
+    detections = coordinateOps.NonMaxSuppression(detections, settings.nmsIouThreshold)
+    elapsed = time.time() - start
+    scoring.Close()
+
+    with Image.open(sourceImage) as im:
+        tiles = len(tiler.GetTileLayout(*im.size))
+    latencies = np.array(scoring.requestLatencies) * 1000
+
+    return {
+        "tileSize": tileSize,
+        "concurrency": concurrency,
+        "tiles": tiles,
+        "failedTiles": scoring.failedTileCount,
+        "requests": scoring.requestCount,
+        "detections": len(detections),
+        "seconds": elapsed,
+        "tilesPerSec": tiles / elapsed,
+        "latencyP50Ms": float(np.percentile(latencies, 50)) if latencies.size else None,
+        "latencyP95Ms": float(np.percentile(latencies, 95)) if latencies.size else None,
+        "latencyP99Ms": float(np.percentile(latencies, 99)) if latencies.size else None,
+        "bytesUploaded": scoring.bytesUploaded
+    }
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="End-to-end scoring throughput benchmark against a local mock of the Custom Vision prediction endpoint."
+    )
+    parser.add_argument("--sourceImage", help="Source image to score. If not given, a synthetic image is generated.", type=str)
+    parser.add_argument("--imageSize", help="Width and height (in pixels) of the synthetic source image", type=int, nargs=2, default=[8192, 8192])
+    parser.add_argument("--tileSizes", help="Tile sizes (in pixels, square tiles) to benchmark", type=int, nargs="+", default=[512, 1024])
+    parser.add_argument("--concurrency", help="Concurrency levels to benchmark", type=int, nargs="+", default=[4, 8, 16, 32])
+    parser.add_argument("--httpBackend", help="HTTP client backend for the scoring engine", choices=("auto", "curl", "simple"), default="auto")
+    parser.add_argument("--port", help="Port for the mock prediction server", type=int, default=18080)
+    parser.add_argument("--latency", help="Mock server latency distribution", type=str, default="lognormal")
+    parser.add_argument("--latencyMean", help="Mock server mean latency (in seconds)", type=float, default=0.2)
+    parser.add_argument("--latencyStdev", help="Mock server latency standard deviation (in seconds)", type=float, default=0.1)
+    parser.add_argument("--errorRate", help="Fraction of mock requests that fail with HTTP 500", type=float, default=0.0)
+    parser.add_argument("--throttleRate", help="Fraction of mock requests that are throttled with HTTP 429", type=float, default=0.0)
+    parser.add_argument("--output", help="Optional path to write the results to (as JSON)", type=str)
+    args = parser.parse_args()
+
+    logging.basicConfig(format=LOG_FORMAT, level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+
+    server = startMockServer(args)
+    try:
+        with tempfile.TemporaryDirectory() as tempDir:
+            sourceImage = args.sourceImage
+            if sourceImage is None:
+                sourceImage = os.path.join(tempDir, "source.jpg")
+                logger.info(f"Generating {args.imageSize[0]}x{args.imageSize[1]} synthetic source image...")
+                createSourceImage(sourceImage, args.imageSize[0], args.imageSize[1])
+
+            results = []
+            for tileSize in args.tileSizes:
+                for concurrency in args.concurrency:
+                    logger.info(f"Scoring with tile size {tileSize} and concurrency {concurrency}...")
+                    results.append(runWorkload(args, sourceImage, tileSize, concurrency))
+    finally:
+        server.terminate()
+        server.wait()
+
+    print(f"{'tile':>6} {'conc':>5} {'tiles':>6} {'failed':>6} {'sec':>8} {'tiles/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'MB up':>8}")
+    for r in results:
+        print(
+            f"{r['tileSize']:>6} {r['concurrency']:>5} {r['tiles']:>6} {r['failedTiles']:>6} {r['seconds']:>8.2f} {r['tilesPerSec']:>8.1f} "
+            f"{r['latencyP50Ms'] or 0:>8.1f} {r['latencyP95Ms'] or 0:>8.1f} {r['latencyP99Ms'] or 0:>8.1f} {r['bytesUploaded'] / 1e6:>8.1f}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,31 @@
+import numpy as np
+from PIL import Image
+
+# Rows of the source image generated at a time
+STRIP_HEIGHT = 1024
+
+def createSourceImage(path, width, height):
+    """
+    Writes a synthetic source image: smooth random blobs with some noise, so tiles compress like real imagery
+    rather than like pure noise. A path ending in .npy is written as a raw raster (see RasterReader) a strip
+    at a time, so very large images never have to fit in memory; anything else is saved whole with Pillow.
+    """
+    rng = np.random.default_rng(0)
+    coarse = rng.integers(0, 256, size=(max(1, height // 64) + 1, max(1, width // 64), 3), dtype=np.uint8)
+
+    def strip(top, bottom):
+        first, last = top // 64, (bottom + 63) // 64 + 1
+        rows = np.asarray(Image.fromarray(coarse[first:last]).resize((width, (last - first) * 64), Image.BILINEAR))
+        rows = rows[top - first * 64:][0:bottom - top]
+        noise = rng.integers(-8, 9, size=rows.shape)
+        return np.clip(rows.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+    if not path.endswith(".npy"):
+        Image.fromarray(strip(0, height)).save(path, quality=90)
+        return
+
+    raster = np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8, shape=(height, width, 3))
+    for top in range(0, height, STRIP_HEIGHT):
+        raster[top:min(height, top + STRIP_HEIGHT)] = strip(top, min(height, top + STRIP_HEIGHT))
+    raster.flush()
+    del raster
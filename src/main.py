@@ -1,16 +1,137 @@
 import argparse
+import atexit
+import cProfile, io, pstats
 import logging
 import glob, os
 
-from ImageTiling import DefaultImageTiler
+from tornado import ioloop
+
+from ImageTiling import DefaultImageTiler, SlidingWindowImageTiler
+from Instrumentation import recorder, SamplingProfiler
 from ModelScoring import ParallelScoring
+from LocalScoring import BatchedLocalScoring
+from PyramidScoring import CoarseToFineScoring
+from AugmentedScoring import AdaptiveAugmentedScoring
 from BoundingBoxes import CoordinateOperations
-from ResultsWriter import ImageWithBoundingBoxes
+from ResultsWriter import ImageWithBoundingBoxes, DetectionsAsJsonLines, PreviewWithBoundingBoxes, ProgressiveDetections
+from ScoringJournal import ScoringJournal
+from ScoringService import ScoringService
 from Settings import ConfigSettings
+from TileFilter import InformativeTileFilter
+from Workspace import RunWorkspace
 
 LOG_FORMAT="%(asctime)s: %(name)s - %(levelname)s - %(message)s"
 logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
 
+# Results that can be written for each scored source image (see '--outputs')
+RESULT_OUTPUTS = ("detections", "geojson", "preview", "overlay")
+
+# Files picked up when '--sourceImages' names a directory
+SOURCE_IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".tif", ".tiff", ".bmp", ".npy")
+
+def findSourceImages(sourceImages):
+    """
+    Expands the '--sourceImages' argument (a directory or a glob pattern) into a sorted list of image paths.
+    """
+    if os.path.isdir(sourceImages):
+        paths = [p for p in glob.glob(os.path.join(sourceImages, "*")) if p.lower().endswith(SOURCE_IMAGE_EXTENSIONS)]
+    else:
+        paths = glob.glob(sourceImages)
+    return sorted(p for p in paths if os.path.isfile(p))
+
+def createResultsWriters(args):
+    """
+    Creates the results writers selected with '--outputs'.
+    """
+    writers = {
+        "detections": lambda: DetectionsAsJsonLines(),
+        "geojson": lambda: DetectionsAsJsonLines(geoJson=True),
+        "preview": lambda: PreviewWithBoundingBoxes(args.previewSize, args.previewLevels),
+        "overlay": lambda: ImageWithBoundingBoxes()
+    }
+    return [(output, writers[output]()) for output in args.outputs]
+
+def startProfiling(args):
+    """
+    Starts the profiler selected with '--profile'; results are written to '--profileOutput' when the process exits.
+    """
+    if args.profile == "cprofile":
+        profile = cProfile.Profile()
+        profile.enable()
+
+        def writeProfile():
+            profile.disable()
+            profile.dump_stats(args.profileOutput)
+            summary = io.StringIO()
+            pstats.Stats(profile, stream=summary).sort_stats("cumulative").print_stats(20)
+            logging.info(f"Wrote cProfile statistics to {args.profileOutput}, top functions by cumulative time:\n{summary.getvalue()}")
+    else:
+        profile = SamplingProfiler()
+        profile.Start()
+
+        def writeProfile():
+            profile.Stop()
+            profile.Write(args.profileOutput)
+
+    atexit.register(writeProfile)
+
+def createProgressiveDetections(args, coordinateOps, resultsWriters, sourceImage, outputPath):
+    """
+    Creates the consumer of the detections of a source image as its tiles are scored (see ProgressiveDetections),
+    which writes partial detections when the 'detections' output is selected.
+    """
+    jsonWriter = dict(resultsWriters).get("detections")
+    return ProgressiveDetections(coordinateOps, args.tileHeight, args.tileWidth, sourceImage, jsonWriter, outputPath)
+
+def writeResults(args, settings, coordinateOps, resultsWriters, sourceImage, scores, outputPath):
+    """
+    Turns the tile scores of a single source image into final detections (see writeDetections), writes the
+    selected results to the output path, and returns the detections.
+    """
+
+    source = os.path.basename(sourceImage)
+
+    # Merge the rotated views of each tile before re-mapping
+    if args.augment:
+        with recorder.Span("fuse", source=source, boxes=len(scores)):
+            scores = coordinateOps.FuseAugmentedViews(
+                args.tileHeight, 
+                args.tileWidth, 
+                scores, 
+                scoreThreshold=settings.boundingBoxScoreThreshold
+            )
+    with recorder.Span("remap", source=source, boxes=len(scores)):
+        detections = coordinateOps.RemapDetections(
+            args.tileHeight, 
+            args.tileWidth, 
+            coordinateOps.ScoresToDetections(scores)
+        )
+
+    return writeDetections(args, settings, coordinateOps, resultsWriters, sourceImage, detections, outputPath)
+
+def writeDetections(args, settings, coordinateOps, resultsWriters, sourceImage, detections, outputPath, index=None):
+    """
+    Removes duplicates from the detections (in source image space) of a single source image, writes the selected
+    results to the output path, and returns the final detections. A spatial index of the detections built as
+    they were collected (see ProgressiveDetections) saves building one for removing duplicates.
+    """
+
+    source = os.path.basename(sourceImage)
+
+    # Remove duplicate detections across tiles
+    with recorder.Span("nms", source=source, boxes=len(detections)):
+        detections = coordinateOps.NonMaxSuppression(detections, settings.nmsIouThreshold, index)
+    if args.overlap is not None:
+        with recorder.Span("merge", source=source, boxes=len(detections)):
+            detections = coordinateOps.MergeSeamDuplicates(detections)
+
+    # Results files are named after the source image, in the outputPath dir
+    for output, resultsWriter in resultsWriters:
+        with recorder.Span("write" if output in ("detections", "geojson") else "draw", source=source, output=output):
+            resultsWriter.WriteDetections(sourceImage, detections, resultsWriter.GetOutputPath(outputPath, sourceImage))
+
+    return detections
+
 def main():
     parser = argparse.ArgumentParser(
         description="Utility to help with analysis of high-resolution images when using the Custom Vision API."
@@ -28,11 +149,39 @@ def main():
         help="If present, tiles the source image and scores against the Custom Vision API, generating a final image with object identification rectangles overlayed.", 
         action="store_true"
     )
+    group.add_argument(
+        "--serve", 
+        help="If present, runs as a long-running scoring service: source images are submitted over HTTP (see '--port') and scored as they arrive, with the results of each job written to its own directory in the output path.", 
+        action="store_true"
+    )
+    parser.add_argument(
+        "--port", 
+        help="The port the scoring service listens on (with '--serve')", 
+        type=int, 
+        default=8888
+    )
+    parser.add_argument(
+        "--address", 
+        help="The address the scoring service listens on (with '--serve'). Defaults to 127.0.0.1 (local clients only).", 
+        type=str, 
+        default="127.0.0.1"
+    )
+    parser.add_argument(
+        "--maxQueuedJobs", 
+        help="The number of jobs the scoring service accepts at a time (with '--serve'); further jobs are refused with HTTP 503 until some finish.", 
+        type=int, 
+        default=16
+    )
     parser.add_argument(
         "--sourceImage", 
         help="The path to the source image to create tiles from.", 
         type=str
     )
+    parser.add_argument(
+        "--sourceImages", 
+        help="A directory or glob pattern of source images to score in one batch (with '-s' or '--score'). Images are tiled and scored through one shared work queue, and each results image is written as soon as its image is scored.", 
+        type=str
+    )
     parser.add_argument(
         "--tileWidth", 
         help="The width (in pixels) of each output tile", 
@@ -49,52 +198,306 @@ def main():
         type=str, 
         default=""
     )
+    parser.add_argument(
+        "--outputs", 
+        help="The results to write for each scored image: 'detections' (JSON lines), 'geojson' (GeoJSON lines), 'preview' (downsampled image with the boxes drawn on it) and/or 'overlay' (the boxes drawn on the full resolution image, which is slow for large images).", 
+        choices=RESULT_OUTPUTS, 
+        nargs="+", 
+        default=["detections", "preview"]
+    )
+    parser.add_argument(
+        "--previewSize", 
+        help="The maximum width/height (in pixels) of the 'preview' output", 
+        type=int, 
+        default=2048
+    )
+    parser.add_argument(
+        "--previewLevels", 
+        help="The number of 'preview' images to write, each half the size of the previous one (an image pyramid)", 
+        type=int, 
+        default=1
+    )
+    parser.add_argument(
+        "--debugTiles", 
+        help="If present when scoring, tiles are written to a workspace of the run's own in the temporary file location and scored from disk (useful for debugging) instead of being streamed to the scoring engine in memory.", 
+        action="store_true"
+    )
+    parser.add_argument(
+        "--augment", 
+        help="If present when scoring, each tile is also scored rotated by 90, 180 and 270 degrees, and the detections from the 4 views are fused into a single set of boxes.", 
+        action="store_true"
+    )
+    parser.add_argument(
+        "--adaptiveAugment", 
+        help="If present when scoring, tiles are scored as they are first, and only tiles with detections close to the score threshold (see AugmentUncertaintyBand in the configuration file) are also scored rotated and fused, as with '--augment'.", 
+        action="store_true"
+    )
+    parser.add_argument(
+        "--overlap", 
+        help="If present, tiles overlap by this many pixels (using a sliding window), and source images of any size can be tiled. Duplicate detections along tile seams are merged.", 
+        type=int
+    )
+    parser.add_argument(
+        "--edgeMode", 
+        help="When using overlapping tiles, how to handle the last tile in each row/column: 'shift' moves it back inside the image, 'pad' fills the area outside the image with black.", 
+        choices=SlidingWindowImageTiler.EDGE_MODES, 
+        default="shift"
+    )
+    parser.add_argument(
+        "--skipUninformative", 
+        help="If present, tiles that are nearly uniform (e.g. sky, water or no-data padding) are skipped instead of being written/scored. Thresholds are set in the configuration file.", 
+        action="store_true"
+    )
+    parser.add_argument(
+        "--coarseFactor", 
+        help="If present when scoring, the source image is first scored reduced by this factor, and full resolution tiles are only scored around the boxes found (coarse-to-fine). Saves most requests for imagery with sparse objects.", 
+        type=int
+    )
+    parser.add_argument(
+        "--tilingWorkers", 
+        help="The number of worker processes used to crop, rotate and encode tiles (one row of tiles per task). Defaults to 1 (tiling in the main process).", 
+        type=int, 
+        default=1
+    )
+    parser.add_argument(
+        "--resume", 
+        help="If present when scoring, resumes an interrupted run: tiles already recorded in the scoring journal (scoring-journal.jsonl in the output path) are not scored again.", 
+        action="store_true"
+    )
+    parser.add_argument(
+        "--metricsPath", 
+        help="If present, the time spent in each pipeline stage (decode, crop, encode, queue, request, parse, remap, nms, draw, ...) is recorded, and a JSON run summary (run-summary.json) and Prometheus metrics (metrics.prom) are written to this directory when the run ends.", 
+        type=str
+    )
+    parser.add_argument(
+        "--profile", 
+        help="If present, profiles the run: 'cprofile' (deterministic, main thread only) or 'sampling' (samples the stacks of all threads, written as collapsed stacks for flame graphs).", 
+        choices=("cprofile", "sampling")
+    )
+    parser.add_argument(
+        "--profileOutput", 
+        help="The path to write the profile to (when using '--profile')", 
+        type=str, 
+        default="profile.out"
+    )
     args = parser.parse_args()
 
     logging.info("Starting tiling utility with the following arguments:")
     logging.info(f"train = {args.train}")
     logging.info(f"score = {args.score}")
+    logging.info(f"serve = {args.serve}")
+    logging.info(f"port = {args.port}")
+    logging.info(f"address = {args.address}")
+    logging.info(f"maxQueuedJobs = {args.maxQueuedJobs}")
     logging.info(f"sourceImage = {args.sourceImage}")
+    logging.info(f"sourceImages = {args.sourceImages}")
     logging.info(f"tileWidth = {args.tileWidth}") 
     logging.info(f"tileHeight = {args.tileHeight}")
     logging.info(f"outputPath = {args.outputPath}")
+    logging.info(f"outputs = {args.outputs}")
+    logging.info(f"previewSize = {args.previewSize}")
+    logging.info(f"previewLevels = {args.previewLevels}")
+    logging.info(f"debugTiles = {args.debugTiles}")
+    logging.info(f"augment = {args.augment}")
+    logging.info(f"adaptiveAugment = {args.adaptiveAugment}")
+    logging.info(f"overlap = {args.overlap}")
+    logging.info(f"edgeMode = {args.edgeMode}")
+    logging.info(f"skipUninformative = {args.skipUninformative}")
+    logging.info(f"coarseFactor = {args.coarseFactor}")
+    logging.info(f"tilingWorkers = {args.tilingWorkers}")
+    logging.info(f"resume = {args.resume}")
+    logging.info(f"metricsPath = {args.metricsPath}")
+    logging.info(f"profile = {args.profile}")
+
+    # Instrumentation is written when the process exits, so failed runs are covered too
+    if args.metricsPath is not None:
+        os.makedirs(args.metricsPath, exist_ok=True)
+        recorder.Enable()
+        atexit.register(recorder.WritePrometheusMetrics, os.path.join(args.metricsPath, "metrics.prom"))
+        atexit.register(recorder.WriteSummary, os.path.join(args.metricsPath, "run-summary.json"))
+    if args.profile is not None:
+        startProfiling(args)
 
     # Quick validation check
-    if args.score:
+    if args.score or args.serve:
         # Make sure we have the final output path available
         if args.outputPath == "":
             raise Exception("Missing '--outputPath' argument!!!")
 
+    if args.serve:
+        # Source images are submitted to the service, and tiles are always streamed
+        if args.sourceImage is not None or args.sourceImages is not None or args.debugTiles:
+            raise Exception("'--serve' can't be used with '--sourceImage', '--sourceImages' or '--debugTiles'!!!")
+
+    if args.sourceImages is not None:
+        # Batch mode only scores, and always streams tiles (one set of temporary tile files can't be shared)
+        if not args.score or args.debugTiles:
+            raise Exception("'--sourceImages' can only be used when scoring, without '--debugTiles'!!!")
+        if args.sourceImage is not None:
+            raise Exception("Use either '--sourceImage' or '--sourceImages', not both!!!")
+
+    if args.coarseFactor is not None:
+        # The coarse pass has to finish before the full resolution tiles are known, so only single images are supported
+        if not args.score or args.sourceImage is None or args.debugTiles:
+            raise Exception("'--coarseFactor' can only be used when scoring a single '--sourceImage', without '--debugTiles'!!!")
+
+    if args.adaptiveAugment:
+        # Rotated views are made in memory from streamed tiles, and only for the tiles that need them
+        if not args.score or args.debugTiles or args.augment:
+            raise Exception("'--adaptiveAugment' can only be used when scoring, without '--debugTiles' or '--augment'!!!")
+
     # Applicaiton services
     settings = ConfigSettings(os.path.abspath("./settings.cfg"))
-    tiler = DefaultImageTiler(settings, args.tileHeight, args.tileWidth)
-    scoringMethod = ParallelScoring(settings, args.tileWidth, args.tileHeight)
+    tileFilter = None
+    if args.skipUninformative:
+        tileFilter = InformativeTileFilter(
+            settings.minTileVariance, 
+            settings.minTileEntropy, 
+            settings.minTileEdgeDensity, 
+            settings.maxTileHashDistance
+        )
+
+    if args.overlap is None:
+        tiler = DefaultImageTiler(settings, args.tileHeight, args.tileWidth, tileFilter, args.tilingWorkers)
+    else:
+        tiler = SlidingWindowImageTiler(settings, args.tileHeight, args.tileWidth, args.overlap, args.edgeMode, tileFilter, args.tilingWorkers)
+    # Scored tiles are journaled as they arrive, so an interrupted run can be resumed. Journal entries are only
+    # reused for the same model (iteration, or exported model file) and tile size.
+    if settings.scoringBackend == "rest":
+        modelKey = f"{settings.projectId}/{settings.publishIterationName}"
+    else:
+        modelKey = f"{settings.scoringBackend}/{settings.modelPath}"
+    journal = None
+    if args.score:
+        journal = ScoringJournal(
+            os.path.join(args.outputPath, "scoring-journal.jsonl"), 
+            f"{modelKey}/{args.tileWidth}x{args.tileHeight}", 
+            args.resume
+        )
+        atexit.register(journal.Close)
+
+    # Tiles are scored through the Custom Vision prediction API, or locally with an exported model
+    if settings.scoringBackend == "rest":
+        scoringMethod = ParallelScoring(settings, args.tileWidth, args.tileHeight, journal)
+    else:
+        scoringMethod = BatchedLocalScoring(settings, args.tileWidth, args.tileHeight, journal)
     coordinateOps = CoordinateOperations()
-    resultsWriter = ImageWithBoundingBoxes()
+    resultsWriters = createResultsWriters(args)
 
     # Verify / dump settings
     settings.DumpSettingsToLog()
 
-    # Cleanup any leftover temp files
-    tiler.Cleanup()
+    # The scoring backend is closed however scoring ends, stopping its threads and connections
+    try:
+        # Service mode: score images as they are submitted, through the same scoring instance (and warm connections)
+        if args.serve:
+            service = ScoringService(
+                scoringMethod, 
+                lambda sourceImage: tiler.GenerateTiles(sourceImage, args.augment), 
+                lambda sourceImage, scores, outputPath: writeResults(args, settings, coordinateOps, resultsWriters, sourceImage, scores, outputPath), 
+                args.outputPath, 
+                args.maxQueuedJobs
+            )
+            service.Listen(args.port, args.address)
+            service.Start()
+            ioloop.IOLoop.current().start()
+            return
 
-    # Tile the input image
-    tiler.CreateTiles(
-        args.sourceImage, 
-        args.train
-    )
+        # Batch mode: tile image N+1 while the tiles of image N are still being scored, writing each results image
+        # as soon as its image is done
+        if args.sourceImages is not None:
+            sourceImages = findSourceImages(args.sourceImages)
+            logging.info(f"Found {len(sourceImages)} source images to score...")
+            images = ((sourceImage, tiler.GenerateTiles(sourceImage, args.augment)) for sourceImage in sourceImages)
+
+            # The rotated views of each tile have to be fused before re-mapping, so only then are scores collected
+            if args.augment:
+                scoringMethod.ScoreImages(
+                    images,
+                    lambda sourceImage, scores: writeResults(args, settings, coordinateOps, resultsWriters, sourceImage, scores, args.outputPath)
+                )
+                return
+
+            # Each image takes two passes with adaptive augmentation, so images are scored one after another
+            if args.adaptiveAugment:
+                adaptive = AdaptiveAugmentedScoring(settings, scoringMethod, tiler, coordinateOps)
+                for sourceImage, tiles in images:
+                    stream = createProgressiveDetections(args, coordinateOps, resultsWriters, sourceImage, args.outputPath)
+                    try:
+                        adaptive.ScoreTiles(sourceImage, tiles, stream.OnTileScored)
+                    except Exception as e:
+                        # As with other batches, an image that fails part way through is left with its partial detections file
+                        logging.error(f"{sourceImage} failed to score, only partial detections were written: {e}")
+                        stream.GetDetections()
+                        continue
+                    writeDetections(args, settings, coordinateOps, resultsWriters, sourceImage, stream.GetDetections(), args.outputPath, stream.store.index)
+                return
+
+            # Otherwise detections are re-mapped (and written to the partial detections file) as tiles are scored
+            streams = {}
+
+            def onTileScored(sourceImage, tile, detections):
+                if sourceImage not in streams:
+                    streams[sourceImage] = createProgressiveDetections(args, coordinateOps, resultsWriters, sourceImage, args.outputPath)
+                streams[sourceImage].OnTileScored(tile, detections)
+
+            def onImageScored(sourceImage, scores):
+                stream = streams.pop(sourceImage, None) or createProgressiveDetections(args, coordinateOps, resultsWriters, sourceImage, args.outputPath)
+                writeDetections(args, settings, coordinateOps, resultsWriters, sourceImage, stream.GetDetections(), args.outputPath, stream.store.index)
+
+            scoringMethod.ScoreImages(images, onImageScored, onTileScored=onTileScored)
+
+            # Images that failed to tile part way through are left with their partial detections files
+            for sourceImage, stream in streams.items():
+                logging.error(f"{sourceImage} failed to tile, only partial detections were written")
+                stream.GetDetections()
+            return
+
+        # File-based tiling is used for training, and for scoring when debugging tiles
+        useTileFiles = (not args.score) or args.debugTiles
+
+        if useTileFiles:
+            # Tiles are written to a workspace of this run's own, so any number of runs can share the temp file location
+            workspace = RunWorkspace(settings.workspacePath or settings.tempFilePath)
+            if args.score:
+                atexit.register(workspace.Close)
+
+            # Tile the input image
+            tiler.CreateTiles(
+                args.sourceImage, 
+                args.train or args.augment,
+                workspace
+            )
+            if args.train:
+                workspace.Close(keep=True)
 
-    # If scoring, run the scoring workflow
-    if args.score:        
-        scores = scoringMethod.ScoreTiles()
-        boxes = coordinateOps.RemapBoundingBoxes(args.tileHeight, args.tileWidth, scores)
+        # If scoring, run the scoring workflow
+        if args.score:        
+            if useTileFiles:
+                tiles = workspace.ReadTiles()
+            elif args.coarseFactor is not None:
+                pyramid = CoarseToFineScoring(settings, scoringMethod, tiler, coordinateOps, args.coarseFactor)
+                tiles = pyramid.GenerateTiles(args.sourceImage, args.augment)
+            else:
+                tiles = tiler.GenerateTiles(args.sourceImage, args.augment)
 
-        # The result / output file is named the same as the source image, but in the outputPath dir
-        resultFileName = os.path.join(args.outputPath, os.path.basename(args.sourceImage))
-        resultsWriter.Write(args.sourceImage, boxes, resultFileName)
+            # As in batch mode, detections are streamed unless the rotated views of each tile have to be fused
+            if args.augment:
+                scores = scoringMethod.ScoreTiles(tiles, args.sourceImage)
+                writeResults(args, settings, coordinateOps, resultsWriters, args.sourceImage, scores, args.outputPath)
+            else:
+                stream = createProgressiveDetections(args, coordinateOps, resultsWriters, args.sourceImage, args.outputPath)
+                if args.adaptiveAugment:
+                    AdaptiveAugmentedScoring(settings, scoringMethod, tiler, coordinateOps).ScoreTiles(args.sourceImage, tiles, stream.OnTileScored)
+                else:
+                    scoringMethod.ScoreTiles(tiles, args.sourceImage, stream.OnTileScored)
+                writeDetections(args, settings, coordinateOps, resultsWriters, args.sourceImage, stream.GetDetections(), args.outputPath, stream.store.index)
 
-        # Cleanup (only when scoring)
-        tiler.Cleanup()
+            # Cleanup (only when scoring), removing the whole workspace at once
+            if useTileFiles:
+                workspace.Close()
+    finally:
+        scoringMethod.Close()
 
 if __name__=='__main__':
     try:
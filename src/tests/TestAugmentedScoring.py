@@ -0,0 +1,98 @@
+import unittest
+import sys
+import os
+import threading
+import numpy as np
+from PIL import Image, ImageDraw
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root)
+
+from Settings import ConfigSettings
+from ImageTiling import DefaultImageTiler, Tile, EncodeTileImage
+from LocalScoring import BatchedLocalScoring
+from BoundingBoxes import CoordinateOperations
+from AugmentedScoring import AdaptiveAugmentedScoring
+
+def createTile(index, brightness):
+    image = Image.new("RGB", (800, 600))
+    if brightness > 0:
+        ImageDraw.Draw(image).rectangle((200, 100, 399, 299), fill=(brightness, brightness, brightness))
+    return Tile(f"tile_{index}_0_{index}_0.png", index, 0, index, 0, EncodeTileImage(image))
+
+class TestAdaptiveAugmentedScoring(unittest.TestCase):
+
+    def test_uncertain_tiles_only(self):
+        # The reference model scores bright areas by their brightness: 255 is confident (100), 210 is uncertain (~82)
+        config = ConfigSettings()
+        config.scoringBackend = "reference"
+        config.boundingBoxScoreThreshold = 80
+        config.augmentUncertaintyBand = 5
+        scoring = BatchedLocalScoring(config, 800, 600)
+        adaptive = AdaptiveAugmentedScoring(config, scoring, DefaultImageTiler(config, 600, 800), CoordinateOperations())
+
+        streamed = {}
+        tiles = [createTile(1, 255), createTile(2, 210), createTile(3, 0)]
+        adaptive.ScoreTiles("image", iter(tiles), lambda tile, detections: streamed.update({ tile.name: detections }))
+        scoring.Close()
+
+        # Only the uncertain tile is scored again, rotated 3 times, and its views are fused back into one box
+        self.assertEqual(scoring.scoredTiles, 6)
+        self.assertEqual(sorted(streamed), ["tile_1_0_1_0.png", "tile_2_0_2_0.png", "tile_3_0_3_0.png"])
+        self.assertEqual(len(streamed["tile_3_0_3_0.png"]), 0)
+        self.assertTrue(streamed["tile_1_0_1_0.png"].scores[0] > 99)
+
+        fused = streamed["tile_2_0_2_0.png"]
+        self.assertEqual(len(fused), 1)
+        self.assertTrue(80 < fused.scores[0] < 85)
+        self.assertEqual(fused.tiles.tolist(), [[0, 2, 0]])
+        np.testing.assert_allclose(fused.boxes[0], (200, 100, 400, 300), atol=3)
+
+    def test_overlapping_passes(self):
+        config = ConfigSettings()
+        config.scoringBackend = "reference"
+        config.boundingBoxScoreThreshold = 80
+        config.augmentUncertaintyBand = 5
+        config.inferenceBatchSize = 2
+        scoring = BatchedLocalScoring(config, 800, 600)
+        adaptive = AdaptiveAugmentedScoring(config, scoring, DefaultImageTiler(config, 600, 800), CoordinateOperations())
+
+        streamed = []
+        tiles = [createTile(1, 210)] + [createTile(i, 255) for i in range(2, 41)] + [createTile(41, 210)]
+        adaptive.ScoreTiles("image", iter(tiles), lambda tile, detections: streamed.append((tile, detections)))
+        scoring.Close()
+
+        # The rotated views of an uncertain tile are scored while the first pass is still going, and the tile is
+        # then only kept by position
+        names = [tile.name for tile, _ in streamed]
+        self.assertEqual(sorted(names), sorted(t.name for t in tiles))
+        self.assertLess(names.index("tile_1_0_1_0.png"), names.index("tile_40_0_40_0.png"))
+        self.assertEqual(streamed[names.index("tile_1_0_1_0.png")][0].data, b"")
+        self.assertEqual(scoring.scoredTiles, 47)
+
+    def test_failing_consumer(self):
+        config = ConfigSettings()
+        config.scoringBackend = "reference"
+        config.boundingBoxScoreThreshold = 80
+        config.augmentUncertaintyBand = 5
+        scoring = BatchedLocalScoring(config, 800, 600)
+        adaptive = AdaptiveAugmentedScoring(config, scoring, DefaultImageTiler(config, 600, 800), CoordinateOperations())
+
+        streamed = []
+        def onTileScored(tile, detections):
+            if tile.name == "tile_1_0_1_0.png":
+                raise Exception("Consumer failed")
+            streamed.append(tile.name)
+
+        # A consumer raising on a confident tile doesn't leave scoring waiting for that tile's first view
+        tiles = [createTile(1, 255), createTile(2, 210), createTile(3, 0)]
+        thread = threading.Thread(target=adaptive.ScoreTiles, args=("image", iter(tiles), onTileScored), daemon=True)
+        thread.start()
+        thread.join(30)
+        self.assertFalse(thread.is_alive())
+        scoring.Close()
+
+        self.assertEqual(sorted(streamed), ["tile_2_0_2_0.png", "tile_3_0_3_0.png"])
+
+if __name__ == '__main__':
+    unittest.main()
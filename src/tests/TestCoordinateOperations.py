@@ -6,7 +6,9 @@ import glob
 root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(root)
 
-from BoundingBoxes import CoordinateOperations
+import numpy as np
+from PIL import Image, ImageDraw
+from BoundingBoxes import CoordinateOperations, DetectionArray, DetectionStore, SpatialGridIndex, IndexBoxes, FindOverlapping
 
 class TestCoordinateOperations(unittest.TestCase):
 
@@ -65,5 +67,199 @@ class TestCoordinateOperations(unittest.TestCase):
         with self.assertRaises(Exception):
             x, y = methods.TranslateR4toR2(500, 0, 0, 0, 100, 100)
 
+    def test_rotation_inverse(self):
+        # Draw a box on a non-square tile, rotate the tile the same way the tiler does, and check that the
+        # box found on the rotated tile maps back to the original.
+        methods = CoordinateOperations()
+        box = (100, 50, 300, 150)
+        tile = Image.new("L", (800, 600))
+        ImageDraw.Draw(tile).rectangle((100, 50, 299, 149), fill=255)
+
+        for angle in (0, 90, 180, 270):
+            rotated = tile.rotate(angle, expand=(angle != 180))
+            self.assertEqual(box, methods.RotateBoxToTileSpace(800, 600, angle, rotated.getbbox()))
+
+        with self.assertRaises(Exception):
+            methods.RotateBoxToTileSpace(800, 600, 45, box)
+
+    def test_rotated_remap(self):
+        methods = CoordinateOperations()
+        scores = [
+            { "name": "tile_2_0_1_0.png", "score": 90, "tileRow": 0, "tileColumn": 1, "boxes": [(100, 50, 300, 150)] },
+            { "name": "tile_2_0_1_90.png", "score": 90, "tileRow": 0, "tileColumn": 1, "boxes": [(50, 500, 150, 700)] },
+        ]
+        boxes = methods.RemapBoundingBoxes(600, 800, scores)
+        self.assertEqual(boxes, [(900, 50, 1100, 150), (900, 50, 1100, 150)])
+
+    def test_augmented_view_fusion(self):
+        methods = CoordinateOperations()
+        scores = [
+            { "name": "tile_1_0_0_0.png", "score": 90, "tileRow": 0, "tileColumn": 0, "boxes": [(100, 50, 300, 150)] },
+            { "name": "tile_1_0_0_90.png", "score": 70, "tileRow": 0, "tileColumn": 0, "boxes": [(50, 500, 150, 700)] },
+            { "name": "tile_1_0_0_180.png", "score": 80, "tileRow": 0, "tileColumn": 0, "boxes": [(502, 452, 702, 552)] },
+            { "name": "tile_1_0_0_270.png", "score": 80, "tileRow": 0, "tileColumn": 0, "boxes": [(450, 100, 550, 300)] },
+            # Only seen in a single view, so it gets voted down
+            { "name": "tile_1_0_0_0.png", "score": 60, "tileRow": 0, "tileColumn": 0, "boxes": [(600, 400, 700, 500)] },
+        ]
+        fused = methods.FuseAugmentedViews(600, 800, scores, scoreThreshold=30)
+        self.assertEqual(len(fused), 1)
+        self.assertEqual(fused[0]["views"], 4)
+        self.assertAlmostEqual(fused[0]["score"], 80)
+        self.assertAlmostEqual(fused[0]["boxes"][0][0], 99.5)
+        self.assertEqual(fused[0]["name"], "tile_1_0_0_0.png")
+
+        fused = methods.FuseAugmentedViews(600, 800, scores)
+        self.assertEqual(len(fused), 2)
+        self.assertAlmostEqual(fused[1]["score"], 15)
+
+        # Boxes with different tags are never fused together, and the tag is kept
+        tagged = [dict(score, tag="defect" if score["score"] >= 80 else "scratch") for score in scores]
+        fused = methods.FuseAugmentedViews(600, 800, tagged)
+        self.assertEqual(sorted((f["tag"], f["views"]) for f in fused), [("defect", 3), ("scratch", 1), ("scratch", 1)])
+        self.assertEqual(methods.ScoresToDetections(fused).tags.tolist(), [f["tag"] for f in fused])
+
+    def test_vectorized_remap(self):
+        # The batch path must agree with the per-box scalar operations
+        methods = CoordinateOperations()
+        scores = []
+        for angle in (0, 90, 180, 270):
+            for row, col in ((0, 0), (1, 3), (4, 2)):
+                scores.append({
+                    "name": f"tile_1_{row}_{col}_{angle}.png", 
+                    "score": 50, 
+                    "boxes": [(10, 20, 110, 220), (300, 100, 400, 150)]
+                })
+
+        detections = methods.RemapDetections(600, 800, methods.ScoresToDetections(scores))
+        self.assertEqual(len(detections), 24)
+
+        expected = []
+        for score in scores:
+            _, _, row, col, angle = score["name"].split('.')[0].split('_')
+            for box in score["boxes"]:
+                x1, y1, x2, y2 = methods.RotateBoxToTileSpace(800, 600, int(angle), box)
+                x, y = methods.TranslateR4toR2(800, 600, int(col), int(row), x1, y1)
+                expected.append((x, y, x + (x2 - x1), y + (y2 - y1)))
+
+        self.assertEqual(detections.ToBoxList(), expected)
+        self.assertEqual(methods.RemapBoundingBoxes(600, 800, scores), expected)
+
+    def test_vectorized_remap_validation(self):
+        methods = CoordinateOperations()
+        detections = methods.ScoresToDetections([{ "name": "tile_1_0_0_0.png", "score": 50, "boxes": [(-10, 20, 110, 220)] }])
+        with self.assertRaises(Exception):
+            methods.RemapDetections(600, 800, detections)
+
+        detections = methods.ScoresToDetections([{ "name": "tile_1_0_0_0.png", "score": 50, "boxes": [(10, 20, 110, 220)] }])
+        with self.assertRaises(Exception):
+            methods.RemapDetections(0, 800, detections)
+
+        # No detections at all is fine
+        self.assertEqual(len(methods.RemapDetections(600, 800, methods.ScoresToDetections([]))), 0)
+
+    def test_non_max_suppression(self):
+        methods = CoordinateOperations()
+        detections = DetectionArray(
+            np.array([(0, 0, 100, 100), (5, 5, 105, 105), (200, 200, 300, 300), (0, 0, 100, 100)], dtype=np.float64),
+            np.zeros((4, 3), dtype=np.int64),
+            np.array([60, 90, 70, 30], dtype=np.float64)
+        )
+        kept = methods.NonMaxSuppression(detections, 0.5)
+        self.assertEqual(kept.ToBoxList(), [(5, 5, 105, 105), (200, 200, 300, 300)])
+        self.assertEqual(kept.scores.tolist(), [90, 70])
+
+        # A stricter threshold keeps overlapping boxes
+        self.assertEqual(len(methods.NonMaxSuppression(detections, 0.95)), 3)
+
+    def test_overlapping_tile_remap(self):
+        # Tiles with their pixel origin in the name are translated by that origin, not by row/col
+        methods = CoordinateOperations()
+        scores = [
+            { "name": "tile_2_0_1_0_896_0.png", "score": 90, "boxes": [(100, 50, 300, 150)] },
+            { "name": "tile_2_0_1_90_896_0.png", "score": 90, "boxes": [(50, 724, 150, 924)] },
+        ]
+        boxes = methods.RemapBoundingBoxes(1024, 1024, scores)
+        self.assertEqual(boxes, [(996, 50, 1196, 150), (996, 50, 1196, 150)])
+
+    def test_scaled_remap(self):
+        # Tiles cut from an image reduced 4 times are scaled back up to source image pixels
+        methods = CoordinateOperations()
+        scores = [{ "name": "tile_2_0_1_0_736_0.png", "score": 90, "boxes": [(10, 20, 30, 40)] }]
+        detections = methods.RemapDetections(600, 800, methods.ScoresToDetections(scores), scale=4)
+        self.assertEqual(detections.ToBoxList(), [(2984, 80, 3064, 160)])
+
+        with self.assertRaises(Exception):
+            methods.RemapDetections(600, 800, methods.ScoresToDetections(scores), scale=0)
+
+    def test_seam_merging(self):
+        methods = CoordinateOperations()
+        detections = DetectionArray(
+            np.array([(900, 100, 1024, 200), (900, 100, 1100, 200), (950, 120, 1000, 180), (2000, 0, 2100, 50)], dtype=np.float64),
+            np.array([(0, 0, 0), (0, 1, 0), (0, 0, 0), (0, 2, 0)], dtype=np.int64),
+            np.array([80, 70, 60, 50], dtype=np.float64)
+        )
+        merged = methods.MergeSeamDuplicates(detections)
+
+        # The cut-off box absorbs the whole box from the neighbouring tile, but not the box on its own tile
+        self.assertEqual(merged.ToBoxList(), [(900, 100, 1100, 200), (950, 120, 1000, 180), (2000, 0, 2100, 50)])
+        self.assertEqual(merged.scores.tolist(), [80, 60, 50])
+
+    def test_detection_store(self):
+        methods = CoordinateOperations()
+        store = DetectionStore()
+        self.assertEqual(len(store.ToDetections()), 0)
+
+        # Appending past the initial capacity keeps every detection, in order
+        expected = []
+        for i in range(300):
+            scores = [{ "name": f"tile_{i}_{i}_0_0.png", "score": i, "tag": f"tag-{i % 3}", "boxes": [(i, 0, i + 10, 10), (0, i, 10, i + 10)] }]
+            expected.extend(scores)
+            store.Append(methods.ScoresToDetections(scores))
+
+        detections = store.ToDetections()
+        reference = methods.ScoresToDetections(expected)
+        self.assertEqual(len(store), 600)
+        self.assertEqual(detections.ToBoxList(), reference.ToBoxList())
+        self.assertTrue(np.array_equal(detections.tiles, reference.tiles))
+        self.assertEqual(detections.tags.tolist(), reference.tags.tolist())
+        self.assertEqual(store.tagNames, ["tag-0", "tag-1", "tag-2"])
+
+    def test_spatial_grid_index(self):
+        random = np.random.RandomState(1)
+        origins = random.uniform(0, 5000, (2000, 2))
+        boxes = np.concatenate([origins, origins + random.uniform(1, 300, (2000, 2))], axis=1)
+
+        # The indexed store finds the same boxes as checking every box, whatever the size of the region
+        store = DetectionStore(256)
+        for start in range(0, 2000, 100):
+            store.Append(DetectionArray(boxes[start:start + 100], np.zeros((100, 3), dtype=np.int64), np.zeros(100)))
+        self.assertEqual(len(store.index), 2000)
+        for region in [(100, 100, 400, 300), (2560, 0, 2561, 5000), (-100, -100, 6000, 6000), (6000, 6000, 7000, 7000)]:
+            expected = FindOverlapping(boxes, region)
+            self.assertEqual(store.Query(region).tolist(), expected.tolist())
+            self.assertTrue(set(expected.tolist()) <= set(IndexBoxes(boxes).GetCandidates(region).tolist()))
+
+        # Non-max suppression gives the same result with the index built up by the store
+        detections = DetectionArray(boxes, np.zeros((2000, 3), dtype=np.int64), random.uniform(0, 100, 2000))
+        methods = CoordinateOperations()
+        self.assertEqual(methods.NonMaxSuppression(detections, 0.3, store.index).ToBoxList(), methods.NonMaxSuppression(detections, 0.3).ToBoxList())
+
+        with self.assertRaises(Exception):
+            SpatialGridIndex(0)
+
+    def test_cluster_detections(self):
+        methods = CoordinateOperations()
+        detections = DetectionArray(
+            np.array([(0, 0, 10, 10), (4, 0, 14, 10), (8, 0, 18, 10), (100, 100, 110, 110), (0, 0, 10, 10)], dtype=np.float64),
+            np.zeros((5, 3), dtype=np.int64),
+            np.array([90, 80, 70, 60, 50], dtype=np.float64),
+            tags=np.array(["ship", "ship", "ship", "ship", "plane"], dtype=object)
+        )
+
+        # Chains of neighbours form one cluster, while other tags and far away boxes are clusters of their own
+        self.assertEqual(methods.ClusterDetections(detections, 5).tolist(), [0, 0, 0, 1, 2])
+        self.assertEqual(methods.ClusterDetections(detections, 3).tolist(), [0, 1, 2, 3, 4])
+        self.assertEqual(len(methods.ClusterDetections(methods.ScoresToDetections([]), 5)), 0)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
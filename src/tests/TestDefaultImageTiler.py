@@ -1,13 +1,16 @@
 import unittest
 import sys
 import os
+import io
 import glob
 
 root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(root)
 
 from Settings import ConfigSettings
-from ImageTiling import DefaultImageTiler
+from PIL import Image
+import ImageTiling
+from ImageTiling import DefaultImageTiler, ParseTileName, InitTileWorker, CropTileRow
 
 class TestImageTiler(unittest.TestCase):
 
@@ -34,6 +37,72 @@ class TestImageTiler(unittest.TestCase):
         self.assertEqual(len(glob.glob("./samples/tempFiles/*.png")), 100)
         tiler.Cleanup()
 
+    def test_tile_streaming(self):
+        config = ConfigSettings()
+        config.tempFilePath = "./samples/tempFiles"
+        tiler = DefaultImageTiler(config, 600, 800);
+        tiles = list(tiler.GenerateTiles("./samples/test-1.jpg", False))
+        self.assertEqual(len(tiles), 25)
+        self.assertEqual(len(glob.glob("./samples/tempFiles/*.png")), 0)
+
+        # Streamed tiles carry the same naming/position info as the files on disk
+        self.assertEqual(tiles[6].name, "tile_7_1_1_0.png")
+        self.assertEqual((tiles[6].row, tiles[6].col, tiles[6].angle), (1, 1, 0))
+        self.assertEqual(Image.open(io.BytesIO(tiles[6].data)).size, (800, 600))
+
+    def test_parallel_tiling_matches_serial(self):
+        config = ConfigSettings()
+        config.tempFilePath = "./samples/tempFiles"
+        serial = list(DefaultImageTiler(config, 600, 800).GenerateTiles("./samples/test-1.jpg", True))
+        parallel = list(DefaultImageTiler(config, 600, 800, workerCount=3).GenerateTiles("./samples/test-1.jpg", True))
+        self.assertEqual(len(parallel), 100)
+        self.assertEqual(parallel, serial)
+
+    def test_parallel_tile_files(self):
+        config = ConfigSettings()
+        config.tempFilePath = "./samples/tempFiles"
+        tiler = DefaultImageTiler(config, 600, 800, workerCount=2)
+        tiler.CreateTiles("./samples/test-1.jpg", False)
+        tilePaths = glob.glob("./samples/tempFiles/*.png")
+        self.assertEqual(len(tilePaths), 25)
+
+        # Files written from the encoded tiles are identical to the ones written from the tile images
+        with open("./samples/tempFiles/tile_7_1_1_0.png", "rb") as tileFile:
+            data = tileFile.read()
+        tiler.Cleanup()
+        DefaultImageTiler(config, 600, 800).CreateTiles("./samples/test-1.jpg", False)
+        with open("./samples/tempFiles/tile_7_1_1_0.png", "rb") as tileFile:
+            self.assertEqual(tileFile.read(), data)
+        tiler.Cleanup()
+
+    def test_worker_decode_time(self):
+        # Each worker reports the time it took to decode the source image, with the first row it crops
+        InitTileWorker("./samples/test-1.jpg")
+        try:
+            decodeSec, results = CropTileRow([(1, 0, 0, 0, 0)], 800, 600, False, None)
+            self.assertGreater(decodeSec, 0)
+            self.assertEqual(len(results), 1)
+            self.assertIsNone(CropTileRow([(2, 0, 1, 800, 0)], 800, 600, False, None)[0])
+        finally:
+            ImageTiling.workerSourceReader.Close()
+            ImageTiling.workerSourceReader = None
+
+    def test_region_tiling(self):
+        config = ConfigSettings()
+        config.tempFilePath = "./samples/tempFiles"
+        regions = [(900, 700, 1000, 800), (3990, 2990, 4100, 3100)]
+        serial = list(DefaultImageTiler(config, 600, 800).GenerateTiles("./samples/test-1.jpg", False, regions))
+        parallel = list(DefaultImageTiler(config, 600, 800, workerCount=2).GenerateTiles("./samples/test-1.jpg", False, regions))
+
+        # Only the tiles overlapping the regions are produced, named as when tiling the whole image
+        self.assertEqual([t.name for t in serial], ["tile_7_1_1_0.png", "tile_25_4_4_0.png"])
+        self.assertEqual(parallel, serial)
+
+    def test_tile_name_parsing(self):
+        self.assertEqual(ParseTileName("tile_7_1_2_90.png"), (7, 1, 2, 90, None, None))
+        self.assertEqual(ParseTileName("./samples/tempFiles/tile_7_1_2_90.png"), (7, 1, 2, 90, None, None))
+        self.assertEqual(ParseTileName("tile_7_1_2_90_1792_896.png"), (7, 1, 2, 90, 1792, 896))
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,95 @@
+import unittest
+import sys
+import os
+import json
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root)
+
+from Instrumentation import SpanRecorder, SamplingProfiler, NULL_SPAN
+
+class TestInstrumentation(unittest.TestCase):
+
+    def test_disabled_recorder(self):
+        recorder = SpanRecorder()
+        self.assertIs(recorder.Span("encode", tile="tile_1_0_0_0.png"), NULL_SPAN)
+        with recorder.Span("encode"):
+            pass
+        recorder.Record("request", 0.5)
+        recorder.Increment("requests")
+        self.assertEqual(recorder.GetSummary(), { "stages": {}, "counters": {} })
+
+    def test_summary(self):
+        recorder = SpanRecorder()
+        recorder.Enable()
+        for i in range(10):
+            recorder.Record("request", (i + 1) / 10, tile=f"tile_{i}_0_0_0.png")
+        with recorder.Span("encode", tile="tile_1_0_0_0.png"):
+            time.sleep(0.01)
+        recorder.Increment("bytes_uploaded", 100)
+        recorder.Increment("bytes_uploaded", 50)
+
+        summary = recorder.GetSummary()
+        self.assertEqual(summary["counters"], { "bytes_uploaded": 150 })
+        self.assertEqual(summary["stages"]["request"]["count"], 10)
+        self.assertAlmostEqual(summary["stages"]["request"]["totalSec"], 5.5)
+        self.assertAlmostEqual(summary["stages"]["request"]["quantilesSec"]["0.5"], 0.55)
+
+        # The slowest spans keep their attributes, so slow tiles can be tracked down
+        self.assertEqual(summary["stages"]["request"]["slowest"][0], { "tile": "tile_9_0_0_0.png", "durationSec": 1.0 })
+        self.assertGreaterEqual(summary["stages"]["encode"]["maxSec"], 0.01)
+
+    def test_bounded_spans(self):
+        recorder = SpanRecorder()
+        recorder.SPAN_SAMPLES_KEPT = 100
+        recorder.Enable()
+        for i in range(1000):
+            recorder.Record("request", (i % 500 + 1) / 1000, tile=f"tile_{i}_0_0_0.png")
+
+        # Only the most recent durations are kept for quantiles, while counts and totals cover every span
+        self.assertEqual(len(recorder.stages["request"].durations), 100)
+        self.assertEqual(len(recorder.stages["request"].slowest), recorder.SLOWEST_SPANS)
+        stats = recorder.GetSummary()["stages"]["request"]
+        self.assertEqual(stats["count"], 1000)
+        self.assertAlmostEqual(stats["totalSec"], 250.5)
+        self.assertAlmostEqual(stats["maxSec"], 0.5)
+        self.assertAlmostEqual(stats["quantilesSec"]["0.5"], 0.4505)
+        self.assertEqual([s["durationSec"] for s in stats["slowest"][0:2]], [0.5, 0.5])
+
+    def test_output_files(self):
+        recorder = SpanRecorder()
+        recorder.Enable()
+        recorder.Record("nms", 0.25, source="test-1.jpg")
+        recorder.Increment("tiles_scored", 3)
+
+        recorder.WriteSummary("./samples/tempFiles/run-summary.json")
+        with open("./samples/tempFiles/run-summary.json") as f:
+            self.assertEqual(json.load(f)["stages"]["nms"]["count"], 1)
+
+        recorder.WritePrometheusMetrics("./samples/tempFiles/metrics.prom")
+        with open("./samples/tempFiles/metrics.prom") as f:
+            lines = f.read().splitlines()
+        self.assertIn('cvscoring_stage_seconds_sum{stage="nms"} 0.25', lines)
+        self.assertIn('cvscoring_stage_seconds_count{stage="nms"} 1', lines)
+        self.assertIn("cvscoring_tiles_scored_total 3", lines)
+
+        os.remove("./samples/tempFiles/run-summary.json")
+        os.remove("./samples/tempFiles/metrics.prom")
+
+    def test_sampling_profiler(self):
+        profiler = SamplingProfiler(intervalSec=0.001)
+        profiler.Start()
+        deadline = time.time() + 0.2
+        while time.time() < deadline:
+            sum(range(1000))
+        profiler.Stop()
+
+        self.assertTrue(any("test_sampling_profiler" in stack for stack in profiler.samples))
+        profiler.Write("./samples/tempFiles/profile.folded")
+        with open("./samples/tempFiles/profile.folded") as f:
+            self.assertTrue(f.readline().rsplit(" ", 1)[1].strip().isdigit())
+        os.remove("./samples/tempFiles/profile.folded")
+
+if __name__ == '__main__':
+    unittest.main()
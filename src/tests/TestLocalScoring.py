@@ -0,0 +1,172 @@
+import unittest
+import sys
+import os
+import tempfile
+import numpy as np
+from PIL import Image, ImageDraw
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root)
+
+from Settings import ConfigSettings
+from ImageTiling import Tile, EncodeTileImage
+from LocalScoring import BatchedLocalScoring, ResizeBatch, onnxruntime
+from ScoringJournal import ScoringJournal
+
+# Exported models are built on the fly for the ONNX test, which requires the onnx package
+try:
+    import onnx
+    from onnx import helper, TensorProto
+except ImportError:
+    onnx = None
+
+def createTile(name, angle=0, box=None, color=(255, 255, 255)):
+    size = (600, 800) if angle in (90, 270) else (800, 600)
+    image = Image.new("RGB", size)
+    if box is not None:
+        ImageDraw.Draw(image).rectangle(box, fill=color)
+    _, index, row, col, _ = name.split(".")[0].split("_")
+    return Tile(name, int(index), int(row), int(col), angle, EncodeTileImage(image))
+
+class TestLocalScoring(unittest.TestCase):
+
+    def __createScoring(self, backend="reference", modelPath=None, journal=None):
+        config = ConfigSettings()
+        config.scoringBackend = backend
+        config.modelPath = modelPath
+        config.inferenceBatchSize = 2
+        config.boundingBoxScoreThreshold = 30
+        return BatchedLocalScoring(config, 800, 600, journal)
+
+    def test_batched_scoring(self):
+        scoring = self.__createScoring()
+        tiles = [
+            createTile("tile_1_0_0_0.png", box=(200, 150, 399, 299)),
+            createTile("tile_2_0_1_0.png"),
+            createTile("tile_3_0_2_90.png", angle=90, box=(0, 0, 299, 199)),
+        ]
+        scores = sorted(scoring.ScoreTiles(iter(tiles)), key=lambda s: s["name"])
+        scoring.Close()
+
+        # Tiles are scored 2 at a time (rotated tiles included), giving the same score dicts as the API backend
+        self.assertEqual(scoring.batches, 2)
+        self.assertEqual([s["name"] for s in scores], ["tile_1_0_0_0.png", "tile_3_0_2_90.png"])
+        self.assertEqual((scores[0]["tag"], scores[0]["tileRow"], scores[0]["tileColumn"], scores[0]["angle"]), ("bright", 0, 0, 0))
+        self.assertTrue(scores[0]["score"] > 99)
+        np.testing.assert_allclose(scores[0]["boxes"][0], (200, 150, 400, 300), atol=3)
+        np.testing.assert_allclose(scores[1]["boxes"][0], (0, 0, 300, 200), atol=3)
+
+    def test_score_images_and_resume(self):
+        journalPath = "./samples/tempFiles/local-scoring-journal.jsonl"
+        images = [
+            ("image-1", [createTile("tile_1_0_0_0.png", box=(0, 0, 99, 99)), createTile("tile_2_0_1_0.png", box=(0, 0, 99, 99))]),
+            ("image-2", []),
+            ("image-3", [createTile("tile_1_0_0_0.png", box=(700, 500, 799, 599))]),
+        ]
+        journal = ScoringJournal(journalPath, "run")
+        scoring = self.__createScoring(journal=journal)
+        completed = {}
+        scoring.ScoreImages(((key, iter(tiles)) for key, tiles in images), lambda key, scores: completed.update({ key: scores }))
+        journal.Close()
+
+        # Every image is reported once, and the last partial batch of an image doesn't wait for the next image
+        self.assertEqual(sorted(completed), ["image-1", "image-2", "image-3"])
+        self.assertEqual((len(completed["image-1"]), len(completed["image-2"]), len(completed["image-3"])), (2, 0, 1))
+        self.assertEqual(scoring.batches, 2)
+
+        # Resuming takes every tile from the journal
+        journal = ScoringJournal(journalPath, "run", resume=True)
+        resumed = self.__createScoring(journal=journal)
+        self.assertEqual(resumed.ScoreTiles(iter(images[2][1]), "image-3"), completed["image-3"])
+        self.assertEqual((resumed.resumedTiles, resumed.batches), (1, 0))
+        journal.Close()
+        os.remove(journalPath)
+
+    def test_score_images_with_failing_image(self):
+        def failingTiles():
+            yield createTile("tile_1_0_0_0.png", box=(0, 0, 99, 99))
+            raise Exception("corrupt image")
+
+        images = [
+            ("image-1", iter([createTile("tile_1_0_0_0.png", box=(0, 0, 99, 99))])),
+            ("image-2", failingTiles()),
+            ("image-3", iter([createTile("tile_1_0_0_0.png", box=(700, 500, 799, 599))])),
+        ]
+        scoring = self.__createScoring()
+        completed = {}
+        scoring.ScoreImages(iter(images), lambda key, scores: completed.update({ key: scores }))
+        scoring.Close()
+
+        # The image that fails to tile is skipped, and the images after it are still scored
+        self.assertEqual(sorted(completed), ["image-1", "image-3"])
+        self.assertEqual(len(completed["image-3"]), 1)
+
+    def test_resize_batch(self):
+        pixels = np.random.RandomState(1).randint(0, 256, (3, 60, 80, 3)).astype(np.uint8)
+        self.assertTrue(np.array_equal(ResizeBatch(pixels, 80, 60), pixels))
+
+        # Each image is resized the same way as on its own, and flat areas stay flat
+        resized = ResizeBatch(pixels, 32, 24)
+        self.assertEqual(resized.shape, (3, 24, 32, 3))
+        np.testing.assert_allclose(resized[1:2], ResizeBatch(pixels[1:2], 32, 24))
+        np.testing.assert_allclose(ResizeBatch(np.full((1, 60, 80, 3), 7, np.uint8), 320, 320), 7)
+
+    def test_unknown_backend(self):
+        with self.assertRaises(Exception):
+            self.__createScoring("tensorflow")
+        with self.assertRaises(Exception):
+            self.__createScoring("onnx", "./missing.onnx")
+
+    @unittest.skipIf(onnxruntime is None or onnx is None, "onnxruntime and onnx are not installed")
+    def test_onnx_model(self):
+        # A stand-in for an exported model, with a dynamic batch size: a fixed box for every image, scored by the
+        # mean of its first (blue, as models take BGR input) channel
+        graph = helper.make_graph(
+            [
+                helper.make_node("Slice", ["image_tensor", "starts", "ends", "axes"], ["blue"]),
+                helper.make_node("ReduceMean", ["blue"], ["mean"], axes=[1, 2, 3], keepdims=0),
+                helper.make_node("Div", ["mean", "scale"], ["score"]),
+                helper.make_node("Unsqueeze", ["score", "one"], ["detected_scores"]),
+                helper.make_node("Mul", ["detected_scores", "zero"], ["zeros"]),
+                helper.make_node("Unsqueeze", ["zeros", "two"], ["zeros3"]),
+                helper.make_node("Add", ["zeros3", "box"], ["detected_boxes"]),
+                helper.make_node("Cast", ["zeros"], ["detected_classes"], to=TensorProto.INT64),
+            ],
+            "model",
+            [helper.make_tensor_value_info("image_tensor", TensorProto.FLOAT, [None, 3, 32, 32])],
+            [
+                helper.make_tensor_value_info("detected_boxes", TensorProto.FLOAT, [None, 1, 4]),
+                helper.make_tensor_value_info("detected_scores", TensorProto.FLOAT, [None, 1]),
+                helper.make_tensor_value_info("detected_classes", TensorProto.INT64, [None, 1]),
+            ],
+            [
+                helper.make_tensor("starts", TensorProto.INT64, [1], [0]),
+                helper.make_tensor("ends", TensorProto.INT64, [1], [1]),
+                helper.make_tensor("axes", TensorProto.INT64, [1], [1]),
+                helper.make_tensor("scale", TensorProto.FLOAT, [], [255.0]),
+                helper.make_tensor("zero", TensorProto.FLOAT, [], [0.0]),
+                helper.make_tensor("one", TensorProto.INT64, [1], [1]),
+                helper.make_tensor("two", TensorProto.INT64, [1], [2]),
+                helper.make_tensor("box", TensorProto.FLOAT, [1, 1, 4], [0.1, 0.2, 0.5, 0.6]),
+            ]
+        )
+        model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)], ir_version=8)
+
+        with tempfile.TemporaryDirectory() as modelDir:
+            modelPath = os.path.join(modelDir, "model.onnx")
+            onnx.save(model, modelPath)
+            with open(os.path.join(modelDir, "labels.txt"), "w") as labels:
+                labels.write("ship\n")
+
+            scoring = self.__createScoring("onnx", modelPath)
+            tiles = [createTile(f"tile_{i}_0_{i}_0.png", box=(0, 0, 799, 599), color=(0, 0, 255 if i % 2 else 0)) for i in range(1, 6)]
+            scores = sorted(scoring.ScoreTiles(iter(tiles)), key=lambda s: s["name"])
+            scoring.Close()
+
+        self.assertEqual([s["name"] for s in scores], ["tile_1_0_1_0.png", "tile_3_0_3_0.png", "tile_5_0_5_0.png"])
+        self.assertEqual(scores[0]["tag"], "ship")
+        self.assertAlmostEqual(scores[0]["score"], 100, places=3)
+        np.testing.assert_allclose(scores[0]["boxes"][0], (80, 120, 400, 360))
+
+if __name__ == '__main__':
+    unittest.main()
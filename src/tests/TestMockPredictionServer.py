@@ -0,0 +1,96 @@
+import unittest
+import sys
+import os
+import tempfile
+from PIL import Image
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root)
+
+from tornado import testing
+from Settings import ConfigSettings
+from ImageTiling import Tile, EncodeTileImage
+from ModelScoring import ParallelScoring
+from MockPredictionServer import MockPredictionServer
+
+class TestMockPredictionServer(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.server = MockPredictionServer(latencyMeanSec=0.0, predictionsPerTile=5, predictionKey="key", seed=1)
+        return self.server.MakeApplication()
+
+    def __createScoring(self, predictionKey="key", predictionCachePath=None, uploadFormat="tile", uploadMaxSize=0):
+        config = ConfigSettings()
+        config.predictionCachePath = predictionCachePath
+        config.uploadFormat = uploadFormat
+        config.uploadMaxSize = uploadMaxSize
+        config.serviceEndpoint = self.get_url("/")
+        config.projectId = "project"
+        config.publishIterationName = "iteration"
+        config.predictionKey = predictionKey
+        config.maxRetries = 1
+        config.retryBaseDelaySec = 0.01
+        return ParallelScoring(config, 800, 600)
+
+    def test_synthetic_predictions(self):
+        tiles = [Tile(f"tile_{i}_0_{i}_0.png", i, 0, i, 0, f"tile-{i}".encode()) for i in range(1, 11)]
+        scores = self.__createScoring().ScoreTiles(iter(tiles))
+        self.assertEqual(len(scores), 50)
+        self.assertEqual(self.server.requests, 10)
+        self.assertEqual(self.server.bytesReceived, sum(len(t.data) for t in tiles))
+
+        # Predictions only depend on the tile data
+        rescored = self.__createScoring().ScoreTiles(iter(tiles[0:1]))
+        self.assertEqual(len(rescored), 5)
+        self.assertEqual(rescored, [s for s in scores if s["name"] == "tile_1_0_1_0.png"])
+
+    def test_prediction_cache(self):
+        tiles = [Tile(f"tile_{i}_0_{i}_0.png", i, 0, i, 0, f"tile-{i}".encode()) for i in range(1, 5)]
+        with tempfile.TemporaryDirectory() as cachePath:
+            scoring = self.__createScoring(predictionCachePath=cachePath)
+            scores = scoring.ScoreTiles(iter(tiles))
+            self.assertEqual((self.server.requests, scoring.cacheHits), (4, 0))
+
+            # Rescoring the same tiles doesn't send any requests, and gives the same results
+            scoring = self.__createScoring(predictionCachePath=cachePath)
+            self.assertEqual(sorted(scoring.ScoreTiles(iter(tiles)), key=str), sorted(scores, key=str))
+            self.assertEqual((self.server.requests, scoring.cacheHits), (4, 4))
+
+    def test_upload_encoding(self):
+        tiles = [Tile(f"tile_{i}_0_{i}_0.png", i, 0, i, 0, EncodeTileImage(Image.new("RGB", (800, 600), (i, 0, 0)))) for i in range(1, 5)]
+        scoring = self.__createScoring(uploadFormat="jpeg", uploadMaxSize=400)
+        scores = scoring.ScoreTiles(iter(tiles))
+
+        # Boxes are still in (full size) tile pixels
+        self.assertEqual(len(scores), 20)
+        self.assertTrue(all(0 <= s["boxes"][0][2] <= 800 and 0 <= s["boxes"][0][3] <= 600 for s in scores))
+        self.assertEqual(self.server.bytesReceived, scoring.bytesUploaded)
+        self.assertEqual(scoring.bytesSaved, sum(len(t.data) for t in tiles) - self.server.bytesReceived)
+        self.assertTrue(self.server.bytesReceived < scoring.bytesSaved / 100)
+
+    def test_throttling_and_errors(self):
+        self.server.throttleRate = 0.5
+        self.server.errorRate = 0.5
+        self.server.retryAfterSec = 0
+        scoring = self.__createScoring()
+        scoring.ScoreTiles(iter([Tile("tile_1_0_0_0.png", 1, 0, 0, 0, b"tile-1")]))
+        self.assertEqual(list(scoring.failedTiles), ["tile_1_0_0_0.png"])
+        self.assertEqual(self.server.throttled + self.server.errors, 2)
+
+    def test_prediction_key(self):
+        scoring = self.__createScoring("wrong-key")
+        scoring.ScoreTiles(iter([Tile("tile_1_0_0_0.png", 1, 0, 0, 0, b"tile-1")]))
+        self.assertEqual(list(scoring.failedTiles), ["tile_1_0_0_0.png"])
+
+    def test_latency_distributions(self):
+        for latency in ("constant", "uniform", "exponential", "lognormal"):
+            server = MockPredictionServer(latency=latency, latencyMeanSec=0.2, latencyStdevSec=0.1, seed=1)
+            samples = [server.SampleLatency() for _ in range(2000)]
+            self.assertTrue(min(samples) >= 0)
+            self.assertAlmostEqual(sum(samples) / len(samples), 0.2, delta=0.02)
+
+        with self.assertRaises(Exception):
+            MockPredictionServer(latency="bimodal")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,359 @@
+import unittest
+import sys
+import os
+import json
+import time
+import tempfile
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root)
+
+from tornado import testing, web
+from Settings import ConfigSettings
+from ImageTiling import Tile, DefaultImageTiler
+import ModelScoring
+from ModelScoring import ParallelScoring, AdaptiveConcurrencyLimiter, TokenBucket, ScoringEndpoint
+from Settings import EndpointSettings
+from ScoringJournal import ScoringJournal
+
+PREDICTIONS = {
+    "predictions": [
+        { "probability": 0.9, "tagName": "defect", "boundingBox": { "left": 0.1, "top": 0.2, "width": 0.5, "height": 0.25 } },
+        { "probability": 0.1, "tagName": "defect", "boundingBox": { "left": 0.5, "top": 0.5, "width": 0.1, "height": 0.1 } }
+    ]
+}
+
+class FlakyPredictionHandler(web.RequestHandler):
+    """
+    Throttles the first request for each tile, and always fails tiles whose body is b"fail".
+    """
+    def initialize(self, seen):
+        self.seen = seen
+
+    def post(self, *args):
+        body = self.request.body
+        if body == b"fail":
+            self.set_status(503)
+        elif body not in self.seen:
+            self.seen.add(body)
+            self.set_status(429)
+            self.set_header("Retry-After", "0")
+        else:
+            self.write(json.dumps(PREDICTIONS))
+
+class TestParallelScoring(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        return web.Application([(r"/customvision/.*", FlakyPredictionHandler, { "seen": set() })])
+
+    def __createScoring(self, httpBackend="auto", journal=None):
+        config = ConfigSettings()
+        config.httpBackend = httpBackend
+        config.serviceEndpoint = self.get_url("/")
+        config.projectId = "project"
+        config.publishIterationName = "iteration"
+        config.predictionKey = "key"
+        config.boundingBoxScoreThreshold = 30
+        config.maxRetries = 2
+        config.retryBaseDelaySec = 0.01
+        return ParallelScoring(config, 800, 600, journal)
+
+    def test_scoring_with_retries(self):
+        scoring = self.__createScoring()
+        tiles = [
+            Tile("tile_1_0_0_0.png", 1, 0, 0, 0, b"tile-1"),
+            Tile("tile_2_0_1_0.png", 2, 0, 1, 0, b"tile-2"),
+            Tile("tile_3_0_2_0.png", 3, 0, 2, 0, b"fail"),
+        ]
+        scores = scoring.ScoreTiles(iter(tiles))
+
+        # Throttled tiles are retried, low scoring boxes are skipped, and tiles that keep failing are reported
+        self.assertEqual(sorted(s["name"] for s in scores), ["tile_1_0_0_0.png", "tile_2_0_1_0.png"])
+        self.assertEqual(scores[0]["boxes"], [(80, 120, 480, 270)])
+        self.assertEqual(list(scoring.failedTiles), ["tile_3_0_2_0.png"])
+
+    def test_bounded_statistics(self):
+        kept = ModelScoring.FAILED_TILES_KEPT
+        ModelScoring.FAILED_TILES_KEPT = 2
+        try:
+            scoring = self.__createScoring()
+        finally:
+            ModelScoring.FAILED_TILES_KEPT = kept
+        scoring.ScoreTiles(iter([Tile(f"tile_{i}_0_{i}_0.png", i, 0, i, 0, b"fail") for i in range(1, 4)]))
+
+        # Only the most recent failed tiles are listed (a long-running service never stops scoring), all are counted
+        self.assertEqual(scoring.failedTileCount, 3)
+        self.assertEqual(len(scoring.failedTiles), 2)
+        self.assertEqual(scoring.requestCount, 9)
+
+    def test_rotated_tile_dimensions(self):
+        scoring = self.__createScoring()
+        scores = scoring.ScoreTiles(iter([Tile("tile_1_0_0_90.png", 1, 0, 0, 90, b"tile-1")]))
+        self.assertEqual(scores[0]["boxes"], [(60, 160, 360, 360)])
+
+    def test_shared_http_client(self):
+        scoring = self.__createScoring("simple")
+        scoring.ScoreTiles(iter([Tile("tile_1_0_0_0.png", 1, 0, 0, 0, b"tile-1")]))
+        client = scoring.httpClient
+        scoring.ScoreTiles(iter([Tile("tile_2_0_1_0.png", 2, 0, 1, 0, b"tile-2")]))
+
+        # The same pooled client is used across calls, sized to the maximum concurrency
+        self.assertIs(scoring.httpClient, client)
+        self.assertEqual(client.max_clients, scoring.maxConcurrency)
+        self.assertEqual(len(scoring.scores), 2)
+
+        scoring.Close()
+        self.assertIsNone(scoring.httpClient)
+
+    def test_score_images(self):
+        scoring = self.__createScoring()
+        images = [
+            ("image-1", iter([Tile("tile_1_0_0_0.png", 1, 0, 0, 0, b"image-1-tile-1"), Tile("tile_2_0_1_0.png", 2, 0, 1, 0, b"image-1-tile-2")])),
+            ("image-2", iter([])),
+            ("image-3", iter([Tile("tile_1_0_0_0.png", 1, 0, 0, 0, b"image-3-tile-1"), Tile("tile_2_0_1_0.png", 2, 0, 1, 0, b"fail")])),
+        ]
+        completed = {}
+        scoring.ScoreImages(iter(images), lambda key, scores: completed.update({ key: scores }))
+
+        # Every image is reported once, with only its own scores (including images without any tiles)
+        self.assertEqual(sorted(completed), ["image-1", "image-2", "image-3"])
+        self.assertEqual(sorted(s["name"] for s in completed["image-1"]), ["tile_1_0_0_0.png", "tile_2_0_1_0.png"])
+        self.assertEqual(completed["image-2"], [])
+        self.assertEqual([s["name"] for s in completed["image-3"]], ["tile_1_0_0_0.png"])
+        self.assertEqual(list(scoring.failedTiles), ["tile_2_0_1_0.png"])
+
+    def test_score_images_with_corrupt_image(self):
+        scoring = self.__createScoring()
+        tiler = DefaultImageTiler(ConfigSettings(), 600, 800)
+        with tempfile.TemporaryDirectory() as tempPath:
+            corruptImage = os.path.join(tempPath, "b.jpg")
+            with open(corruptImage, "wb") as f:
+                f.write(b"not a jpeg")
+
+            sourceImages = ["./samples/test-1.jpg", corruptImage, "./samples/test-1.jpg#c"]
+            images = ((key, tiler.GenerateTiles(key.split("#")[0], False)) for key in sourceImages)
+            completed = {}
+            scoring.ScoreImages(images, lambda key, scores: completed.update({ key: scores }))
+
+        # The image that can't be tiled is skipped, and the images after it are still scored
+        self.assertEqual(sorted(completed), ["./samples/test-1.jpg", "./samples/test-1.jpg#c"])
+        self.assertEqual(len({ s["name"] for s in completed["./samples/test-1.jpg#c"] }), 25)
+        self.assertEqual(list(scoring.failedTiles), [])
+
+        # With a single image, failing to tile it fails the call
+        with self.assertRaises(Exception):
+            scoring.ScoreTiles(tiler.GenerateTiles("./samples/missing.jpg", False))
+
+    def test_streamed_detections(self):
+        scoring = self.__createScoring()
+        tiles = [
+            Tile("tile_1_0_0_0.png", 1, 0, 0, 0, b"stream-tile-1"),
+            Tile("tile_2_0_1_90_800_0.png", 2, 0, 1, 90, b"stream-tile-2"),
+            Tile("tile_3_0_2_0.png", 3, 0, 2, 0, b"fail"),
+        ]
+        streamed = {}
+        scoring.ScoreTiles(iter(tiles), onTileScored=lambda tile, detections: streamed.update({ tile.name: detections }))
+
+        # Detections are handed over per tile instead of being kept as score dicts, with the same boxes
+        self.assertEqual(scoring.scores, [])
+        self.assertEqual(sorted(streamed), ["tile_1_0_0_0.png", "tile_2_0_1_90_800_0.png"])
+        self.assertEqual(streamed["tile_1_0_0_0.png"].ToBoxList(), [(80, 120, 480, 270)])
+        self.assertEqual(streamed["tile_2_0_1_90_800_0.png"].ToBoxList(), [(60, 160, 360, 360)])
+        self.assertEqual(streamed["tile_2_0_1_90_800_0.png"].tiles.tolist(), [[0, 1, 90]])
+        self.assertEqual(streamed["tile_2_0_1_90_800_0.png"].origins.tolist(), [[800, 0]])
+        self.assertEqual(list(scoring.failedTiles), ["tile_3_0_2_0.png"])
+
+    @testing.gen_test
+    async def test_stream_tiles_async(self):
+        scoring = self.__createScoring()
+        tiles = [Tile(f"tile_{i}_0_{i}_0.png", i, 0, i, 0, f"async-tile-{i}".encode()) for i in range(1, 4)]
+        names = []
+        async for tile, detections in scoring.StreamTilesAsync(iter(tiles)):
+            self.assertEqual(detections.tags.tolist(), ["defect"])
+            names.append(tile.name)
+        self.assertEqual(sorted(names), [t.name for t in tiles])
+
+    def test_resume_from_journal(self):
+        journalPath = "./samples/tempFiles/scoring-journal.jsonl"
+        tiles = [
+            Tile("tile_1_0_0_0.png", 1, 0, 0, 0, b"journal-tile-1"),
+            Tile("tile_2_0_1_0.png", 2, 0, 1, 0, b"fail"),
+        ]
+        journal = ScoringJournal(journalPath, "run")
+        scoring = self.__createScoring(journal=journal)
+        scores = scoring.ScoreTiles(iter(tiles), "a.jpg")
+        journal.Close()
+
+        # Only the scored tile is journaled; resuming skips it, and retries the failed one
+        journal = ScoringJournal(journalPath, "run", resume=True)
+        self.assertEqual(len(journal), 1)
+        resumed = self.__createScoring(journal=journal)
+        self.assertEqual(resumed.ScoreTiles(iter(tiles), "a.jpg"), scores)
+        self.assertEqual(resumed.resumedTiles, 1)
+        self.assertEqual(list(resumed.failedTiles), ["tile_2_0_1_0.png"])
+        journal.Close()
+        os.remove(journalPath)
+
+    def test_connection_errors(self):
+        # Nothing listens on the port once its socket is closed, so every request is refused
+        sock, port = testing.bind_unused_port()
+        sock.close()
+        scoring = self.__createScoring()
+        scoring.endpoints[0].url = f"http://127.0.0.1:{port}/"
+        scoring.ScoreTiles(iter([Tile("tile_1_0_0_0.png", 1, 0, 0, 0, b"tile-1")]))
+
+        # Refused connections are retried like server errors, before the tile is reported as failed
+        self.assertEqual(list(scoring.failedTiles), ["tile_1_0_0_0.png"])
+        self.assertEqual(scoring.GetEndpointStats()[0]["failures"], scoring.maxRetries + 1)
+
+    def test_unknown_http_backend(self):
+        config = ConfigSettings()
+        config.httpBackend = "sockets"
+        with self.assertRaises(Exception):
+            ParallelScoring(config, 800, 600)
+
+class EndpointPredictionHandler(web.RequestHandler):
+    """
+    Answers for the endpoint named in the path, failing every request to endpoints named "down".
+    """
+    def initialize(self, requests):
+        self.requests = requests
+
+    def post(self, endpoint):
+        self.requests.append(endpoint)
+        if endpoint.startswith("down"):
+            self.set_status(503)
+        else:
+            self.write(json.dumps(PREDICTIONS))
+
+class TestEndpointDispatch(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.requests = []
+        return web.Application([(r"/(\w+)/customvision/.*", EndpointPredictionHandler, { "requests": self.requests })])
+
+    def __createScoring(self, endpoints):
+        config = ConfigSettings()
+        config.projectId = "project"
+        config.publishIterationName = "iteration"
+        config.boundingBoxScoreThreshold = 30
+        config.maxRetries = 2
+        config.retryBaseDelaySec = 0.01
+        config.GetEndpoints = lambda: [EndpointSettings(name, self.get_url(f"/{name}/"), "key", None, rate, weight) for name, rate, weight in endpoints]
+        return ParallelScoring(config, 800, 600)
+
+    def __tiles(self, count):
+        return [Tile(f"tile_{i}_0_{i}_0.png", i, 0, i, 0, f"tile-{i}".encode()) for i in range(1, count + 1)]
+
+    def test_weighted_dispatch(self):
+        scoring = self.__createScoring([("a", 0, 3), ("b", 0, 1)])
+        scoring.ScoreTiles(iter(self.__tiles(20)))
+        self.assertEqual((self.requests.count("a"), self.requests.count("b")), (15, 5))
+        self.assertEqual([s["requests"] for s in scoring.GetEndpointStats()], [15, 5])
+
+    def test_failover(self):
+        scoring = self.__createScoring([("down", 0, 1), ("up", 0, 1)])
+        scores = scoring.ScoreTiles(iter(self.__tiles(40)))
+
+        # Tiles sent to the failing endpoint are retried on the other one, and once the failing endpoint is out of
+        # rotation, it doesn't get any more requests than the ones already in flight (at most the initial
+        # concurrency)
+        self.assertEqual(len(scores), 40)
+        self.assertEqual(list(scoring.failedTiles), [])
+        down, up = scoring.GetEndpointStats()
+        self.assertEqual((down["failures"], up["failures"]), (down["requests"], 0))
+        self.assertTrue(ScoringEndpoint.FAILURE_THRESHOLD <= down["requests"] <= ScoringEndpoint.FAILURE_THRESHOLD + ModelScoring.TASK_CONCURRENCY)
+
+        # Failures of the requests in flight don't lengthen the cooldown
+        self.assertEqual(scoring.endpoints[0].cooldowns, 1)
+        self.assertTrue(scoring.endpoints[0].unhealthyUntil - time.monotonic() <= ScoringEndpoint.BASE_COOLDOWN_SEC)
+
+    def test_failover_from_unreachable_endpoint(self):
+        sock, port = testing.bind_unused_port()
+        sock.close()
+        scoring = self.__createScoring([("down", 0, 1), ("up", 0, 1)])
+        scoring.endpoints[0].url = f"http://127.0.0.1:{port}/"
+        scores = scoring.ScoreTiles(iter(self.__tiles(40)))
+
+        # Refused connections take the endpoint out of rotation like server errors
+        self.assertEqual(len(scores), 40)
+        down, up = scoring.GetEndpointStats()
+        self.assertEqual(self.requests.count("down"), 0)
+        self.assertTrue(ScoringEndpoint.FAILURE_THRESHOLD <= down["failures"] <= ScoringEndpoint.FAILURE_THRESHOLD + ModelScoring.TASK_CONCURRENCY)
+        self.assertFalse(scoring.endpoints[0].IsHealthy(time.monotonic()))
+
+    def test_rate_limit(self):
+        scoring = self.__createScoring([("a", 20, 1)])
+        start = time.time()
+        scoring.ScoreTiles(iter(self.__tiles(30)))
+
+        # A burst of up to one second's worth of requests, then 20 per second
+        self.assertTrue(time.time() - start >= 0.45)
+        self.assertEqual(len(self.requests), 30)
+
+class TestScoringEndpoint(unittest.TestCase):
+
+    def test_cooldown(self):
+        endpoint = ScoringEndpoint(EndpointSettings("a", "http://a/", "key", None, 0, 1), "project", "iteration")
+        error = Exception("failed")
+        for i in range(ScoringEndpoint.FAILURE_THRESHOLD):
+            endpoint.OnFailure(error, 100.0, 99.0)
+        self.assertEqual(endpoint.unhealthyUntil, 100.0 + ScoringEndpoint.BASE_COOLDOWN_SEC)
+
+        # Requests that were in flight when it was taken out of rotation don't lengthen the cooldown
+        for _ in range(30):
+            endpoint.OnFailure(error, 101.0, 99.5)
+        self.assertEqual(endpoint.unhealthyUntil, 100.0 + ScoringEndpoint.BASE_COOLDOWN_SEC)
+        self.assertEqual(endpoint.failures, ScoringEndpoint.FAILURE_THRESHOLD + 30)
+
+        # Failing again once back in rotation doubles it, and succeeding resets it
+        endpoint.OnFailure(error, 110.0, 109.0)
+        self.assertEqual(endpoint.unhealthyUntil, 110.0 + 2 * ScoringEndpoint.BASE_COOLDOWN_SEC)
+        endpoint.OnSuccess()
+        for i in range(ScoringEndpoint.FAILURE_THRESHOLD):
+            endpoint.OnFailure(error, 130.0, 125.0)
+        self.assertEqual(endpoint.unhealthyUntil, 130.0 + ScoringEndpoint.BASE_COOLDOWN_SEC)
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_refill(self):
+        bucket = TokenBucket(10)
+        for _ in range(10):
+            self.assertEqual(bucket.GetWait(100.0), 0.0)
+            bucket.Take(100.0)
+        self.assertAlmostEqual(bucket.GetWait(100.0), 0.1, delta=0.05)
+
+    def test_pause_and_unlimited(self):
+        bucket = TokenBucket(0)
+        self.assertEqual(bucket.GetWait(100.0), 0.0)
+        bucket.Pause(2.0, 100.0)
+        self.assertEqual(bucket.GetWait(101.0), 1.0)
+
+class TestAdaptiveConcurrencyLimiter(unittest.TestCase):
+
+    def test_additive_increase(self):
+        # Roughly one extra request per round of successful requests
+        limiter = AdaptiveConcurrencyLimiter(4, 1, 6, latencyTargetSec=1.0)
+        for _ in range(4):
+            limiter.OnSuccess(0.1)
+        self.assertEqual(int(limiter.limit), 4)
+        for _ in range(2):
+            limiter.OnSuccess(0.1)
+        self.assertEqual(int(limiter.limit), 5)
+
+        for _ in range(100):
+            limiter.OnSuccess(0.1)
+        self.assertEqual(int(limiter.limit), 6)
+
+    def test_multiplicative_decrease(self):
+        limiter = AdaptiveConcurrencyLimiter(8, 2, 16, latencyTargetSec=1.0)
+        limiter.OnCongestion()
+        self.assertEqual(int(limiter.limit), 4)
+
+        # Further congestion signals within the same interval are ignored
+        limiter.OnCongestion()
+        limiter.OnSuccess(5.0)
+        self.assertEqual(int(limiter.limit), 4)
+
+if __name__ == '__main__':
+    unittest.main()
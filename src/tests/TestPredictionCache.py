@@ -0,0 +1,64 @@
+import unittest
+import sys
+import os
+import glob
+import json
+import tempfile
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root)
+
+from PredictionCache import PredictionCache
+
+RESULTS = { "predictions": [{ "probability": 0.9, "boundingBox": { "left": 0.1, "top": 0.2, "width": 0.3, "height": 0.4 } }] }
+
+class TestPredictionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.cachePath = self.tempDir.name
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def test_keys(self):
+        cache = PredictionCache(self.cachePath, 1024 * 1024)
+        key = cache.GetKey("project", "iteration1", b"tile")
+        self.assertEqual(key, cache.GetKey("project", "iteration1", b"tile"))
+
+        # A new iteration, project or different tile contents all get a different key
+        self.assertNotEqual(key, cache.GetKey("project", "iteration2", b"tile"))
+        self.assertNotEqual(key, cache.GetKey("project2", "iteration1", b"tile"))
+        self.assertNotEqual(key, cache.GetKey("project", "iteration1", b"tile2"))
+
+    def test_get_and_put(self):
+        cache = PredictionCache(self.cachePath, 1024 * 1024)
+        key = cache.GetKey("project", "iteration", b"tile")
+        self.assertIsNone(cache.Get(key))
+        cache.Put(key, RESULTS)
+        self.assertEqual(cache.Get(key), RESULTS)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # Entries survive across instances
+        cache = PredictionCache(self.cachePath, 1024 * 1024)
+        self.assertEqual(cache.Get(key), RESULTS)
+
+    def test_lru_eviction(self):
+        entrySize = len(json.dumps(RESULTS))
+        cache = PredictionCache(self.cachePath, entrySize * 3)
+        keys = [cache.GetKey("project", "iteration", f"tile-{i}".encode()) for i in range(4)]
+        for key in keys[0:3]:
+            cache.Put(key, RESULTS)
+
+        # Using the oldest entry makes the second one the least recently used
+        cache.Get(keys[0])
+        cache.Put(keys[3], RESULTS)
+
+        self.assertIsNone(cache.Get(keys[1]))
+        for key in (keys[0], keys[2], keys[3]):
+            self.assertEqual(cache.Get(key), RESULTS)
+        self.assertEqual(len(glob.glob(os.path.join(self.cachePath, "*", "*.json"))), 3)
+        self.assertTrue(cache.sizeBytes <= cache.maxSizeBytes)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+import sys
+import os
+import io
+import json
+import tempfile
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root)
+
+import numpy as np
+from PIL import Image
+from tornado import testing, web
+from Settings import ConfigSettings
+from ImageTiling import DefaultImageTiler
+from ModelScoring import ParallelScoring
+from BoundingBoxes import CoordinateOperations
+from PyramidScoring import CoarseToFineScoring
+
+class BrightSpotPredictionHandler(web.RequestHandler):
+    """
+    Finds the bright pixels of each tile, and returns their bounding box as the only prediction.
+    """
+    def initialize(self, requests):
+        self.requests = requests
+
+    def post(self, *args):
+        self.requests.append(self.request.body)
+        pixels = np.asarray(Image.open(io.BytesIO(self.request.body)).convert("L"))
+        ys, xs = np.nonzero(pixels > 128)
+        predictions = []
+        if xs.size > 0:
+            height, width = pixels.shape
+            predictions.append({
+                "probability": 0.9,
+                "tagName": "spot",
+                "boundingBox": { "left": xs.min() / width, "top": ys.min() / height, "width": (xs.max() + 1 - xs.min()) / width, "height": (ys.max() + 1 - ys.min()) / height }
+            })
+        self.write(json.dumps({ "predictions": predictions }))
+
+class TestPyramidScoring(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.requests = []
+        return web.Application([(r"/customvision/.*", BrightSpotPredictionHandler, { "requests": self.requests })])
+
+    def test_coarse_to_fine(self):
+        config = ConfigSettings()
+        config.serviceEndpoint = self.get_url("/")
+        config.projectId = "project"
+        config.publishIterationName = "iteration"
+        config.predictionKey = "key"
+        config.boundingBoxScoreThreshold = 30
+        scoring = ParallelScoring(config, 800, 600)
+        coordinateOps = CoordinateOperations()
+
+        # A single bright object on a dark 4000x3000 image (25 full resolution tiles)
+        pixels = np.zeros((3000, 4000, 3), dtype=np.uint8)
+        pixels[1500:1580, 2500:2600] = 255
+        with tempfile.TemporaryDirectory() as path:
+            sourceImage = os.path.join(path, "source.png")
+            Image.fromarray(pixels).save(sourceImage)
+
+            pyramid = CoarseToFineScoring(config, scoring, DefaultImageTiler(config, 600, 800), coordinateOps, 4)
+            scores = scoring.ScoreTiles(pyramid.GenerateTiles(sourceImage, False), sourceImage)
+
+        # The 1000x750 coarse image takes 4 tiles, after which only the tile holding the object is refined
+        self.assertEqual(len(self.requests), 5)
+        self.assertEqual([s["name"] for s in scores], ["tile_14_2_3_0.png"])
+        detections = coordinateOps.RemapDetections(600, 800, coordinateOps.ScoresToDetections(scores))
+        np.testing.assert_allclose(detections.boxes, [[2500, 1500, 2600, 1580]])
+
+        with self.assertRaises(Exception):
+            CoarseToFineScoring(config, scoring, DefaultImageTiler(config, 600, 800), coordinateOps, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+import sys
+import os
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root)
+
+import numpy as np
+from PIL import Image
+from Settings import ConfigSettings
+from ImageTiling import SlidingWindowImageTiler
+from RasterReader import OpenRasterReader, MemoryMappedRasterReader, PillowRasterReader, TiffRasterReader, tifffile
+
+class TestRasterReader(unittest.TestCase):
+
+    def setUp(self):
+        self.pixels = np.random.default_rng(0).integers(0, 256, size=(700, 900, 3), dtype=np.uint8)
+        np.save("./samples/tempFiles/raster.npy", self.pixels)
+        Image.fromarray(self.pixels).save("./samples/tempFiles/raster.png")
+
+    def tearDown(self):
+        for name in ("raster.npy", "raster.png", "raster-tiled.tif", "raster-stripped.tif"):
+            if os.path.exists(os.path.join("./samples/tempFiles", name)):
+                os.remove(os.path.join("./samples/tempFiles", name))
+
+    def __assertSameCrops(self, reader):
+        reference = Image.open("./samples/tempFiles/raster.png")
+        self.assertEqual(reader.size, (900, 700))
+
+        # Crops within the image, and crops extending past its edges (which are black)
+        for box in [(0, 0, 256, 256), (300, 250, 700, 450), (800, 600, 1056, 856), (-50, -50, 100, 100)]:
+            self.assertEqual(np.asarray(reader.Crop(box)).tolist(), np.asarray(reference.crop(box)).tolist(), box)
+        reader.Close()
+
+    def test_memory_mapped_rasters(self):
+        reader = OpenRasterReader("./samples/tempFiles/raster.npy")
+        self.assertIsInstance(reader, MemoryMappedRasterReader)
+        self.assertEqual(reader.mode, "RGB")
+        self.__assertSameCrops(reader)
+
+    @unittest.skipIf(tifffile is None, "tifffile is not installed")
+    def test_tiff_rasters(self):
+        tifffile.imwrite("./samples/tempFiles/raster-tiled.tif", self.pixels, tile=(128, 128), compression="zlib")
+        tifffile.imwrite("./samples/tempFiles/raster-stripped.tif", self.pixels, rowsperstrip=50)
+
+        reader = OpenRasterReader("./samples/tempFiles/raster-tiled.tif")
+        self.assertIsInstance(reader, TiffRasterReader)
+        self.__assertSameCrops(reader)
+        self.__assertSameCrops(OpenRasterReader("./samples/tempFiles/raster-stripped.tif"))
+
+    def test_windowed_tiling(self):
+        config = ConfigSettings()
+        tiler = SlidingWindowImageTiler(config, 256, 256, overlap=32, edgeMode="pad")
+
+        # Tiling a raw raster yields exactly the same tiles as tiling the same image read with Pillow
+        reader = OpenRasterReader("./samples/tempFiles/raster.png")
+        self.assertIsInstance(reader, PillowRasterReader)
+        reader.Close()
+        tiles = list(tiler.GenerateTiles("./samples/tempFiles/raster.npy", False))
+        self.assertEqual(tiles, list(tiler.GenerateTiles("./samples/tempFiles/raster.png", False)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,41 @@
 import unittest
 import sys
 import os
+import json
 import glob
 
 root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(root)
 
-from ResultsWriter import ImageWithBoundingBoxes
+import numpy as np
+from PIL import Image, ImageDraw
+from BoundingBoxes import DetectionArray
+from ResultsWriter import ImageWithBoundingBoxes, DetectionsAsJsonLines, PreviewWithBoundingBoxes, ProgressiveDetections, tifffile
+from BoundingBoxes import CoordinateOperations
+from ImageTiling import Tile
 
 class TestResultsWriter(unittest.TestCase):
 
+    def setUp(self):
+        self.pixels = np.random.default_rng(0).integers(0, 256, size=(700, 900, 3), dtype=np.uint8)
+        np.save("./samples/tempFiles/results-source.npy", self.pixels)
+
+        # Boxes crossing strip boundaries (and the image edges) at fractional coordinates
+        self.boxes = [(10.5, 200.5, 100.5, 300.5), (400.2, 253.4, 480.9, 520.7), (850.0, -20.0, 950.0, 20.0), (0, 0, 899, 699)]
+        reference = Image.fromarray(self.pixels)
+        draw = ImageDraw.Draw(reference)
+        for box in self.boxes:
+            draw.rectangle(box, fill=None, outline=ImageWithBoundingBoxes.COLOR, width=ImageWithBoundingBoxes.BORDER_WIDTH)
+        self.reference = np.asarray(reference)
+
+    def tearDown(self):
+        for name in ("results-source.npy", "results-source.jpg", "results.npy", "results.tif", "results.jsonl", "results_preview.jpg", "results_preview_1.jpg"):
+            if os.path.exists(os.path.join("./samples/tempFiles", name)):
+                os.remove(os.path.join("./samples/tempFiles", name))
+        filesToRemove = glob.glob("./samples/results/*.jpg")
+        for f in filesToRemove:
+            os.remove(f)
+
     def test_basic_box_drawing(self):
         writer = ImageWithBoundingBoxes()
         boxes = []
@@ -25,10 +51,74 @@ class TestResultsWriter(unittest.TestCase):
         boxes.append((1200, 900, 1400, 1100))
         writer.Write("./samples/test-1.jpg", boxes, "./samples/results/test-2-results.jpg")
 
-    def tearDown(self):
-        filesToRemove = glob.glob("./samples/results/*.jpg")
-        for f in filesToRemove:
-            os.remove(f)
+    def test_strip_wise_npy_output(self):
+        ImageWithBoundingBoxes().Write("./samples/tempFiles/results-source.npy", self.boxes, "./samples/tempFiles/results.npy")
+        self.assertTrue(np.array_equal(np.load("./samples/tempFiles/results.npy"), self.reference))
+
+    @unittest.skipIf(tifffile is None, "tifffile is not installed")
+    def test_strip_wise_tiff_output(self):
+        ImageWithBoundingBoxes().Write("./samples/tempFiles/results-source.npy", self.boxes, "./samples/tempFiles/results.tif")
+        self.assertTrue(np.array_equal(tifffile.imread("./samples/tempFiles/results.tif"), self.reference))
+
+    def __createDetections(self):
+        return DetectionArray(
+            np.array([[10.5, 200.25, 100.5, 300.5], [400.0, 250.0, 480.0, 520.0]]),
+            np.array([[0, 0, 0], [1, 2, 90]]),
+            np.array([95.5, 40.0]),
+            np.array([[np.nan, np.nan], [384.0, 192.0]]),
+            np.array(["defect", "scratch"], dtype=object)
+        )
+
+    def test_detections_json_lines(self):
+        writer = DetectionsAsJsonLines()
+        outputPath = writer.GetOutputPath("./samples/tempFiles", "/images/results.jpg")
+        self.assertEqual(outputPath, os.path.join("./samples/tempFiles", "results.jsonl"))
+
+        writer.WriteDetections("/images/results.jpg", self.__createDetections(), outputPath)
+        with open(outputPath) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(records[0], { "box": [10.5, 200.25, 100.5, 300.5], "source": "results.jpg", "score": 95.5, "tag": "defect", "tile": { "row": 0, "col": 0, "angle": 0 } })
+        self.assertEqual(records[1]["tile"], { "row": 1, "col": 2, "angle": 90, "x": 384, "y": 192 })
+
+        DetectionsAsJsonLines(geoJson=True).WriteDetections("/images/results.jpg", self.__createDetections(), outputPath)
+        with open(outputPath) as f:
+            feature = json.loads(f.readline())
+        self.assertEqual(feature["geometry"]["coordinates"][0][0:3], [[10.5, 200.25], [100.5, 200.25], [100.5, 300.5]])
+        self.assertEqual(feature["properties"]["tag"], "defect")
+
+    def test_progressive_detections(self):
+        writer = DetectionsAsJsonLines()
+        outputPath = writer.GetOutputPath("./samples/tempFiles", "/images/results.jpg")
+        coordinateOps = CoordinateOperations()
+        stream = ProgressiveDetections(coordinateOps, 600, 800, "/images/results.jpg", writer, "./samples/tempFiles")
+
+        # Each tile's detections are re-mapped and written to the partial file as soon as the tile is scored
+        tiles = [Tile("tile_1_0_0_0.png", 1, 0, 0, 0, b""), Tile("tile_5_1_1_0.png", 5, 1, 1, 0, b"")]
+        for tile in tiles:
+            detections = coordinateOps.ScoresToDetections([{ "name": tile.name, "score": 90, "tag": "defect", "boxes": [(10, 20, 30, 40)] }])
+            stream.OnTileScored(tile, detections)
+            with open(outputPath + ".partial") as f:
+                self.assertEqual(len(f.readlines()), tile.row + 1)
+
+        detections = stream.GetDetections()
+        self.assertEqual(detections.ToBoxList(), [(10, 20, 30, 40), (810, 620, 830, 640)])
+
+        # Writing the final detections replaces the partial file
+        writer.WriteDetections("/images/results.jpg", detections, outputPath)
+        self.assertFalse(os.path.exists(outputPath + ".partial"))
+
+    def test_preview_pyramid(self):
+        writer = PreviewWithBoundingBoxes(maxSize=300, levels=2)
+        outputPath = writer.GetOutputPath("./samples/tempFiles", "results.npy")
+        self.assertEqual(outputPath, os.path.join("./samples/tempFiles", "results_preview.jpg"))
+
+        # Windowed sources are reduced strip by strip, JPEG sources are decoded at a reduced scale
+        Image.fromarray(self.pixels).save("./samples/tempFiles/results-source.jpg")
+        for source in ("./samples/tempFiles/results-source.npy", "./samples/tempFiles/results-source.jpg"):
+            writer.WriteDetections(source, self.__createDetections(), outputPath)
+            with Image.open(outputPath) as preview, Image.open("./samples/tempFiles/results_preview_1.jpg") as reduced:
+                self.assertLessEqual(max(preview.size), 300)
+                self.assertEqual(reduced.size, tuple((s + 1) // 2 for s in preview.size))
 
-if __name__ == "__main__":
-    unittest.main()
\ No newline at end of file
+if __name__ == '__main__':
+    unittest.main()
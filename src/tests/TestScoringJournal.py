@@ -0,0 +1,64 @@
+import unittest
+import sys
+import os
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root)
+
+from ScoringJournal import ScoringJournal
+
+JOURNAL_PATH = "./samples/tempFiles/scoring-journal.jsonl"
+RESULTS = { "predictions": [{ "probability": 0.9, "tagName": "defect", "boundingBox": { "left": 0.1, "top": 0.2, "width": 0.5, "height": 0.25 } }] }
+
+class TestScoringJournal(unittest.TestCase):
+
+    def tearDown(self):
+        if os.path.exists(JOURNAL_PATH):
+            os.remove(JOURNAL_PATH)
+
+    def test_resume(self):
+        journal = ScoringJournal(JOURNAL_PATH, "project/iteration/800x600")
+        journal.Put("a.jpg", "tile_1_0_0_0.png", RESULTS)
+        journal.Put("b.jpg", "tile_1_0_0_0.png", RESULTS)
+        journal.Close()
+
+        # Tiles are keyed by source image and tile name
+        journal = ScoringJournal(JOURNAL_PATH, "project/iteration/800x600", resume=True)
+        self.assertEqual(len(journal), 2)
+        self.assertEqual(journal.Get("a.jpg", "tile_1_0_0_0.png"), RESULTS)
+        self.assertIsNone(journal.Get("a.jpg", "tile_2_0_1_0.png"))
+        self.assertEqual(journal.resumed, 1)
+        journal.Close()
+
+        # Entries from another model iteration (or tile size) are not reused, and starting without resuming
+        # discards the journal
+        journal = ScoringJournal(JOURNAL_PATH, "project/iteration2/800x600", resume=True)
+        self.assertEqual(len(journal), 0)
+        journal.Close()
+        ScoringJournal(JOURNAL_PATH, "project/iteration/800x600").Close()
+        journal = ScoringJournal(JOURNAL_PATH, "project/iteration/800x600", resume=True)
+        self.assertEqual(len(journal), 0)
+        journal.Close()
+
+    def test_incomplete_entry(self):
+        journal = ScoringJournal(JOURNAL_PATH, "run")
+        journal.Put("a.jpg", "tile_1_0_0_0.png", RESULTS)
+        journal.Put("a.jpg", "tile_2_0_1_0.png", RESULTS)
+        journal.Close()
+
+        # Simulate the process dying in the middle of writing the last entry
+        with open(JOURNAL_PATH, "rb+") as f:
+            f.truncate(os.path.getsize(JOURNAL_PATH) - 20)
+
+        journal = ScoringJournal(JOURNAL_PATH, "run", resume=True)
+        self.assertEqual(len(journal), 1)
+        journal.Put("a.jpg", "tile_2_0_1_0.png", RESULTS)
+        journal.Close()
+
+        # New entries start on a fresh line, so they aren't lost along with the incomplete one
+        journal = ScoringJournal(JOURNAL_PATH, "run", resume=True)
+        self.assertEqual(len(journal), 2)
+        journal.Close()
+
+if __name__ == '__main__':
+    unittest.main()
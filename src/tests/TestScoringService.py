@@ -0,0 +1,122 @@
+import unittest
+import sys
+import os
+import json
+import tempfile
+import threading
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root)
+
+from tornado import testing, web
+from Settings import ConfigSettings
+from ImageTiling import DefaultImageTiler
+from ModelScoring import ParallelScoring
+from BoundingBoxes import CoordinateOperations
+from MockPredictionServer import MockPredictionServer
+from ScoringService import ScoringService
+
+SOURCE_IMAGE = os.path.abspath("./samples/test-1.jpg")
+
+class TestScoringService(testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        config = ConfigSettings()
+        config.serviceEndpoint = self.get_url("/")
+        config.projectId = "project"
+        config.publishIterationName = "iteration"
+        config.predictionKey = "key"
+        config.boundingBoxScoreThreshold = 30
+        self.scoring = ParallelScoring(config, 800, 600)
+        self.tiler = DefaultImageTiler(config, 600, 800)
+        self.coordinateOps = CoordinateOperations()
+        self.outputPath = tempfile.TemporaryDirectory()
+        self.tilingStarted = threading.Event()
+
+        self.service = ScoringService(self.scoring, self.__generateTiles, self.__processScores, self.outputPath.name, maxQueuedJobs=1)
+        self.server = MockPredictionServer(latencyMeanSec=0.0, seed=1)
+        return web.Application(self.service.GetHandlers() + self.server.MakeApplication().default_router.rules)
+
+    def setUp(self):
+        super().setUp()
+        self.service.Start()
+
+    def tearDown(self):
+        self.tilingStarted.set()
+        self.io_loop.run_sync(self.service.Stop)
+        self.scoring.Close()
+        self.outputPath.cleanup()
+        super().tearDown()
+
+    def __generateTiles(self, sourceImage):
+        self.tilingStarted.wait(10)
+        return self.tiler.GenerateTiles(sourceImage, False)
+
+    def __processScores(self, sourceImage, scores, outputPath):
+        return self.coordinateOps.RemapDetections(600, 800, self.coordinateOps.ScoresToDetections(scores))
+
+    def __submit(self, body, contentType="application/json"):
+        return self.fetch("/jobs", method="POST", body=body, headers={ "Content-Type": contentType }, raise_error=False)
+
+    def test_submit_path(self):
+        self.tilingStarted.set()
+        response = self.__submit(json.dumps({ "sourceImage": SOURCE_IMAGE }))
+        self.assertEqual(response.code, 202)
+        job = json.loads(response.body)
+        self.assertEqual(response.headers["Location"], f"/jobs/{job['id']}")
+
+        # Long polling returns as soon as the job is done
+        status = json.loads(self.fetch(f"/jobs/{job['id']}?wait=10").body)
+        self.assertEqual((status["state"], status["tiles"]), ("done", 25))
+
+        detections = [json.loads(line) for line in self.fetch(f"/jobs/{job['id']}/detections").body.decode().splitlines()]
+        self.assertEqual(len(detections), status["detections"])
+        self.assertTrue(len(detections) > 0)
+        self.assertTrue(all(d["source"] == "test-1.jpg" for d in detections))
+
+        # Region queries return the detections overlapping the region, in the same order
+        region = (1000, 500, 2000, 1500)
+        inRegion = [json.loads(line) for line in self.fetch(f"/jobs/{job['id']}/detections?bbox=1000,500,2000,1500").body.decode().splitlines()]
+        self.assertEqual(inRegion, [d for d in detections if d["box"][0] < region[2] and d["box"][2] > region[0] and d["box"][1] < region[3] and d["box"][3] > region[1]])
+        self.assertTrue(0 < len(inRegion) < len(detections))
+        self.assertEqual(self.fetch(f"/jobs/{job['id']}/detections?bbox=1,2,3", raise_error=False).code, 400)
+
+        events = [json.loads(line) for line in self.fetch(f"/jobs/{job['id']}/events").body.decode().splitlines()]
+        self.assertEqual([e["state"] for e in events], ["done"])
+
+    def test_upload(self):
+        self.tilingStarted.set()
+        with open(SOURCE_IMAGE, "rb") as f:
+            data = f.read()
+        job = json.loads(self.__submit(data, "image/jpeg").body)
+
+        # Stream status changes until the job finishes; the uploaded image is removed once it is scored
+        events = [json.loads(line) for line in self.fetch(f"/jobs/{job['id']}/events").body.decode().splitlines()]
+        self.assertEqual(events[-1]["state"], "done")
+        self.assertEqual(events[-1]["source"], "image.jpg")
+        self.assertFalse(os.path.exists(os.path.join(self.outputPath.name, job["id"], "upload")))
+
+        # Data that isn't an image fails the job rather than the service
+        job = json.loads(self.__submit(b"not an image", "image/jpeg").body)
+        status = json.loads(self.fetch(f"/jobs/{job['id']}?wait=10").body)
+        self.assertEqual(status["state"], "failed")
+        self.assertEqual(self.fetch(f"/jobs/{job['id']}/detections", raise_error=False).code, 500)
+
+    def test_backpressure(self):
+        # While the only job slot is taken, submissions are refused
+        first = json.loads(self.__submit(json.dumps({ "sourceImage": SOURCE_IMAGE })).body)
+        response = self.__submit(json.dumps({ "sourceImage": SOURCE_IMAGE }))
+        self.assertEqual(response.code, 503)
+        self.assertEqual(response.headers["Retry-After"], "1")
+
+        self.tilingStarted.set()
+        self.assertEqual(json.loads(self.fetch(f"/jobs/{first['id']}?wait=10").body)["state"], "done")
+        self.assertEqual(self.__submit(json.dumps({ "sourceImage": SOURCE_IMAGE })).code, 202)
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.__submit(json.dumps({ "sourceImage": "./missing.jpg" })).code, 400)
+        self.assertEqual(self.__submit("{}").code, 400)
+        self.assertEqual(self.fetch("/jobs/0123abcd", raise_error=False).code, 404)
+
+if __name__ == '__main__':
+    unittest.main()
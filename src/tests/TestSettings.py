@@ -2,6 +2,7 @@ import unittest
 import sys
 import os
 import glob
+import tempfile
 
 root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(root)
@@ -27,3 +28,17 @@ class TestSettings(unittest.TestCase):
         with self.assertRaises(FileNotFoundError):
             config = ConfigSettings("file-that-doesn-exist.cfg")
 
+    def test_multiple_endpoints(self):
+        with tempfile.TemporaryDirectory() as path:
+            file = os.path.join(path, "settings.cfg")
+            with open(file, "w") as f:
+                f.write(
+                    "[UtilityDefaults]\nBoundingBoxScoreThreshold = 30\nTempFilePath = tiles\n"
+                    "[CustomVisionService]\nServiceEndpoint = https://a/\nPredictionKey = key-a\nPredictionResourceId = a\n"
+                    "PublishIterationName = iteration\nProjectId = project\nRequestsPerSecond = 10\n"
+                    "[CustomVisionService.b]\nServiceEndpoint = https://b/\nPredictionKey = key-b\nWeight = 2\n"
+                )
+            endpoints = ConfigSettings(file).GetEndpoints()
+
+        self.assertEqual([(e.name, e.serviceEndpoint, e.predictionKey) for e in endpoints], [("default", "https://a/", "key-a"), ("b", "https://b/", "key-b")])
+        self.assertEqual([(e.requestsPerSecond, e.weight) for e in endpoints], [(10.0, 1.0), (0.0, 2.0)])
@@ -0,0 +1,62 @@
+import unittest
+import sys
+import os
+import io
+import glob
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root)
+
+from PIL import Image
+from Settings import ConfigSettings
+from ImageTiling import SlidingWindowImageTiler
+
+class TestSlidingWindowImageTiler(unittest.TestCase):
+
+    def test_shifted_layout(self):
+        config = ConfigSettings()
+        tiler = SlidingWindowImageTiler(config, 1024, 1024, overlap=128)
+        layout = tiler.GetTileLayout(4000, 3000)
+        self.assertEqual(len(layout), 20)
+        self.assertEqual(sorted(set(l[2] for l in layout)), [0, 896, 1792, 2688, 2976])
+        self.assertEqual(sorted(set(l[3] for l in layout)), [0, 896, 1792, 1976])
+        self.assertEqual(layout[-1], (3, 4, 2976, 1976))
+
+    def test_padded_layout(self):
+        config = ConfigSettings()
+        tiler = SlidingWindowImageTiler(config, 1024, 1024, overlap=128, edgeMode="pad")
+        layout = tiler.GetTileLayout(4000, 3000)
+        self.assertEqual(sorted(set(l[2] for l in layout)), [0, 896, 1792, 2688, 3584])
+        self.assertEqual(sorted(set(l[3] for l in layout)), [0, 896, 1792, 2688])
+
+        # Sources smaller than a tile are padded, even in shift mode
+        tiler = SlidingWindowImageTiler(config, 1024, 1024, overlap=128)
+        self.assertEqual(tiler.GetTileLayout(500, 2000), [(0, 0, 0, 0), (1, 0, 0, 896), (2, 0, 0, 976)])
+
+    def test_invalid_settings(self):
+        config = ConfigSettings()
+        with self.assertRaises(Exception):
+            SlidingWindowImageTiler(config, 600, 800, overlap=600)
+
+        with self.assertRaises(Exception):
+            SlidingWindowImageTiler(config, 600, 800, overlap=-1)
+
+        with self.assertRaises(Exception):
+            SlidingWindowImageTiler(config, 600, 800, edgeMode="wrap")
+
+    def test_tiling_arbitrary_size(self):
+        config = ConfigSettings()
+        config.tempFilePath = "./samples/tempFiles"
+        tiler = SlidingWindowImageTiler(config, 670, 670, overlap=64)
+        tiles = list(tiler.GenerateTiles("./samples/test-1.jpg", False))
+        self.assertEqual(len(tiles), 35)
+        self.assertEqual(tiles[-1].name, "tile_35_4_6_0_3330_2330.png")
+        self.assertEqual(Image.open(io.BytesIO(tiles[-1].data)).size, (670, 670))
+
+        tiler.CreateTiles("./samples/test-1.jpg", False)
+        self.assertEqual(len(glob.glob("./samples/tempFiles/*.png")), 35)
+        tiler.Cleanup()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+import sys
+import os
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root)
+
+import numpy as np
+from PIL import Image, ImageDraw
+from Settings import ConfigSettings
+from ImageTiling import DefaultImageTiler
+from TileFilter import InformativeTileFilter
+
+def createStripes(contrast):
+    # Low frequency vertical stripes, so the perceptual hash has plenty of structure
+    x = np.arange(512)
+    row = 128 + contrast * np.sin(x / 20.0)
+    return Image.fromarray(np.tile(row, (512, 1)).astype(np.uint8)).convert("RGB")
+
+class TestTileFilter(unittest.TestCase):
+
+    def test_uniform_tiles(self):
+        tileFilter = InformativeTileFilter()
+        self.assertFalse(tileFilter.IsInformative(Image.new("RGB", (1024, 1024), (20, 60, 120))))
+
+        # A single small object on a uniform background is still worth scoring
+        tile = Image.new("RGB", (1024, 1024), (20, 60, 120))
+        ImageDraw.Draw(tile).rectangle((500, 500, 530, 530), fill=(240, 240, 240))
+        self.assertTrue(tileFilter.IsInformative(tile))
+
+        noise = np.random.default_rng(0).integers(0, 256, size=(1024, 1024, 3), dtype=np.uint8)
+        self.assertTrue(tileFilter.IsInformative(Image.fromarray(noise)))
+        self.assertEqual((tileFilter.skipped, tileFilter.checked), (1, 3))
+
+    def test_statistics(self):
+        tileFilter = InformativeTileFilter()
+        variance, entropy, edgeDensity = tileFilter.GetStatistics(Image.new("L", (256, 256), 100))
+        self.assertEqual((variance, entropy, edgeDensity), (0.0, 0.0, 0.0))
+
+        checkerboard = Image.fromarray((np.indices((256, 256)).sum(axis=0) % 2 * 255).astype(np.uint8))
+        variance, entropy, edgeDensity = InformativeTileFilter(thumbnailSize=256).GetStatistics(checkerboard)
+        self.assertAlmostEqual(entropy, 1.0)
+        self.assertAlmostEqual(edgeDensity, 1.0)
+
+    def test_near_duplicates(self):
+        tileFilter = InformativeTileFilter(minVariance=100)
+        self.assertFalse(tileFilter.IsInformative(createStripes(5)))
+
+        # Same structure with more contrast passes the thresholds, but is a near-duplicate of the skipped tile
+        self.assertTrue(InformativeTileFilter(minVariance=100).IsInformative(createStripes(40)))
+        self.assertFalse(tileFilter.IsInformative(createStripes(40)))
+        self.assertEqual(tileFilter.skipped, 2)
+
+    def test_filtered_tiling(self):
+        config = ConfigSettings()
+        image = Image.new("RGB", (800, 600))
+        image.paste(Image.fromarray(np.random.default_rng(0).integers(0, 256, size=(300, 400, 3), dtype=np.uint8)), (0, 0))
+        image.save("./samples/tempFiles/filter-source.png")
+
+        tiler = DefaultImageTiler(config, 300, 400, InformativeTileFilter())
+        tiles = list(tiler.GenerateTiles("./samples/tempFiles/filter-source.png", True))
+        os.remove("./samples/tempFiles/filter-source.png")
+
+        # Only the first tile (and its 3 rotations) has any content
+        self.assertEqual([t.name for t in tiles], ["tile_1_0_0_0.png", "tile_1_0_0_90.png", "tile_1_0_0_180.png", "tile_1_0_0_270.png"])
+        self.assertEqual(tiler.tileFilter.skipped, 3)
+
+        # Parallel tiling makes the same (order dependent) decisions
+        tiler = DefaultImageTiler(config, 300, 400, InformativeTileFilter(), workerCount=2)
+        image.save("./samples/tempFiles/filter-source.png")
+        parallelTiles = list(tiler.GenerateTiles("./samples/tempFiles/filter-source.png", True))
+        os.remove("./samples/tempFiles/filter-source.png")
+        self.assertEqual(parallelTiles, tiles)
+        self.assertEqual((tiler.tileFilter.skipped, tiler.tileFilter.checked), (3, 4))
+
+    def test_shared_filter(self):
+        config = ConfigSettings()
+        createStripes(5).save("./samples/tempFiles/filter-first.png")
+        createStripes(40).save("./samples/tempFiles/filter-second.png")
+
+        # The second image only resembles a tile skipped in the first, so it's scored, and counts are per image
+        tileFilter = InformativeTileFilter(minVariance=100)
+        tiler = DefaultImageTiler(config, 512, 512, tileFilter)
+        self.assertEqual(list(tiler.GenerateTiles("./samples/tempFiles/filter-first.png", False)), [])
+        self.assertEqual((tileFilter.skipped, tileFilter.checked), (1, 1))
+        self.assertEqual(len(list(tiler.GenerateTiles("./samples/tempFiles/filter-second.png", False))), 1)
+        self.assertEqual((tileFilter.skipped, tileFilter.checked), (0, 1))
+        os.remove("./samples/tempFiles/filter-first.png")
+        os.remove("./samples/tempFiles/filter-second.png")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+import sys
+import os
+import io
+import numpy as np
+from PIL import Image, ImageDraw
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root)
+
+from ImageTiling import EncodeTileImage
+from UploadEncoding import UploadEncoder
+
+def createTile():
+    # Smooth gradients with a bright object, which compress well (unlike noise)
+    x = np.arange(1024)
+    pixels = np.stack([np.tile(x % 256, (768, 1)), np.tile((np.arange(768) // 3)[:, None], (1, 1024)), np.full((768, 1024), 90)], axis=2)
+    image = Image.fromarray(pixels.astype(np.uint8))
+    ImageDraw.Draw(image).rectangle((400, 300, 499, 399), fill=(255, 255, 255))
+    return image
+
+class TestUploadEncoding(unittest.TestCase):
+
+    def test_disabled(self):
+        data = EncodeTileImage(createTile())
+        encoder = UploadEncoder()
+        self.assertFalse(encoder.enabled)
+        self.assertIs(encoder.Encode(data), data)
+
+    def test_formats(self):
+        tile = createTile()
+        data = EncodeTileImage(tile)
+        for uploadFormat, imageFormat in (("png", "PNG"), ("jpeg", "JPEG"), ("webp", "WEBP")):
+            payload = UploadEncoder(uploadFormat, quality=80).Encode(data)
+            self.assertTrue(len(payload) < len(data) / 4)
+            with Image.open(io.BytesIO(payload)) as image:
+                self.assertEqual((image.format, image.size), (imageFormat, (1024, 768)))
+
+                # Optimized PNG is lossless
+                if uploadFormat == "png":
+                    self.assertTrue(np.array_equal(np.asarray(image), np.asarray(tile)))
+
+    def test_scale_down(self):
+        data = EncodeTileImage(createTile())
+        with Image.open(io.BytesIO(UploadEncoder("tile", 512).Encode(data))) as image:
+            self.assertEqual((image.format, image.size), ("PNG", (512, 384)))
+
+            # The object stays at the same place relative to the tile
+            pixels = np.asarray(image.convert("L"))
+            ys, xs = np.nonzero(pixels == 255)
+            np.testing.assert_allclose((xs.min() / 512, ys.min() / 384, (xs.max() + 1) / 512, (ys.max() + 1) / 384), (400 / 1024, 300 / 768, 500 / 1024, 400 / 768), atol=0.005)
+
+        # Tiles already within the size are left as they are
+        small = EncodeTileImage(Image.new("RGB", (256, 200)))
+        self.assertIs(UploadEncoder("tile", 512).Encode(small), small)
+
+    def test_invalid_settings(self):
+        with self.assertRaises(Exception):
+            UploadEncoder("gif")
+        with self.assertRaises(Exception):
+            UploadEncoder("jpeg", quality=0)
+        with self.assertRaises(Exception):
+            UploadEncoder("jpeg", maxSize=-1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+import sys
+import os
+import glob
+import tempfile
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root)
+
+from Settings import ConfigSettings
+from ImageTiling import DefaultImageTiler
+from Workspace import RunWorkspace, MANIFEST_NAME
+
+class TestRunWorkspace(unittest.TestCase):
+
+    def test_concurrent_runs(self):
+        config = ConfigSettings()
+        tiler = DefaultImageTiler(config, 600, 800)
+        with tempfile.TemporaryDirectory() as rootPath:
+            first = RunWorkspace(rootPath)
+            second = RunWorkspace(rootPath)
+            self.assertNotEqual(first.path, second.path)
+
+            # Each run only reads back the tiles it wrote, in the order they were written
+            tiler.CreateTiles("./samples/test-1.jpg", False, first)
+            tiler.CreateTiles("./samples/test-1.jpg", True, second)
+            tiles = list(first.ReadTiles())
+            self.assertEqual(len(tiles), 25)
+            self.assertEqual([t.name for t in tiles], [t.name for t in tiler.GenerateTiles("./samples/test-1.jpg", False)])
+            self.assertEqual(tiles[6], next(t for t in tiler.GenerateTiles("./samples/test-1.jpg", False) if t.name == "tile_7_1_1_0.png"))
+            self.assertEqual(len(second.GetTileNames()), 100)
+
+            # Tearing down one run removes its directory, and leaves the other run alone
+            first.Close()
+            first.Close()
+            self.assertFalse(os.path.exists(first.path))
+            self.assertEqual(len(glob.glob(os.path.join(second.path, "*.png"))), 100)
+
+            second.Close(keep=True)
+            self.assertTrue(os.path.exists(os.path.join(second.path, MANIFEST_NAME)))
+
+    def test_missing_root(self):
+        with self.assertRaises(Exception):
+            RunWorkspace(None)
+
+if __name__ == '__main__':
+    unittest.main()